@@ -0,0 +1,25 @@
+import statistics
+import subprocess
+import sys
+import time
+
+# Measures the cold import time of Saola's modules, each in a fresh interpreter.
+#
+# Usage: python benchmarks/import_time.py [num_runs]
+
+MODULES = ["saola", "saola.convo", "saola.model", "saola.ui", "saola.serve"]
+
+def _import_time(module):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", f"import {module}"], check=True)
+    return time.perf_counter() - start
+
+def main(num_runs=10):
+    baseline = statistics.median(_import_time("os") for _ in range(num_runs))
+    print(f"{'module':<16}{'median (ms)':>12}{'min (ms)':>12}")
+    for module in MODULES:
+        times = [_import_time(module) - baseline for _ in range(num_runs)]
+        print(f"{module:<16}{statistics.median(times) * 1000:>12.1f}{min(times) * 1000:>12.1f}")
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
@@ -0,0 +1,190 @@
+import os
+import sys
+import json
+import timeit
+import tempfile
+import argparse
+import contextlib
+from saola.doc import Doc
+from saola.model import Model
+from saola.base_convo import BaseConvo
+from saola.convo import Convo, TitleInterface, ShellInterface, FileShowInterface, FileWriteInterface, SearchInterface, PythonInterface
+from saola.ui import UI
+
+# Benchmarks of Saola's hot paths, driven by a synthetic in-process model (no network access needed).
+#
+# Usage: python benchmarks/run.py [-k FILTER] [--save-baseline] [--tolerance 0.25]
+#
+# Results are compared with benchmarks/baseline.json, and any benchmark slower than its baseline by more
+# than the tolerance is reported as a regression (with a non-zero exit code). Baselines depend on the
+# machine, so save them again (with --save-baseline) before comparing on a different one.
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+BENCHMARKS = {}
+
+def benchmark(name):
+    # Registers a function that prepares a benchmark and returns the callable to be timed
+    def decorator(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return decorator
+
+class SyntheticModel(Model):
+    def __init__(self, text, chunk_size=4):
+        self.text = text
+        self.chunk_size = chunk_size
+
+    def _stream_answer_nonstop(self, messages):
+        for i in range(0, len(self.text), self.chunk_size):
+            yield ("assistant", self.text[i:i + self.chunk_size])
+
+class SilentUI(UI):
+    def no_safety_confirmation(self):
+        return True
+
+def _words(num_words):
+    return " ".join(f"word{i % 97}" for i in range(num_words))
+
+def _noop_handler(author, chunk, ending):
+    return None
+
+def _stream_answer_with_handlers(num_handlers):
+    model = SyntheticModel(_words(5000))
+    handlers = [_noop_handler] * num_handlers
+    def run():
+        for _ in model.stream_answer([], *handlers): pass
+    return run
+
+for num_handlers in [1, 8, 32]:
+    benchmark(f"model.stream_answer[handlers={num_handlers}]")(lambda num_handlers=num_handlers: _stream_answer_with_handlers(num_handlers))
+
+def _interface_detection(num_words):
+    # A long answer without interface blocks, followed by one block (not executed)
+    text = _words(num_words) + "\n[__FILE_SHOW__]\n/dev/null\n[/__FILE_SHOW__]\n"
+    interfaces = [TitleInterface, ShellInterface, FileShowInterface, FileWriteInterface, SearchInterface, PythonInterface]
+    def run():
+        convo = Convo(SyntheticModel(text), ui=SilentUI(), interfaces=interfaces)
+        convo.user << "Show /dev/null"
+        for _ in BaseConvo.stream_answer(convo, convo.interface_matcher): pass
+        assert convo.current_matching_interface is not None
+    return run
+
+for num_words in [1000, 10000]:
+    benchmark(f"interface_detection[words={num_words}]")(lambda num_words=num_words: _interface_detection(num_words))
+
+def _convo_with_bubbles(num_bubbles):
+    convo = BaseConvo(ui=SilentUI())
+    convo.system << "You are a useful assistant."
+    for i in range(num_bubbles - 1): (convo.user if i % 2 == 0 else convo.assistant) << _words(50)
+    return convo
+
+def _messages_cold(num_bubbles):
+    def run():
+        convo = _convo_with_bubbles(num_bubbles)
+        return convo.messages
+    return run
+
+def _messages_streaming(num_bubbles):
+    # Building the messages after every streamed chunk of the last bubble
+    convo = _convo_with_bubbles(num_bubbles)
+    convo.messages
+    def run():
+        convo.bubbles[-1].doc.append(" chunk")
+        return convo.messages
+    return run
+
+for num_bubbles in [10, 100, 1000]:
+    benchmark(f"convo.messages[cold,bubbles={num_bubbles}]")(lambda num_bubbles=num_bubbles: _messages_cold(num_bubbles))
+    benchmark(f"convo.messages[streaming,bubbles={num_bubbles}]")(lambda num_bubbles=num_bubbles: _messages_streaming(num_bubbles))
+
+def _fork(num_bubbles):
+    convo = _convo_with_bubbles(num_bubbles)
+    convo.messages
+    def run():
+        fork = convo.fork()
+        fork.assistant << "A new branch"
+        return fork.messages
+    return run
+
+for num_bubbles in [200, 2000]:
+    benchmark(f"convo.fork[bubbles={num_bubbles}]")(lambda num_bubbles=num_bubbles: _fork(num_bubbles))
+
+@benchmark("doc.append_with_newline[appends=2000]")
+def _doc_append_with_newline():
+    def run():
+        doc = Doc()
+        for i in range(2000): doc.append_with_newline(f"    line {i}\n    of text  \n")
+        return doc.text
+    return run
+
+@benchmark("doc.append[chunks=20000]")
+def _doc_append():
+    def run():
+        doc = Doc()
+        for i in range(20000): doc.append("tok ")
+        return doc.text
+    return run
+
+@benchmark("file_show.execute[lines=20000]")
+def _file_show():
+    path = os.path.join(tempfile.mkdtemp(), "file.txt")
+    with open(path, "w") as f: f.write(os.linesep.join(f"line {i}" for i in range(20000)))
+    interface = FileShowInterface(Convo(SyntheticModel(""), ui=SilentUI()))
+    def run():
+        return interface.execute(f"{path}\n10000-10100")
+    return run
+
+@benchmark("file_write.execute[lines=20000]")
+def _file_write():
+    path = os.path.join(tempfile.mkdtemp(), "file.txt")
+    with open(path, "w") as f: f.write(os.linesep.join(f"line {i}" for i in range(20000)))
+    interface = FileWriteInterface(Convo(SyntheticModel(""), ui=SilentUI()))
+    def run():
+        return interface.execute(f"{path}\n10000-10010\nnew line 1\nnew line 2\n")
+    return run
+
+@benchmark("shell.execute[lines=20000]")
+def _shell():
+    interface = ShellInterface(Convo(SyntheticModel(""), ui=SilentUI()))
+    def run():
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            return interface.execute("seq 1 20000")
+    return run
+
+def _time(run, repeat):
+    timer = timeit.Timer(run)
+    (number, _) = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs Saola's benchmarks.")
+    parser.add_argument("-k", "--filter", default="", help="Only run the benchmarks whose name contains this text.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown over the baseline (0.25 is 25%%).")
+    parser.add_argument("--save-baseline", action="store_true", help="Save the results as the new baseline.")
+    args = parser.parse_args()
+    try:
+        with open(BASELINE_PATH, "r") as f: baseline = json.load(f)
+    except OSError:
+        baseline = {}
+    results = {}
+    regressions = []
+    print(f"{'benchmark':<48}{'time (ms)':>12}{'baseline':>12}{'change':>9}")
+    for (name, setup) in BENCHMARKS.items():
+        if args.filter not in name: continue
+        results[name] = _time(setup(), args.repeat)
+        line = f"{name:<48}{results[name] * 1000:>12.3f}"
+        if name in baseline:
+            change = results[name] / baseline[name] - 1
+            line += f"{baseline[name] * 1000:>12.3f}{change:>+9.0%}"
+            if change > args.tolerance: regressions.append(name)
+        print(line)
+    if args.save_baseline:
+        with open(BASELINE_PATH, "w") as f: json.dump(dict(baseline, **results), f, indent=2, sort_keys=True)
+    if regressions and not args.save_baseline:
+        print("Regressions: " + ", ".join(regressions))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,25 @@
+import copy
 import uuid
+from bisect import bisect_right
 import saola
 from saola.doc import Doc
 from functools import partial
 from saola.ui import DefaultUI
 
 class BaseConvo:
-    def __init__(self, model=None, ui=None):
+    def __init__(self, model=None, ui=None, context_manager=None):
         self.bubbles = []
         self.checkpoints = []
+        self._message_groups = []
+        self._dirty_bubbles = set()
         self.model = model() if isinstance(model, type) else model
         self.ui = ui or DefaultUI()
+        self.context_manager = context_manager
+        self._token_tally = None  # The token counts of the context manager, if any (see saola.context.TokenTally)
+        # Bubbles and message groups created with another epoch may be shared with forks, so they are copied
+        # before being changed (see fork)
+        self._epoch = object()
+        self.store = None  # A ConvoStore where the changes of this convo are appended (see saola.store)
 
     @property
     def system(self):
@@ -29,24 +39,105 @@ class BaseConvo:
     def bubble_maker(self, author, meta=None):
         return BubbleMaker(author, convo=self, meta=meta)
 
+    def _writable_bubble(self, index):
+        # Returns the bubble at index, after replacing it with a copy if it may be shared with forks
+        bubble = self.bubbles[index]
+        if bubble.epoch is not self._epoch:
+            bubble = bubble.copy(self)
+            self.bubbles[bubble.index] = bubble
+        return bubble
+
+    def _writable_group(self, group_index):
+        group = self._message_groups[group_index]
+        if group.epoch is not self._epoch:
+            group = group.copy(self._epoch)
+            self._message_groups[group_index] = group
+        return group
+
+    def _bubble_changed(self, index):
+        self._dirty_bubbles.add(index)
+        if self._token_tally is not None: self._token_tally.changed.add(index)
+
+    def _update_message_groups(self):
+        # Consecutive bubbles of the same author are merged into one message (as in copy(ignore_meta=True)).
+        # Only the groups containing changed bubbles are rebuilt, and new bubbles extend the last group or
+        # start new ones, so the cost is proportional to the changed bubbles rather than the whole convo.
+        groups = self._message_groups
+        if self._dirty_bubbles and groups:
+            starts = [group.start for group in groups]
+            covered = groups[-1].end
+            for group_index in set(bisect_right(starts, i) - 1 for i in self._dirty_bubbles if i < covered):
+                self._writable_group(group_index).rebuild(self.bubbles)
+        self._dirty_bubbles = set()
+        for i in range(groups[-1].end if groups else 0, len(self.bubbles)):
+            bubble = self.bubbles[i]
+            if groups and groups[-1].author == bubble.author:
+                self._writable_group(-1).extend(bubble)
+            else:
+                groups.append(MessageGroup(i, bubble, self._epoch))
+
+    def _truncate_message_groups(self, num_bubbles):
+        groups = self._message_groups
+        while groups and groups[-1].start >= num_bubbles: groups.pop()
+        if groups and groups[-1].end > num_bubbles:
+            self._writable_group(-1).end = num_bubbles
+            self._dirty_bubbles.add(groups[-1].start)
+        self._dirty_bubbles = set(i for i in self._dirty_bubbles if i < num_bubbles)
+
     @property
     def messages(self):
-        convo = self.copy(ignore_meta=True)
-        return [{'role': bubble.author, 'content': bubble.text} for bubble in convo.bubbles]
+        self._update_message_groups()
+        messages = [group.message for group in self._message_groups]
+        return self.context_manager.fit(self, messages) if self.context_manager else messages
 
     def copy(self, ignore_meta=False):
         convo = BaseConvo(model=self.model)
         for bubble in self.bubbles: convo.bubble_maker(bubble.author, meta=None if ignore_meta else bubble.meta) << bubble.text
         return convo
 
+    def fork(self):
+        """
+        Returns a branch of this convo, which can be continued (and streamed) independently of it.
+        The bubbles and messages are shared by both convos until one of them changes them, at which
+        point that convo changes a copy of its own (copy-on-write). Forking thus only copies the lists
+        of bubbles and messages, and neither the bubbles nor their texts.
+        """
+        fork = copy.copy(self)
+        fork.bubbles = list(self.bubbles)
+        fork.checkpoints = list(self.checkpoints)
+        fork._message_groups = list(self._message_groups)
+        fork._dirty_bubbles = set(self._dirty_bubbles)
+        fork._token_tally = self._token_tally.copy() if self._token_tally is not None else None
+        fork.store = None
+        # Both convos get a new epoch, so the bubbles and message groups created so far become shared
+        fork._epoch = object()
+        self._epoch = object()
+        return fork
+
+    def adopt(self, fork):
+        # Continues this convo from one of its forks (e.g. the best of several answers), sharing its bubbles
+        if self.store is not None:
+            start = next((i for (i, (a, b)) in enumerate(zip(self.bubbles, fork.bubbles)) if a is not b), min(len(self.bubbles), len(fork.bubbles)))
+            self.store.bubbles_replaced(fork, start)
+        self.bubbles = list(fork.bubbles)
+        self.checkpoints = list(fork.checkpoints)
+        if self.store is not None: self.store.checkpoints_changed(self)
+        self._message_groups = list(fork._message_groups)
+        self._dirty_bubbles = set(fork._dirty_bubbles)
+        self._token_tally = fork._token_tally.copy() if fork._token_tally is not None else None
+        fork._epoch = object()
+        self._epoch = object()
+
     def _stream_to_bubble_handler(self, bubble_box, author, chunk, ending):
         bubble = bubble_box[0] or self.bubble_maker(author) << ""
         bubble_box[0] = bubble
-        bubble.doc.text += chunk or ""
+        bubble.doc.append(chunk or "")
 
-    def stream_answer(self, *handlers):
-        bubble_box = [None]
-        for (_, chunk, _) in self.model.stream_answer(self.messages, *handlers, partial(self._stream_to_bubble_handler, bubble_box)):
+    def stream_answer(self, *handlers, resume=False):
+        # With resume, the answer is appended as it is to the last bubble (e.g. to resume a stream cut short)
+        bubble_box = [self._writable_bubble(-1) if resume and self.bubbles else None]
+        store_handler = self.store.stream_handler if self.store is not None else None
+        for (_, chunk, _) in self.model.stream_answer(self.messages, *handlers, partial(self._stream_to_bubble_handler, bubble_box), store_handler):
             yield (bubble_box[0], chunk)
 
     def stream_answer_to_end(self, *handlers):
@@ -67,17 +158,22 @@ class BaseConvo:
         if len(self.bubbles) == 0: return
         meta = self.bubbles[-1].meta or {}
         if 'checkpoint_uuid' in meta: return
-        self.bubbles[-1].meta = dict(**meta, checkpoint_uuid=str(uuid.uuid4()))
+        self._writable_bubble(-1).meta = dict(**meta, checkpoint_uuid=str(uuid.uuid4()))
 
     def checkpoint(self):
         self.tag_bubble_with_uuid()
         self.checkpoints.append(len(self.bubbles))
+        if self.store is not None: self.store.checkpoints_changed(self)
         return self.checkpoints[-1]
 
     def rollback(self, checkpoint=None):
         checkpoint = checkpoint or (self.checkpoints[-1] if len(self.checkpoints) > 0 else 0)
         self.checkpoints = [c for c in self.checkpoints if c < checkpoint]
         self.bubbles = self.bubbles[:checkpoint]
+        self._truncate_message_groups(len(self.bubbles))
+        if self.store is not None:
+            self.store.bubbles_truncated(len(self.bubbles))
+            self.store.checkpoints_changed(self)
 
     def loop(self):
         saola.user = UserRef(self)
@@ -118,9 +214,40 @@ class Bubble:
     def __init__(self, author, convo, meta=None):
         self.author = author
         self.convo = convo
-        self.meta = meta
-        self.doc = Doc()
+        self._meta = meta
+        self.index = len(convo.bubbles)
+        self.epoch = convo._epoch
+        self.num_tokens = None  # Cached by the context manager of the convo
+        self.doc = Doc(on_change=self._doc_changed)
         self.convo.bubbles.append(self)
+        self.convo._bubble_changed(self.index)
+        if self.convo.store is not None: self.convo.store.bubble_created(self)
+
+    def copy(self, convo):
+        # Returns a copy of this bubble for convo, at the same index (see BaseConvo.fork)
+        bubble = Bubble.__new__(Bubble)
+        bubble.author = self.author
+        bubble.convo = convo
+        bubble._meta = dict(self.meta) if self.meta is not None else None
+        bubble.index = self.index
+        bubble.epoch = convo._epoch
+        bubble.num_tokens = self.num_tokens
+        bubble.doc = self.doc.copy(on_change=bubble._doc_changed)
+        return bubble
+
+    def _doc_changed(self, kind, value):
+        self.num_tokens = None
+        self.convo._bubble_changed(self.index)
+        if self.convo.store is not None: self.convo.store.bubble_edited(self, kind, value)
+
+    @property
+    def meta(self):
+        return self._meta
+
+    @meta.setter
+    def meta(self, meta):
+        self._meta = meta
+        if self.convo.store is not None: self.convo.store.meta_changed(self)
 
     def __lshift__(self, text):
         self.doc.append_with_newline(str(text))
@@ -130,6 +257,40 @@ class Bubble:
     def text(self):
         return self.doc.text
 
+class MessageGroup:
+    """
+    A message of the convo, made of consecutive bubbles of the same author.
+    """
+    def __init__(self, start, bubble, epoch=None):
+        self.start = start
+        self.end = start
+        self.author = bubble.author
+        self.epoch = epoch
+        self.doc = Doc()
+        self._message = None
+        self.extend(bubble)
+
+    def copy(self, epoch):
+        group = copy.copy(self)
+        group.epoch = epoch
+        group.doc = self.doc.copy()
+        return group
+
+    def extend(self, bubble):
+        self.doc.append_with_newline(bubble.text)
+        self.end += 1
+        self._message = None
+
+    def rebuild(self, bubbles):
+        self.doc = Doc()
+        for bubble in bubbles[self.start:self.end]: self.doc.append_with_newline(bubble.text)
+        self._message = None
+
+    @property
+    def message(self):
+        if self._message is None: self._message = {'role': self.author, 'content': self.doc.text}
+        return self._message
+
 class BubbleMaker:
     def __init__(self, author, convo, meta=None):
         self.author = author
@@ -145,6 +306,6 @@ class BubbleMaker:
 
     def __lshift__(self, text):
         if self._matches_convo_last_bubble():
-            return self.convo.bubbles[-1] << text
+            return self.convo._writable_bubble(-1) << text
         else:
             return Bubble(self.author, self.convo, meta=self.meta) << text
\ No newline at end of file
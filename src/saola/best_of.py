@@ -0,0 +1,107 @@
+import asyncio
+import threading
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+from saola.model import R
+
+_DONE = object()
+
+class BestOf:
+    """
+    Answers a convo n times at once, each answer being streamed in its own fork of the convo, and then
+    continues the convo from the answer with the highest scorer(fork).
+
+    With a Convo, the forks are streamed in threads (at most max_workers at once), and with an AsyncConvo,
+    in tasks of the running event loop. The stream handlers are given to every fork, so they may be called
+    from several threads at once. Forks whose stream raises an exception are not scored, and the exception
+    is raised if all the forks fail.
+
+    The forks only stream text: each one stops at its first interface block, without running it. Once the
+    best fork is adopted, the convo runs the blocks of that answer (asking for confirmations as usual) and
+    streams the rest of it, which is yielded as part of the winning fork.
+    """
+    def __init__(self, convo, n, scorer, max_workers=None):
+        self.convo = convo
+        self.scorer = scorer
+        self.max_workers = max_workers or n
+        self.forks = [convo.fork() for _ in range(n)]
+        for fork in self.forks:
+            if hasattr(fork, "execute_interfaces"): fork.execute_interfaces = False
+        self.errors = {}  # Exceptions raised by the streams of the forks, by fork index
+        self.scores = None
+        self.winner = None  # The index of the fork that was adopted
+        self._stopped = threading.Event()
+
+    def _stop_handler(self, author, chunk, ending):
+        # Stops the streams of the forks when the caller stops iterating
+        if self._stopped.is_set(): return R(chunk=True, should_yield=False, should_continue=False)
+
+    def _choose(self):
+        if len(self.errors) == len(self.forks): raise next(iter(self.errors.values()))
+        self.scores = [None if i in self.errors else self.scorer(fork) for (i, fork) in enumerate(self.forks)]
+        self.winner = max((i for i in range(len(self.forks)) if i not in self.errors), key=lambda i: self.scores[i])
+        self.convo.adopt(self.forks[self.winner])
+        for (i, fork) in enumerate(self.forks):
+            if i != self.winner and hasattr(fork, "close"): fork.close()
+
+    def stream(self, *handlers):
+        # Yields triplets (fork index, bubble, chunk) as the forks stream them, then adopts the best fork
+        queue = Queue()
+        def stream_fork(i, fork):
+            try:
+                for (bubble, chunk) in fork.stream_answer(self._stop_handler, *handlers): queue.put((i, bubble, chunk))
+            except Exception as e:
+                self.errors[i] = e
+            finally:
+                queue.put((i, _DONE, None))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            try:
+                for (i, fork) in enumerate(self.forks): executor.submit(stream_fork, i, fork)
+                remaining = len(self.forks)
+                while remaining:
+                    (i, bubble, chunk) = queue.get()
+                    if bubble is _DONE:
+                        remaining -= 1
+                        continue
+                    yield (i, bubble, chunk)
+            finally:
+                self._stopped.set()
+        self._choose()
+        if hasattr(self.convo, "interfaces_pending") and self.convo.interfaces_pending():
+            for (bubble, chunk) in self.convo.stream_answer(*handlers): yield (self.winner, bubble, chunk)
+
+    async def astream(self, *handlers):
+        # Same as stream, for AsyncConvo
+        queue = asyncio.Queue()
+        semaphore = asyncio.Semaphore(self.max_workers)
+        async def stream_fork(i, fork):
+            try:
+                async with semaphore:
+                    async for (bubble, chunk) in fork.stream_answer(self._stop_handler, *handlers): await queue.put((i, bubble, chunk))
+            except Exception as e:
+                self.errors[i] = e
+            finally:
+                await queue.put((i, _DONE, None))
+        tasks = [asyncio.ensure_future(stream_fork(i, fork)) for (i, fork) in enumerate(self.forks)]
+        try:
+            remaining = len(self.forks)
+            while remaining:
+                (i, bubble, chunk) = await queue.get()
+                if bubble is _DONE:
+                    remaining -= 1
+                    continue
+                yield (i, bubble, chunk)
+        finally:
+            self._stopped.set()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self._choose()
+        if hasattr(self.convo, "interfaces_pending") and self.convo.interfaces_pending():
+            async for (bubble, chunk) in self.convo.stream_answer(*handlers): yield (self.winner, bubble, chunk)
+
+    def stream_to_end(self, *handlers):
+        for _ in self.stream(*handlers): pass
+        return self.convo.bubbles[-1] if self.convo.bubbles else None
+
+    async def astream_to_end(self, *handlers):
+        async for _ in self.astream(*handlers): pass
+        return self.convo.bubbles[-1] if self.convo.bubbles else None
@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from saola.model import Model, _continue_answer
+
+class ResponseCache:
+    """
+    A cache of JSON-serializable values, with an in-memory LRU of up to max_entries values, and
+    optionally an SQLite file at path holding up to max_disk_bytes of values (least recently used
+    values are evicted first).
+
+    Hits in memory refresh the access times on disk in batches of touch_batch (and on put, clear and
+    close), so the disk LRU order also follows them.
+    """
+    touch_batch = 64
+    evict_batch = 64
+
+    def __init__(self, max_entries=1024, path=None, max_disk_bytes=256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._disk_size = 0
+        self._touched = {}  # Access times of the memory hits not written to disk yet, by key
+        if path:
+            path = os.path.abspath(os.path.expanduser(path))
+            if os.path.dirname(path): os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT, size INTEGER, accessed REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+            self._db.commit()
+            (self._disk_size,) = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()
+
+    def _remember(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries: self._entries.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                if self._db is not None:
+                    self._touched[key] = time.time()
+                    if len(self._touched) >= self.touch_batch:
+                        self._write_touched()
+                        self._db.commit()
+                return self._entries[key]
+            if self._db is None: return None
+            row = self._db.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None: return None
+            self._db.execute("UPDATE entries SET accessed = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            value = json.loads(row[0])
+            self._remember(key, value)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._remember(key, value)
+            if self._db is None: return
+            serialized = json.dumps(value)
+            self._touched.pop(key, None)
+            self._write_touched()
+            row = self._db.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            self._db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)", (key, serialized, len(serialized), time.time()))
+            self._disk_size += len(serialized) - (row[0] if row else 0)
+            while self._disk_size > self.max_disk_bytes:
+                # Least recently used entries are evicted a batch at a time, until the values fit
+                rows = self._db.execute("SELECT key, size FROM entries ORDER BY accessed LIMIT ?", (self.evict_batch,)).fetchall()
+                if not rows: break
+                for (old_key, size) in rows:
+                    if self._disk_size <= self.max_disk_bytes: break
+                    self._db.execute("DELETE FROM entries WHERE key = ?", (old_key,))
+                    self._disk_size -= size
+            self._db.commit()
+
+    def _write_touched(self):
+        # Writes the access times of the memory hits to disk (the caller commits)
+        if not self._touched: return
+        self._db.executemany("UPDATE entries SET accessed = ? WHERE key = ?", [(t, k) for (k, t) in self._touched.items()])
+        self._touched.clear()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._touched.clear()
+            if self._db is None: return
+            self._db.execute("DELETE FROM entries")
+            self._db.commit()
+            self._disk_size = 0
+
+    def close(self):
+        with self._lock:
+            if self._db is None: return
+            self._write_touched()
+            self._db.commit()
+            self._db.close()
+            self._db = None
+
+class CachedModel(Model):
+    """
+    Wraps any model, caching its answers by a hash of the model name and the messages.
+
+    Cached streams are replayed chunk by chunk, so they go through the stream handlers (and interface
+    detection) as usual. A stream stopped by the handlers (e.g. at an interface block) is cached as far
+    as it was consumed, and if a replay of it needs more chunks, the model is asked to continue the
+    replayed answer (sent as a partial assistant message, as when retrying a stream, see saola.model).
+    """
+    def __init__(self, model, cache=None, **cache_kwargs):
+        self.model = model() if isinstance(model, type) else model
+        self.cache = cache or ResponseCache(**cache_kwargs)
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def model_name(self):
+        return getattr(self.model, "model_name", type(self.model).__name__)
+
+    def key(self, kind, messages):
+        payload = json.dumps({"kind": kind, "model": self.model_name, "messages": messages}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _stream_answer_nonstop(self, messages):
+        key = self.key("stream", messages)
+        entry = self.cache.get(key)
+        chunks = []
+        if entry is not None:
+            self.hits += 1
+            for (author, chunk) in entry["chunks"]:
+                chunks.append((author, chunk))
+                yield (author, chunk)
+            if entry["complete"]: return
+        else:
+            self.misses += 1
+        replayed = "".join(chunk or "" for (_, chunk) in chunks)
+        complete = False
+        try:
+            for (author, chunk) in self.model._stream_answer_nonstop(_continue_answer(messages, replayed)):
+                chunks.append((author, chunk))
+                yield (author, chunk)
+            complete = True
+        finally:
+            if chunks: self.cache.put(key, {"chunks": chunks, "complete": complete})
+
+    def _get_answer(self, messages):
+        key = self.key("answer", messages)
+        entry = self.cache.get(key)
+        if entry is not None:
+            self.hits += 1
+            return tuple(entry)
+        self.misses += 1
+        answer = self.model._get_answer(messages)
+        self.cache.put(key, list(answer))
+        return answer
@@ -0,0 +1,196 @@
+from bisect import bisect_right
+from saola.doc import Doc
+from saola.base_convo import MessageGroup
+
+# CONTEXT MANAGERS
+# ================
+# A context manager is given to a convo (BaseConvo(context_manager=...)) and decides which messages
+# are sent to the model. It is any object with a fit(convo, messages) method returning the messages to send.
+
+def estimate_tokens(text):
+    # A rough estimate for English text and code, used when no tokenizer is given
+    return (len(text) + 3) // 4
+
+def tiktoken_counter(model_name):
+    # Returns an exact token counter for an OpenAI model (requires the optional tiktoken package)
+    import tiktoken
+    encoding = tiktoken.encoding_for_model(model_name)
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+class ContextManager:
+    """
+    Keeps the messages of each request under max_tokens.
+
+    While over budget, it first hides (or summarizes) the oldest interface outputs, and then drops the
+    oldest bubbles. System bubbles, checkpointed bubbles, the last bubble and the bubbles of the last
+    keep_recent_turns turns (a turn starts with a user bubble) are never touched, except for the interface
+    outputs of those turns, so that a long turn running many interfaces still fits. Token counts are cached per bubble
+    and only recounted when a bubble changes. Subclasses may override pinned and the policies.
+    """
+    output_placeholder = "[OUTPUT HIDDEN]"
+    message_overhead = 4  # Tokens taken by the role and delimiters of every message
+
+    def __init__(self, max_tokens, count_tokens=None, keep_recent_turns=2, summarize=None):
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens or estimate_tokens
+        self.keep_recent_turns = keep_recent_turns
+        self.summarize = summarize
+        self.policies = [self.hide_stale_outputs, self.drop_old_bubbles]
+
+    def bubble_tokens(self, bubble):
+        if bubble.num_tokens is None: bubble.num_tokens = self.count_tokens(bubble.text) + self.message_overhead
+        return bubble.num_tokens
+
+    def pinned(self, convo):
+        # Returns the set of indices of the bubbles that must be sent as they are
+        pinned = set()
+        turns = 0
+        recent_start = 0
+        for bubble in reversed(convo.bubbles):
+            if bubble.author == "user":
+                turns += 1
+                if turns >= self.keep_recent_turns:
+                    recent_start = bubble.index
+                    break
+        for bubble in convo.bubbles:
+            recent = bubble.index >= recent_start and not (bubble.meta and 'interface' in bubble.meta)
+            if bubble.author == "system" or recent or (bubble.meta and 'checkpoint_uuid' in bubble.meta):
+                pinned.add(bubble.index)
+        if convo.bubbles: pinned.add(len(convo.bubbles) - 1)  # The output (or message) the model answers
+        return pinned
+
+    # Policies replace texts (or drop them, with None) and their token counts, until the total is within budget
+    def hide_stale_outputs(self, convo, texts, tokens, pinned, total):
+        for bubble in convo.bubbles:
+            if total <= self.max_tokens: break
+            if bubble.index in pinned or texts[bubble.index] is None: continue
+            if not bubble.meta or 'interface' not in bubble.meta: continue
+            text = self.summarize(texts[bubble.index]) if self.summarize else self.output_placeholder
+            if text == texts[bubble.index]: continue
+            texts[bubble.index] = text
+            total -= tokens[bubble.index]
+            tokens[bubble.index] = self.count_tokens(text) + self.message_overhead
+            total += tokens[bubble.index]
+        return total
+
+    def drop_old_bubbles(self, convo, texts, tokens, pinned, total):
+        for bubble in convo.bubbles:
+            if total <= self.max_tokens: break
+            if bubble.index in pinned or texts[bubble.index] is None: continue
+            texts[bubble.index] = None
+            total -= tokens[bubble.index]
+            tokens[bubble.index] = 0
+        return total
+
+    def _tally(self, convo):
+        # Returns the TokenTally of the convo, brought up to date with the bubbles changed since the last request
+        tally = convo._token_tally
+        if tally is None or tally.context_manager is not self:
+            tally = convo._token_tally = TokenTally(self)
+            tally.changed.update(range(len(convo.bubbles)))
+        counts = tally.counts
+        while len(counts) > len(convo.bubbles): tally.total -= counts.pop()  # Rolled back
+        if len(counts) < len(convo.bubbles):
+            tally.changed.update(range(len(counts), len(convo.bubbles)))
+            counts.extend([0] * (len(convo.bubbles) - len(counts)))
+        for index in tally.changed:
+            if index >= len(counts): continue
+            count = self.bubble_tokens(convo.bubbles[index])
+            tally.total += count - counts[index]
+            counts[index] = count
+        tally.changed = set()
+        return tally
+
+    def fit(self, convo, messages):
+        tally = self._tally(convo)
+        total = tally.total
+        if total <= self.max_tokens: return messages
+        tokens = list(tally.counts)
+        texts = _Texts(convo.bubbles)
+        pinned = self.pinned(convo)
+        for policy in self.policies:
+            if total <= self.max_tokens: break
+            total = policy(convo, texts, tokens, pinned, total)
+        if not texts.replaced: return messages
+        return _replace_in_messages(convo, texts, tally)
+
+class TokenTally:
+    """
+    The token counts of the bubbles of a convo as last counted by its context manager, and their total,
+    which is updated from the bubbles changed since (kept in changed by the convo) on every request. The
+    messages rebuilt with replaced texts are also kept, by author and texts, as the same bubbles are
+    usually replaced on every request.
+    """
+    def __init__(self, context_manager):
+        self.context_manager = context_manager
+        self.counts = []
+        self.total = 0
+        self.changed = set()
+        self.messages = {}
+
+    def copy(self):
+        tally = TokenTally(self.context_manager)
+        tally.counts = list(self.counts)
+        tally.total = self.total
+        tally.changed = set(self.changed)
+        tally.messages = dict(self.messages)
+        return tally
+
+class _Texts:
+    # The texts of the bubbles, as replaced by the policies (None for dropped bubbles), keeping only the replaced ones
+    def __init__(self, bubbles):
+        self.bubbles = bubbles
+        self.replaced = {}
+
+    def __len__(self):
+        return len(self.bubbles)
+
+    def __getitem__(self, index):
+        return self.replaced[index] if index in self.replaced else self.bubbles[index].text
+
+    def __setitem__(self, index, text):
+        self.replaced[index] = text
+
+def _replace_in_messages(convo, texts, tally):
+    # Returns the messages of the convo with the replaced texts. Only the messages (message groups) with replaced
+    # texts are rebuilt, unless they are merged with the messages next to them, when the ones between are dropped.
+    groups = convo._message_groups
+    starts = [group.start for group in groups]
+    changed_groups = set(bisect_right(starts, index) - 1 for index in texts.replaced)
+    parts = []  # Pairs (author, message group kept as it is, or list of texts)
+    for (group_index, group) in enumerate(groups):
+        if group_index in changed_groups:
+            group_texts = [texts[i] for i in range(group.start, group.end) if texts[i] is not None]
+            if not group_texts: continue
+            part = (group.author, group_texts)
+        else:
+            part = (group.author, group)
+        if parts and parts[-1][0] == group.author:
+            parts[-1] = (group.author, _part_texts(parts[-1][1], texts) + _part_texts(part[1], texts))
+        else:
+            parts.append(part)
+    messages = []
+    rebuilt = {}
+    for (author, part) in parts:
+        if isinstance(part, MessageGroup):
+            messages.append(part.message)
+            continue
+        key = (author, tuple(part))
+        rebuilt[key] = tally.messages.get(key) or _merge_into_messages([(author, text) for text in part])[0]
+        messages.append(rebuilt[key])
+    tally.messages = rebuilt
+    return messages
+
+def _part_texts(part, texts):
+    return part if isinstance(part, list) else [texts[i] for i in range(part.start, part.end)]
+
+def _merge_into_messages(authors_and_texts):
+    # Merges consecutive texts of the same author, like BaseConvo.messages
+    authors = []
+    docs = []
+    for (author, text) in authors_and_texts:
+        if not authors or authors[-1] != author:
+            authors.append(author)
+            docs.append(Doc())
+        docs[-1].append_with_newline(text)
+    return [{'role': author, 'content': doc.text} for (author, doc) in zip(authors, docs)]
@@ -1,40 +1,159 @@
 import os
 import sys
-import subprocess
+import asyncio
+import copy
+import threading
+from functools import partial
 from io import StringIO
 from saola.base_convo import BaseConvo
+from saola.outputs import OutputIndex
 from saola.model import R
-from saola.utils import _is_notebook
-import pexpect
+from saola.utils import _is_notebook, _get_username, _lazy_class_attribute
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 class Convo(BaseConvo):
-    def __init__(self, model, *, ui=None, interfaces=None, safety_checks=True):
-        super().__init__(model, ui=ui)
+    max_parallel_interfaces = 8  # Threads running interface blocks at once, with parallel_interfaces
+    max_speculative_interfaces = 8  # Threads running interface blocks speculatively, with speculative_interfaces
+
+    def __init__(self, model, *, ui=None, interfaces=None, safety_checks=True, context_manager=None, interface_options=None, parallel_interfaces=False,
+                 speculative_interfaces=False):
+        super().__init__(model, ui=ui, context_manager=context_manager)
+        # Attributes overridden on the interfaces of this convo, by interface name, e.g. {"SHELL": {"timeout": 60}}
+        self.interface_options = interface_options or {}
+        # State kept by interfaces across executions (e.g. shell sessions), closed with the convo
+        self.interface_state = {}
+        # Snapshots of the interface states that support them, by checkpoint
+        self.interface_snapshots = {}
+        # Interface outputs, indexed to hide those repeated or superseded by later ones
+        self.outputs = OutputIndex()
         self.current_streaming_bubble = None
         self.current_matching_interface = None
+        # With parallel_interfaces, the blocks of a message are queued while it streams, and run once it ends
+        # (those of pure interfaces at once, see Interface.pure), instead of stopping the stream at each block
+        self.parallel_interfaces = parallel_interfaces
+        self.queued_interfaces = []
+        # With speculative_interfaces, the blocks of pure interfaces start running as soon as they are streamed
+        # (see Interface._speculate), if they need no confirmation, in threads of a pool closed with the convo
+        self.speculative_interfaces = speculative_interfaces
+        self._speculation_pool = None
+        # Without execute_interfaces, streaming stops at the first block to run, leaving it (and those queued)
+        # to the convo that adopts this one (see saola.best_of)
+        self.execute_interfaces = True
         self.interfaces = interfaces or []
         self.safety_checks = safety_checks
         self.next_interface_title = None
+        self.interface_matcher = InterfaceMatcher(self, self.interfaces)
         if len(self.interfaces) > 0:
             self.system << """
             You are a useful AI assistant that has just been equiped with the novel ability to to leverage a collection of "interfaces" to access real-time data and external systems, directly in-chat, in order to answer the user's questions or fulfill user requests. You try to answer all the user's questions and perform the tasks requested by the user, and you promptly leverage the available interfaces whenever needed. These interfaces allow you to perform tasks that a normal LLM-based assistant would not be able to perform.
             To trigger an interface, you start in a new line with [__INTERFACE_NAME__], followed by your command, ending with [/__INTERFACE_NAME__], followed by a line break. The output of this command will show up in the chat and you may proceed to answer questions and requests based on those outputs.
             The available interfaces are listed below.
             """
-            for interface in self.interfaces:
+            for interface in self.interface_matcher.prototypes:
                 self.system << f"""
                 {interface.name} Interface:
                 [__{interface.name}__]...[/__{interface.name}__]
                 """
                 self.system << interface.explanation
+                notes = interface.explanation_notes()
+                if notes: self.system << notes
+            if parallel_interfaces:
+                self.system << """
+                You may use several interfaces in one message, if they don't depend on each other's outputs. They will run once your message ends, in the order they appear, and their outputs will then show up in the chat in the same order.
+                """
             # TODO: Consider removing this and restoring it depending on whether new version of GPT will require this instruction.
             # self.system << f"""
             # Feel free to go step by step when following instructions from the user. It is ok to ask for clarification questions, or to use the interfaces provided to find out more information before performing an action.
             # """
     
+    def checkpoint(self):
+        checkpoint = super().checkpoint()
+        self._discard_snapshots(self.interface_snapshots.pop(checkpoint, {}))
+        self.interface_snapshots[checkpoint] = {name: state.snapshot() for (name, state) in self.interface_state.items() if hasattr(state, "snapshot")}
+        return checkpoint
+
+    def rollback(self, checkpoint=None):
+        checkpoint = checkpoint or (self.checkpoints[-1] if len(self.checkpoints) > 0 else 0)
+        super().rollback(checkpoint)
+        self.outputs.truncate(self, len(self.bubbles))
+        # Interface states are restored as they were at the checkpoint, and those created since are closed
+        snapshots = self.interface_snapshots.get(checkpoint, {} if checkpoint == 0 else None)
+        if snapshots is not None:
+            for (name, state) in list(self.interface_state.items()):
+                if not hasattr(state, "snapshot"): continue
+                if name in snapshots:
+                    state.restore(snapshots[name])
+                else:
+                    state.close()
+                    del self.interface_state[name]
+        for c in [c for c in self.interface_snapshots if c >= checkpoint]: self._discard_snapshots(self.interface_snapshots.pop(c))
+
+    def fork(self):
+        fork = super().fork()
+        fork.current_streaming_bubble = None
+        fork.current_matching_interface = None
+        fork.queued_interfaces = []
+        fork._speculation_pool = None
+        fork.interface_matcher = self.interface_matcher.fork(fork)
+        fork.outputs = self.outputs.copy()
+        # Interface states are forked if they support it (e.g. Python namespaces), and otherwise created
+        # anew by the fork when needed. Forked states share the snapshots of the states they come from.
+        fork.interface_state = {name: state.fork() for (name, state) in self.interface_state.items() if hasattr(state, "fork")}
+        fork.interface_snapshots = {}
+        for (checkpoint, snapshots) in self.interface_snapshots.items():
+            fork.interface_snapshots[checkpoint] = {name: snapshot for (name, snapshot) in snapshots.items() if name in fork.interface_state}
+        return fork
+
+    def adopt(self, fork):
+        super().adopt(fork)
+        self.current_matching_interface = fork.current_matching_interface
+        self.queued_interfaces = fork.queued_interfaces
+        for interface in [self.current_matching_interface] + self.queued_interfaces:
+            if interface: interface.convo = self
+        self.next_interface_title = fork.next_interface_title
+        self.outputs = fork.outputs.copy()
+        # The interface states of the fork (and their snapshots) replace those of this convo, which keeps the others
+        snapshots = {}
+        for (checkpoint, fork_snapshots) in fork.interface_snapshots.items():
+            snapshots[checkpoint] = {name: snapshot for (name, snapshot) in self.interface_snapshots.get(checkpoint, {}).items() if name not in fork.interface_state}
+            snapshots[checkpoint].update(fork_snapshots)
+        for (name, state) in fork.interface_state.items():
+            if name in self.interface_state and self.interface_state[name] is not state: self.interface_state[name].close()
+            self.interface_state[name] = state
+        self.interface_snapshots = snapshots
+        fork.interface_state = {}
+        fork.interface_snapshots = {}
+
+    def _discard_snapshots(self, snapshots):
+        for (name, snapshot) in snapshots.items():
+            if name in self.interface_state: self.interface_state[name].discard(snapshot)
+
+    def _speculation_executor(self):
+        if self._speculation_pool is None: self._speculation_pool = ThreadPoolExecutor(max_workers=self.max_speculative_interfaces)
+        return self._speculation_pool
+
+    def close(self):
+        for interface in [self.current_matching_interface] + self.queued_interfaces:
+            if interface: interface._drop_speculation()
+        if self._speculation_pool is not None:
+            # Blocks already running speculatively finish in the background, as they only read data
+            self._speculation_pool.shutdown(wait=False)
+            self._speculation_pool = None
+        for state in self.interface_state.values():
+            if hasattr(state, "close"): state.close()
+        self.interface_state = {}
+        self.interface_snapshots = {}
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     @property
     def user(self):
+        for interface in [self.current_matching_interface] + self.queued_interfaces:
+            if interface: interface._drop_speculation()
         self.current_matching_interface = None
+        self.queued_interfaces = []
         return super().user
     
     def ready_for_user_input(self):
@@ -43,23 +162,93 @@ class Convo(BaseConvo):
     def stream_answer(self, *handlers):
         self.current_streaming_bubble = None
         while True:
-            if not self.current_matching_interface:
-                for (bubble, chunk) in super().stream_answer(*[i(self) for i in self.interfaces], *handlers):
+            if not self.interfaces_pending():
+                # The matching of a block cut short (in a recovered convo) goes on as the stream resumes
+                if not self.current_matching_interface: self.interface_matcher.reset()
+                for (bubble, chunk) in super().stream_answer(self.interface_matcher, *handlers, resume=bool(self.current_matching_interface)):
                     self.current_streaming_bubble = bubble
                     yield (bubble, chunk)
             else:
                 self.current_streaming_bubble = self.bubbles[-1]
-            interface = self.current_matching_interface
-            meta = interface.meta if interface else None
+            if not self.execute_interfaces: break
+            if self._append_interface_outputs(self._execute_interfaces()): break
+        self.current_streaming_bubble = None
+
+    def interfaces_pending(self):
+        # Whether blocks were streamed that have not run yet (e.g. waiting for a confirmation, or in a fork
+        # that was adopted), in which case streaming the answer runs them before going on
+        return bool(self.queued_interfaces) or (self.current_matching_interface is not None and self.current_matching_interface.current_code is not None)
+
+    def _interface_changed(self):
+        if self.store is not None: self.store.interface_changed(self.current_matching_interface)
+
+    def _restore_interface(self, record):
+        # Restores the interface block that was streamed or about to run when the convo was saved (see saola.store)
+        index = next((i for (i, interface) in enumerate(self.interfaces) if interface.name == record["name"]), None)
+        if index is None: return
+        if record["code"] is not None:
+            interface = self.interfaces[index](self)
+            interface.current_code = record["code"]
+            interface.approved = record["approved"]
+            self.current_matching_interface = interface
+            return
+        # The block was cut short, so the matcher is fed its text, and will go on matching it if the stream is resumed
+        text = self.bubbles[-1].text if self.bubbles else ""
+        start = text.rfind(self.interface_matcher.prototypes[index].pattern_start)
+        if start != -1: self.interface_matcher.resume(text[start:])
+
+    def _execute_interfaces(self):
+        # Runs the interface block that ended the stream, or the blocks queued while streaming (with
+        # parallel_interfaces), and returns the pairs (interface, output) of those that ran, in order
+        interface = self.current_matching_interface
+        if not self.parallel_interfaces:
             output = interface._execute(self.ui.will_begin_interface_output) if interface else None
-            if output:
-                self.ui.display_interface_output(interface, output)
-                self.bubble_maker(self.current_streaming_bubble.author, meta=meta or self.current_streaming_bubble.meta) << \
-                    "-- OUTPUT --\n" + output + "\n-- END OUTPUT --"
-                interface.cleanup()
-            else:
+            if interface: self._interface_changed()
+            return [(interface, output)] if output else []
+        interfaces = [interface] if interface and interface.current_code is not None else []
+        interfaces += self.queued_interfaces
+        (self.current_matching_interface, self.queued_interfaces) = (None, [])
+        # Confirmations are asked in order, up to the first one left pending, which stops the blocks after it
+        confirmations = []
+        for (i, interface) in enumerate(interfaces):
+            confirmation = interface._confirm()
+            if confirmation is None:
+                (self.current_matching_interface, self.queued_interfaces) = (interface, interfaces[i + 1:])
+                for interface in interfaces[i:]: interface._drop_speculation()
                 break
-        self.current_streaming_bubble = None
+            confirmations.append(confirmation)
+        if interfaces: self._interface_changed()
+        # Consecutive blocks of pure interfaces run at once, and any other block runs on its own
+        batches = []
+        for (interface, confirmation) in zip(interfaces, confirmations):
+            if batches and interface.pure and batches[-1][0][0].pure:
+                batches[-1].append((interface, confirmation))
+            else:
+                batches.append([(interface, confirmation)])
+        outputs = []
+        for (i, batch) in enumerate(batches):
+            # Blocks that ran speculatively run again after blocks with side effects (e.g. a FILE_SHOW after a FILE_WRITE)
+            if i > 0 and not batches[i - 1][0][0].pure:
+                for (interface, _) in batch: interface._drop_speculation()
+            if len(batch) == 1:
+                outputs.append(batch[0][0]._run(self.ui.will_begin_interface_output, batch[0][1]))
+                continue
+            with ThreadPoolExecutor(max_workers=min(len(batch), self.max_parallel_interfaces)) as executor:
+                outputs += list(executor.map(lambda pair: pair[0]._run(self.ui.will_begin_interface_output, pair[1]), batch))
+        return list(zip(interfaces, outputs))
+
+    def _append_interface_outputs(self, outputs):
+        # Appends the outputs, and returns True if the stream must stop (no block ran, or one awaits confirmation)
+        for (interface, output) in outputs: self._append_interface_output(interface, output)
+        return not outputs or self.current_matching_interface is not None
+
+    def _append_interface_output(self, interface, output):
+        self.ui.display_interface_output(interface, output)
+        interface.meta['output_hash'] = OutputIndex.hash(output)
+        bubble = self.bubble_maker(self.current_streaming_bubble.author, meta=interface.meta or self.current_streaming_bubble.meta) << \
+            "-- OUTPUT --\n" + output + "\n-- END OUTPUT --"
+        self.outputs.add(self, bubble, output, interface.output_key())
+        interface.cleanup()
 
     def append_user_input(self, user_input):
         if user_input is True and self.current_matching_interface:
@@ -68,18 +257,209 @@ class Convo(BaseConvo):
         super().append_user_input(user_input)
 
 
+class AsyncConvo(Convo):
+    """
+    A Convo driven by an AsyncModel. Interfaces are executed in the default executor of the
+    event loop, so that many conversations can be multiplexed in one process.
+    """
+    async def _stream_bubble(self, *handlers, resume=False):
+        bubble_box = [self._writable_bubble(-1) if resume and self.bubbles else None]
+        store_handler = self.store.stream_handler if self.store is not None else None
+        async for (_, chunk, _) in self.model.stream_answer(self.messages, *handlers, partial(self._stream_to_bubble_handler, bubble_box), store_handler):
+            yield (bubble_box[0], chunk)
+
+    async def stream_answer(self, *handlers):
+        self.current_streaming_bubble = None
+        while True:
+            if not self.interfaces_pending():
+                if not self.current_matching_interface: self.interface_matcher.reset()
+                async for (bubble, chunk) in self._stream_bubble(self.interface_matcher, *handlers, resume=bool(self.current_matching_interface)):
+                    self.current_streaming_bubble = bubble
+                    yield (bubble, chunk)
+            else:
+                self.current_streaming_bubble = self.bubbles[-1]
+            if not self.execute_interfaces: break
+            outputs = []
+            if self.current_matching_interface or self.queued_interfaces:
+                outputs = await asyncio.get_running_loop().run_in_executor(None, self._execute_interfaces)
+            if self._append_interface_outputs(outputs): break
+        self.current_streaming_bubble = None
+
+    async def stream_answer_to_end(self, *handlers):
+        bubble = None
+        async for (b, _) in self.stream_answer(*handlers): bubble = b
+        return bubble
+
+    async def append_user_input(self, user_input):
+        if user_input is True and self.current_matching_interface:
+            self.current_matching_interface.approved = True
+            user_input = None
+        if user_input:
+            self.user << user_input
+            self.ui.display_assistant_header()
+        await self.stream_answer_to_end(self.ui.append_to_assistant_output)
+        if self.ready_for_user_input():
+            self.ui.display_user_header()
+
+    async def loop(self):
+        self.ui.display_user_header()
+        while self.ui.supports_synchronous_user_input():
+            user_input = await asyncio.get_running_loop().run_in_executor(None, self.ui.get_user_input)
+            await self.append_user_input(user_input)
+
+
+class InterfaceMatcher:
+    # A single stream handler that detects the blocks of all the interfaces of a convo.
+    # The start and end patterns of every interface are compiled once into an Aho-Corasick
+    # automaton, whose state is carried across chunks, so the cost of each chunk depends
+    # neither on the number of interfaces nor on the length of the bubble being streamed.
+    def __init__(self, convo, interfaces):
+        self.convo = convo
+        self.interfaces = list(interfaces)
+        self.prototypes = [interface(convo) for interface in self.interfaces]
+        self._patterns = []  # Triplets (pattern, interface index, whether it is a start pattern)
+        for (index, prototype) in enumerate(self.prototypes):
+            self._patterns.append((prototype.pattern_start, index, True))
+            self._patterns.append((prototype.pattern_end, index, False))
+        self._build_automaton()
+        first_chars = set(pattern[0] for (pattern, _, _) in self._patterns)
+        self._first_char = first_chars.pop() if len(first_chars) == 1 else None
+        self._tail_size = max([len(pattern) for (pattern, _, _) in self._patterns], default=0) + len(os.linesep)
+        self.reset()
+
+    def fork(self, convo):
+        # Returns a matcher for a fork of the convo, sharing the automaton of this one
+        matcher = copy.copy(self)
+        matcher.convo = convo
+        matcher.prototypes = [interface(convo) for interface in self.interfaces]
+        matcher.reset()
+        return matcher
+
+    def _build_automaton(self):
+        self._goto = [{}]
+        self._fail = [0]
+        self._outputs = [[]]
+        for (pattern_id, (pattern, _, _)) in enumerate(self._patterns):
+            assert len(pattern) >= 1, "Interface substrings (pattern starts and ends) must not be empty!"
+            state = 0
+            for char in pattern:
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._outputs.append([])
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            self._outputs[state].append(pattern_id)
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for (char, next_state) in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]: fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._outputs[next_state] = self._outputs[next_state] + self._outputs[self._fail[next_state]]
+
+    def _step(self, state, char):
+        while state and char not in self._goto[state]: state = self._fail[state]
+        return self._goto[state].get(char, 0)
+
+    def reset(self):
+        # Must be called before streaming a new bubble
+        self._state = 0
+        self._length = 0
+        self._tail = ""
+        self._matching = None
+        self._matching_index = None
+        self._code_chunks = []
+        self._code_start = 0
+
+    def resume(self, text):
+        # Goes on matching a block from its text (starting with its start pattern), which must not be complete
+        self.reset()
+        self._feed(text)
+
+    def _text_before(self, chunk, end, size):
+        # Returns (at most) `size` characters of the streamed text before position `end` of chunk
+        if end >= size: return chunk[end - size:end]
+        if end < 0: return self._tail[:len(self._tail) + end][-size:]
+        return (self._tail + chunk[:end])[-size:]
+
+    def _match(self, pattern_id, chunk, end):
+        # Returns True if the match of the given pattern, ending at position `end` of chunk, is accepted
+        (pattern, index, is_start) = self._patterns[pattern_id]
+        if is_start:
+            if self._matching is not None: return False
+            start = end - len(pattern)
+            if self._length + start > 0 and self._text_before(chunk, start, len(os.linesep)) != os.linesep: return False
+            self._matching = self.interfaces[index](self.convo)
+            self._matching_index = index
+            self._code_chunks = []
+            self._code_start = end
+            self.convo.current_matching_interface = self._matching
+            self.convo._interface_changed()
+            return True
+        if self._matching is None or index != self._matching_index: return False
+        self._code_chunks.append(chunk[self._code_start:end])
+        self._matching.current_code = "".join(self._code_chunks)[:-len(pattern)]
+        self.convo._interface_changed()
+        return True
+
+    def _feed(self, chunk):
+        i = 0
+        while i < len(chunk):
+            if self._state == 0 and self._first_char is not None:
+                i = chunk.find(self._first_char, i)
+                if i == -1: break
+            self._state = self._step(self._state, chunk[i])
+            i += 1
+            for pattern_id in self._outputs[self._state]:
+                if not self._match(pattern_id, chunk, i): continue
+                if self._patterns[pattern_id][2]: break
+                interface = self._matching
+                self._matching = None
+                if interface.pure and self.convo.speculative_interfaces and self.convo.execute_interfaces and interface._may_speculate(): interface._speculate()
+                if interface.interrupt_stream_for_execution and self.convo.parallel_interfaces:
+                    # The block runs once the stream ends, along with the others
+                    self.convo.queued_interfaces.append(interface)
+                    self.convo.current_matching_interface = None
+                    self.convo._interface_changed()
+                    break
+                if interface.interrupt_stream_for_execution:
+                    return R(chunk=chunk[:i].rstrip(os.linesep), should_yield=True, should_continue=False)
+                _ = interface._execute(lambda _: None)
+                self.convo._interface_changed()
+                break
+        if self._matching is not None:
+            self._code_chunks.append(chunk[self._code_start:])
+            self._code_start = 0
+        self._length += len(chunk)
+        self._tail = (self._tail + chunk[-self._tail_size:])[-self._tail_size:]
+        return None
+
+    def __call__(self, author, chunk, ending):
+        if not self._patterns: return None
+        if not ending and not chunk: return None
+        if ending: chunk = os.linesep
+        return self._feed(chunk)
+
+
+_speculative_run = threading.local()  # The held_output list of the block running speculatively in this thread, if any
+
 class Interface:
     safety_checks = True
     interrupt_stream_for_execution = True
+    pure = False  # Whether running a block has no side effects (e.g. reading a file), so it may run along with others
     empty_output = "<empty output>"
 
     def __init__(self, convo):
         self.convo = convo
-        self.pattern_start_pos = -1
-        self.pattern_end_pos = -1
         self.current_code = None
         self.meta = {'interface': self.name}
         self.approved = False
+        self._speculation = None  # The Future of the output of the block, if it started running speculatively
+        self._held_output = None  # What the block prints while running speculatively, shown once it is run
+        for (key, value) in getattr(convo, 'interface_options', {}).get(self.name, {}).items(): setattr(self, key, value)
 
     @property
     def pattern_start(self):
@@ -92,68 +472,76 @@ class Interface:
     def execute(self, code):
         raise NotImplementedError()
 
+    def explanation_notes(self):
+        # Returns the text following the explanation in the system prompt that depends on the options of the
+        # interface or on the environment (e.g. whether shell commands share a session), if any
+        return ""
+
+    def _confirm(self):
+        # Returns True if the code may run, False if the user prevented it, or None if the confirmation is pending
+        if (self.approved or not self.safety_checks or not self.convo.safety_checks) and self.convo.ui.no_safety_confirmation(): return True
+        confirmation = self.convo.ui.safety_confirmation(self.name, self.convo.next_interface_title)
+        self.convo.next_interface_title = None
+        return confirmation if isinstance(confirmation, bool) else None
+
+    def _may_speculate(self):
+        # Blocks that need a confirmation don't run before it arrives, even if they only read data (the UI is
+        # not asked anything while streaming, its no_safety_confirmation hook being called when the block runs)
+        return self.approved or not self.safety_checks or not self.convo.safety_checks
+
+    def _speculate(self):
+        # Starts running the block in the background while the stream goes on, so that its output may be ready
+        # by the time it is run. What it prints is held back until then, and dropped along with its output if
+        # the block runs again or not at all (see _drop_speculation).
+        self._held_output = []
+        self._speculation = self.convo._speculation_executor().submit(self._execute_speculatively, self._held_output)
+
+    def _execute_speculatively(self, held_output):
+        _speculative_run.held_output = held_output
+        try:
+            return self.execute(self.current_code)
+        finally:
+            _speculative_run.held_output = None
+
+    def _drop_speculation(self):
+        if self._speculation is not None: self._speculation.cancel()
+        (self._speculation, self._held_output) = (None, None)
+
+    def _run(self, will_begin, confirmation=True):
+        if confirmation is False:
+            self._drop_speculation()
+            return f"The user prevented this {self.name} code from running. This was a manual action and not an error of the code itself. The user may have an explanation for their decision."
+        will_begin(self)
+        (speculation, held_output) = (self._speculation, self._held_output)
+        (self._speculation, self._held_output) = (None, None)
+        if speculation is None: return self.execute(self.current_code) or self.empty_output
+        output = speculation.result()
+        for (stream_name, text) in held_output: self.convo.ui.append_to_interface_output(self, stream_name, text)
+        return output or self.empty_output
+
     def _execute(self, will_begin):
         self.convo.current_matching_interface = None
         if self.current_code is None: return None
-        if (self.approved or not self.safety_checks or not self.convo.safety_checks) and self.convo.ui.no_safety_confirmation():
-            will_begin(self)
-            output = self.execute(self.current_code) or self.empty_output
-        else:
-            confirmation = self.convo.ui.safety_confirmation(self.name, self.convo.next_interface_title)
-            self.convo.next_interface_title = None
-            if confirmation is True:
-                will_begin(self)
-                output = self.execute(self.current_code) or self.empty_output
-            elif confirmation is False:
-                output = f"The user prevented this {self.name} code from running. This was a manual action and not an error of the code itself. The user may have an explanation for their decision."
-            else:
-                self.convo.current_matching_interface = self
-                output = None
-        return output
-    
-    def _find_substring(self, substring, text, chunk, needs_newline):
-        # Finds substring in text + chunk, if it intersects with chunk
-        assert len(substring) >= 1, "Interface substrings (pattern starts and ends) must not be empty!"
-        extended_chunk = (text[-len(substring) + 1:] if len(substring) > 1 else "") + chunk
-        pos = extended_chunk.find(substring)
-        if pos == -1: return -1
-        full_text = text + chunk
-        pos += len(full_text) - len(extended_chunk)
-        text_until_substring = full_text[:pos]
-        if needs_newline and text_until_substring and not text_until_substring.endswith(os.linesep): return -1
-        return pos
-    
-    def _find_pattern_start(self, text, chunk):
-        return self._find_substring(self.pattern_start, text, chunk, needs_newline=True)
-    
-    def _find_pattern_end(self, text, chunk):
-        return self._find_substring(self.pattern_end, text, chunk, needs_newline=False)
-    
-    def __call__(self, author, chunk, ending):
-        if self.convo.current_matching_interface and self.convo.current_matching_interface is not self: return None
-        if not ending and not chunk: return None
-        if ending: chunk = os.linesep
-        text = self.convo.current_streaming_bubble.text if self.convo.current_streaming_bubble else ""
-        if self.pattern_start_pos == -1:
-            self.pattern_start_pos = self._find_pattern_start(text, chunk)
-            if self.pattern_start_pos == -1: return None
-        self.convo.current_matching_interface = self
-        if self.pattern_end_pos == -1:
-            self.pattern_end_pos = self._find_pattern_end(text, chunk)
-            if self.pattern_end_pos < self.pattern_start_pos + len(self.pattern_start):
-                self.pattern_end_pos = -1
-                return None
-        assert self.pattern_start_pos < self.pattern_end_pos, "Prompt start position must be before prompt end position!"
-        full_text = text + chunk
-        self.current_code = full_text[self.pattern_start_pos + len(self.pattern_start):self.pattern_end_pos]
-        new_text = full_text[:self.pattern_end_pos + len(self.pattern_end)]
-        new_chunk = new_text[len(text):].rstrip(os.linesep)
-        if self.interrupt_stream_for_execution:
-            return R(chunk=new_chunk, should_yield=True, should_continue=False)
-        else:
-            _ = self._execute(lambda _: None)
+        confirmation = self._confirm()
+        if confirmation is None:
+            # The data may change until the confirmation arrives, so the block will run again then
+            self._drop_speculation()
+            self.convo.current_matching_interface = self
             return None
+        return self._run(will_begin, confirmation)
     
+    def output_key(self):
+        # Outputs with the same key supersede each other, so only the latest one is kept (see saola.outputs)
+        return None
+
+    def _print_output(self, stream_name, text):
+        # Shows what the code prints as it runs, before its whole output is displayed (unless it runs speculatively)
+        held_output = getattr(_speculative_run, "held_output", None)
+        if held_output is not None:
+            held_output.append((stream_name, text))
+            return
+        self.convo.ui.append_to_interface_output(self, stream_name, text)
+
     def cleanup(self):
         pass
 
@@ -179,57 +567,50 @@ class TitleInterface(Interface):
 
 class ShellInterface(Interface):
     name = "SHELL"
-    explanation = f"""
-    This interface allows you to run commands on the user's shell console. For example you may execute the command "date" to retrieve the current time, or ping a website to check for internet connectivity. The output of your command will show up in the chat and you may proceed to answer questions and requests based on those outputs. Tip: When you execute a command, the user may see the output, so you can make reference to it, but there is no need to repeat it in your answer. For example, if you execute a cat statement, there is no need to repeat the contents of the file in your answer after that.
-    An important thing to know is that each shell command is independent, so instead of running for example "cd some_path" followed by "ls", you will probably need to do "ls some_path" or "cd some_path && ls" instead.
-    In case this is useful, here is some information about the user's system: {os.uname()}. Also the user's username is {os.getlogin()}.
-    """
-
-    def execute(self, code):
-        output_capture = StringIO()
-
-        # Start the command with pexpect
-        child = pexpect.spawn('/bin/bash', ['-c', code.strip()], encoding='utf-8', timeout=None)
-
-        # Use a try-except block to catch pexpect exceptions, if any
-        try:
-            while True:
-                # This tries to read a line, streaming to sys.stdout and capturing in StringIO
-                line = child.readline()
-                if not line:  # If no more lines are read, break out of the loop
-                    break
-                print(line)  # Stream to stdout
-                output_capture.write(line)  # Capture the output
-        except pexpect.EOF:
-            pass  # Handle the end of file (EOF) condition if necessary
-        except pexpect.TIMEOUT:
-            pass  # Handle a timeout if necessary
+    timeout = 300  # Seconds
+    idle_timeout = 120  # Seconds without any output
+    max_output_size = 20000  # Characters kept of each of stdout and stderr
+    persistent_session = False  # Whether to run all the commands of a convo in one shell session
+    session_pool = None  # The ShellSessionPool that sessions are taken from (a shared one by default)
+    _shared_session_pool = None
 
-        # After the process ends, capture any remaining output
-        if child.before:
-            print(child.before)
-            output_capture.write(child.before)
+    @_lazy_class_attribute
+    def _system_info(cls):
+        return f"{os.uname()}. Also the user's username is {_get_username()}"
 
-        # Assuming the command errors are directed to stdout
-        # If stderr needs to be separately captured, that would require a different approach
-
-        # Return the captured output and errors
-        return output_capture.getvalue()
+    explanation = """
+    This interface allows you to run commands on the user's shell console. For example you may execute the command "date" to retrieve the current time, or ping a website to check for internet connectivity. The output of your command will show up in the chat and you may proceed to answer questions and requests based on those outputs. Tip: When you execute a command, the user may see the output, so you can make reference to it, but there is no need to repeat it in your answer. For example, if you execute a cat statement, there is no need to repeat the contents of the file in your answer after that.
+    Commands cannot read any input, commands that run for too long are stopped, and very long outputs are truncated, so prefer commands that finish on their own and limit their output (e.g. with head, tail or grep).
+    """
 
+    def explanation_notes(self):
+        if self.persistent_session:
+            session = "All your shell commands run in the same shell session, so the working directory and environment variables persist between commands (e.g. you may run \"cd some_path\" and then \"ls\")."
+        else:
+            session = "An important thing to know is that each shell command is independent, so instead of running for example \"cd some_path\" followed by \"ls\", you will probably need to do \"ls some_path\" or \"cd some_path && ls\" instead."
+        return f"""
+    {session}
+    In case this is useful, here is some information about the user's system: {self._system_info}.
+    """
 
+    def _session(self):
+        from saola.shell import ShellSessionPool
+        if "SHELL" not in self.convo.interface_state:
+            if self.session_pool is None and ShellInterface._shared_session_pool is None: ShellInterface._shared_session_pool = ShellSessionPool()
+            self.convo.interface_state["SHELL"] = (self.session_pool or ShellInterface._shared_session_pool).acquire()
+        return self.convo.interface_state["SHELL"]
 
-        # old_stdout = sys.stdout
-        # old_stderr = sys.stderr
-        # sys.stdout = new_stdout = StringAndPrintIO(old_stdout)
-        # sys.stderr = new_stderr = StringAndPrintIO(old_stderr)
-        # try:
-        #     subprocess.run(code.strip(), check=True, stdout=new_stdout, stderr=new_stderr)
-        #     return new_stdout.getvalue().rstrip() + new_stderr.getvalue().rstrip()
-        # except Exception as e:
-        #     return f"ERROR: {e}"
-        # finally:
-        #     sys.stdout = old_stdout
-        #     sys.stderr = old_stderr
+    def execute(self, code):
+        from saola.shell import run_command
+        run = self._session().run if self.persistent_session else run_command
+        result = run(
+            code.strip(),
+            timeout=self.timeout,
+            idle_timeout=self.idle_timeout,
+            max_output_size=self.max_output_size,
+            on_output=self._print_output
+        )
+        return result.format()
 
 
 class StringAndPrintIO:
@@ -255,26 +636,59 @@ class StringAndPrintIO:
         return self.stdout.fileno()
 
 class PythonInterface(Interface):
-    _globals = None
-    _locals = None
-
     name = "PYTHON"
-    explanation = """
-    This interface allows you to run Python code. The input of your command is the Python code to be executed. All Python code in this conversation is executed at the same scope, so all global variables are shared. The output of your command is the result of the Python code. You may use this interface to perform calculations, manipulate data, or run any Python code that you need. The stdout (e.g. outputs of print calls) and stderr of your code will show up in the chat and you may proceed to answer questions and requests based on those outputs. An empty output usually means the code ran successfully. If you need the result of a calculation or of an algorithm to answer a user query, you will need to print it, or display, or show it, explicitly, for example print(x), instead of just typing x at the end of the code. Things like charts and plots are supported by this interface, and they are visible to the user even if they are not visible to you. You can do multiple things and display multiple charts in one same Python code, if necessary.
-    """ + """
+    use_worker = False  # Whether to run the code of a convo in its own Python subprocess instead of this process
+    worker_pool = None  # The PythonWorkerPool that workers are taken from (a shared one by default)
+    timeout = 300  # Seconds (in a worker only)
+    memory_limit = None  # Bytes of address space the code may use (in a worker only)
+    max_output_size = 20000  # Characters kept of each of stdout and stderr (in a worker only)
+    _shared_worker_pool = None
+
+    @_lazy_class_attribute
+    def _notebook_explanation(cls):
+        return """
     This conversation is happening within a Jupyter Notebook. If you ever need to display an object to the user, please make sure to explicitly call the display function of the IPython.display module, for example display(x), or the built-in Python print(x), instead of just typing x at the end of the code.
     """ if _is_notebook() else ""
+
+    explanation = """
+    This interface allows you to run Python code. The input of your command is the Python code to be executed. All Python code in this conversation is executed at the same scope, so all global variables are shared. The output of your command is the result of the Python code. You may use this interface to perform calculations, manipulate data, or run any Python code that you need. The stdout (e.g. outputs of print calls) and stderr of your code will show up in the chat and you may proceed to answer questions and requests based on those outputs. An empty output usually means the code ran successfully. If you need the result of a calculation or of an algorithm to answer a user query, you will need to print it, or display, or show it, explicitly, for example print(x), instead of just typing x at the end of the code. Things like charts and plots are supported by this interface, and they are visible to the user even if they are not visible to you. You can do multiple things and display multiple charts in one same Python code, if necessary.
+    """
+
+    def explanation_notes(self):
+        return ("""
+    Code that runs for too long is stopped, and very long outputs are truncated.
+    """ if self.use_worker else "") + self._notebook_explanation
+
     empty_output = "Empty output. This normally means the code ran successfully."
 
+    def _namespace(self):
+        # Returns the PythonWorker or PythonNamespace of this convo
+        from saola.python_worker import PythonNamespace, PythonWorkerPool
+        if "PYTHON" not in self.convo.interface_state:
+            if not self.use_worker:
+                self.convo.interface_state["PYTHON"] = PythonNamespace()
+            else:
+                if self.worker_pool is None and PythonInterface._shared_worker_pool is None: PythonInterface._shared_worker_pool = PythonWorkerPool()
+                self.convo.interface_state["PYTHON"] = (self.worker_pool or PythonInterface._shared_worker_pool).acquire()
+        return self.convo.interface_state["PYTHON"]
+
     def execute(self, code):
-        if PythonInterface._globals is None: PythonInterface._globals = {}
-        if PythonInterface._locals is None: PythonInterface._locals = {}
+        if self.use_worker:
+            result = self._namespace().run(
+                code.strip(),
+                timeout=self.timeout,
+                memory_limit=self.memory_limit,
+                max_output_size=self.max_output_size,
+                on_output=self._print_output
+            )
+            return result.format()
+        namespace = self._namespace()
         old_stdout = sys.stdout
         old_stderr = sys.stderr
         sys.stdout = new_stdout = StringAndPrintIO(old_stdout)
         sys.stderr = new_stderr = StringAndPrintIO(old_stderr)
         try:
-            exec(code.strip(), PythonInterface._globals, PythonInterface._locals)
+            exec(code.strip(), namespace.globals)
             new_stdout.flush()
             new_stderr.flush()
             return new_stdout.getvalue().rstrip() + new_stderr.getvalue().rstrip()
@@ -284,47 +698,52 @@ class PythonInterface(Interface):
             sys.stdout = old_stdout
             sys.stderr = old_stderr
     
-class FileShowInterface(Interface):
+class _FileOutput:
+    # For interfaces whose outputs show the contents of a file (FILE_SHOW and FILE_WRITE), at meta['file_path']
+    def output_key(self):
+        # The latest output showing a file supersedes the others
+        return ("FILE", self.meta['file_path']) if 'file_path' in self.meta else None
+
+class FileShowInterface(_FileOutput, Interface):
     name = "FILE_SHOW"
+    pure = True
     explanation = """
-    This interface allows you to show the contents of a file in the user's filesystem. The input of your command is the path to the file to be shown. The file will be shown with line numbers. Please avoid repeating the contents of the file in your message after using this interface, as the user will already see the contents of the file in the chat.
+    This interface allows you to show the contents of a file in the user's filesystem. The input of your command is the path to the file to be shown, optionally followed on the next line by the range of lines to be shown, e.g. 50-100. The file will be shown with line numbers. Please avoid repeating the contents of the file in your message after using this interface, as the user will already see the contents of the file in the chat.
 
-    As mentioned above, the output of the FILE_SHOW command is the selected file with its line numbers.
+    As mentioned above, the output of the FILE_SHOW command is the selected file (or range of lines) with its line numbers. Only the first lines of long files are shown, so use line ranges to see the rest.
 
     It is advisable to run a FILE_SHOW before running any FILE_WRITE command (see the FILE_WRITE interface below).
     """
+    max_lines = 2000  # Lines shown when no line range is given
 
     def execute(self, code):
+        from saola.files import line_index, numbered_lines, parse_line_range
         try:
-            file_path = code.strip()
-            file_path = os.path.abspath(os.path.expanduser(file_path))
-            with open(file_path, "r") as f: contents = f.read()
+            args = code.strip().split(os.linesep)
+            file_path = os.path.abspath(os.path.expanduser(args[0].strip()))
+            index = line_index(file_path)
+            line_range = args[1].strip() if len(args) > 1 else ""
+            (start, end) = parse_line_range(line_range) if line_range else (1, self.max_lines)
+            assert start <= end, f"Invalid line range: {line_range} (the range can't end before it starts)."
+            # One more line is read to tell whether the file continues after the range
+            lines = index.lines(start, end + 1)
+            assert lines, f"The file has only {index.num_lines} lines."
+            more_lines = len(lines) > end - start + 1
+            if more_lines: lines.pop()
             self.meta['file_path'] = file_path
-            result = f"File {file_path} (shown below with line numbers):"
-            content_lines = contents.split(os.linesep)
-            max_line_number_size = len(str(len(content_lines)))
-            for (i, line) in enumerate(contents.split(os.linesep)):
-                line_number = " " * (max_line_number_size - len(str(i + 1))) + str(i + 1)
-                result += os.linesep + f"{line_number}  {line}"
+            if start == 1 and not more_lines:
+                result = f"File {file_path} (shown below with line numbers):"
+            else:
+                result = f"File {file_path}, lines {start}-{start + len(lines) - 1} (shown below with line numbers):"
+            result += os.linesep + numbered_lines(lines, start)
+            if more_lines and not line_range: result += os.linesep + f"[The file continues after line {end}, show more with a line range, e.g. {end + 1}-{2 * end}]"
             return result
         except Exception as e:
             return f"ERROR: {e}"
-        
-    def cleanup(self):
-        file_paths = set()
-        for bubble in reversed(self.convo.bubbles):
-            if not bubble.meta or bubble.meta.get('interface') not in ["FILE_SHOW", "FILE_WRITE"]: continue
-            if bubble.meta.get('cleaned_up'): break
-            file_path = bubble.meta.get('file_path')
-            if not file_path: continue
-            if file_path in file_paths:
-                bubble.doc.text = "[OUTPUT HIDDEN]"
-                bubble.meta['cleaned_up'] = True
-            else:
-                file_paths.add(file_path)
 
 class SearchInterface(Interface):
     name = "SEARCH"
+    pure = True
     explanation = """
     This interface allows you to search the web for information. The input of your command is the search query. The output of your command is the search results, which may be a single string answering your query or a list of truncated results.
     """
@@ -334,19 +753,18 @@ class SearchInterface(Interface):
             from langchain_community.utilities import SerpAPIWrapper
             search = SerpAPIWrapper()
             result = search.run(code.strip())
-            print(result + "\n")
-            sys.stdout.flush()
+            self._print_output("stdout", result + "\n")
             return result
         except Exception as e:
                 return f"ERROR: {e}"
 
 
-class FileWriteInterface(Interface):
+class FileWriteInterface(_FileOutput, Interface):
     name = "FILE_WRITE"
     explanation = """
     This interface allows you to write a new file or replace the contents of a file in the user's filesystem. The first line of your command is the path to the file to be created or replaced. The second line is the range of file lines to be replaced, e.g. 10-20, or the word ALL. The new contents of the file or of the replaced lines should start on the next line. This will cause the file to be written to the filesystem of the user.
 
-    The output of the FILE_WRITE command is the full selected file with its line numbers. Always refer to the latest output of the FILE_SHOW command or of the FILE_WRITE command to see the current contents of the file. This allows you to make iterative changes to a file by specifying the correct line numbers every time.
+    The output of the FILE_WRITE command is the full selected file with its line numbers (for long files, a diff of the change followed by the lines around it). Always refer to the latest output of the FILE_SHOW command or of the FILE_WRITE command to see the current contents of the file. This allows you to make iterative changes to a file by specifying the correct line numbers every time.
 
     For example, the command below creates a file with letters A-Z, one in each line, some of them skipped:
 
@@ -426,52 +844,46 @@ class FileWriteInterface(Interface):
     14  (skipped some letters)
     [END OF OUTPUT]
     """
+    output = "window"  # "file" to always show the whole file written
+    max_lines = 2000  # Longer files are shown around the replaced lines (with a diff of the change), in "window" output
+    context_lines = 20  # Lines shown before and after the replaced lines
+
     def execute(self, code):
+        from saola.files import line_index, numbered_lines, parse_line_range, replace_lines, write_atomically, common_lines, unified_diff
         try:
             args = code.lstrip().split(os.linesep, 2)
             assert len(args) == 3, "Remember the first line of the FILE_WRITE arguments must be the file path, the second line is the line range (or the word ALL), and on the third line starts the new content of the file."
-            # if len(args) == 1: args = args + ["ALL", ""]
-            # elif len(args) == 2: args = args + [""]
             file_path, line_range, contents = args
             file_path = file_path.strip()
             file_path = os.path.abspath(os.path.expanduser(file_path))
             base_folder = os.path.dirname(file_path)
             if base_folder and not os.path.exists(base_folder): os.makedirs(base_folder)
-            current_contents = None
-            if os.path.exists(file_path):
-                with open(file_path, "r") as f: current_contents = f.read()
+            # Writes go to the target of symbolic links, rather than replacing the links
+            target_path = os.path.realpath(file_path)
             if line_range != "ALL":
-                range = line_range.split("-")
-                start_line, end_line = [int(i) for i in range] if len(range) == 2 else [int(line_range), int(line_range)]
-                lines = current_contents.split(os.linesep) if current_contents else []
-                lines = lines[:start_line - 1] + contents.strip(os.linesep).split(os.linesep) + lines[end_line:]
-                contents = os.linesep.join(lines)
-            with open(file_path, "w") as f: f.write(contents)
+                (start, end) = parse_line_range(line_range)
+                new_lines = contents.strip(os.linesep).split(os.linesep)
+                (start, old_lines) = replace_lines(target_path, start, end, os.linesep.join(new_lines))
+            else:
+                old_lines = line_index(target_path).lines(1) if os.path.exists(target_path) else []
+                write_atomically(target_path, [contents.encode("utf-8")])
+                (start, new_lines) = (1, contents.split(os.linesep))
             self.meta['file_path'] = file_path
-            result = f"File written to {file_path} (shown below with line numbers):"
-            content_lines = contents.split(os.linesep)
-            max_line_number_size = len(str(len(content_lines)))
-            for (i, line) in enumerate(contents.split(os.linesep)):
-                line_number = " " * (max_line_number_size - len(str(i + 1))) + str(i + 1)
-                result += os.linesep + f"{line_number}  {line}"
-            return result
+            index = line_index(target_path)
+            lines = index.lines(1, None if self.output == "file" else self.max_lines + 1)
+            if len(lines) <= self.max_lines or self.output == "file":
+                return f"File written to {file_path} (shown below with line numbers):" + os.linesep + numbered_lines(lines)
+            # Only the lines that changed are diffed and shown
+            (num_start, num_end) = common_lines(old_lines, new_lines)
+            (start, old_lines, new_lines) = (start + num_start, old_lines[num_start:len(old_lines) - num_end], new_lines[num_start:len(new_lines) - num_end])
+            window_start = max(1, start - self.context_lines)
+            lines = index.lines(window_start, start + len(new_lines) - 1 + self.context_lines)
+            diff = unified_diff(file_path, old_lines, new_lines, start) or "(no changes)"
+            return os.linesep.join([
+                f"File written to {file_path} with the changes below:",
+                diff,
+                f"Lines {window_start}-{window_start + len(lines) - 1} of {index.num_lines} of the file (shown below with line numbers):",
+                numbered_lines(lines, window_start)
+            ])
         except Exception as e:
             return f"ERROR: {e}"
-        
-    def cleanup(self):
-        file_paths = set()
-        for bubble in reversed(self.convo.bubbles):
-            if not bubble.meta or bubble.meta.get('interface') not in ["FILE_SHOW", "FILE_WRITE"]: continue
-            if bubble.meta.get('cleaned_up'): break
-            file_path = bubble.meta.get('file_path')
-            if not file_path: continue
-            if file_path in file_paths:
-                bubble.doc.text = "[OUTPUT HIDDEN]"
-                bubble.meta['cleaned_up'] = True
-            else:
-                file_paths.add(file_path)
-
-
-                
-
-
@@ -6,13 +6,102 @@ def _dedent_and_trim(text):
     return re.sub(r'^\s*\n', '', dedent(text).rstrip())
 
 class Doc:
-    def __init__(self):
-        self.text = ""
+    # The text of a doc is kept as a list of chunks, and only joined (and cached) when read,
+    # so that appending a chunk costs O(chunk) instead of O(doc).
+    #
+    # on_change is called with every edit: ("append", text), ("rstrip", None) or ("set", text).
+    # A doc may also be created with a loader, a function returning its text, which is only called
+    # when the text is first needed (see saola.store).
+    def __init__(self, on_change=None, loader=None):
+        self._chunks = []
+        self._length = 0
+        self._text = ""
+        self._loader = loader
+        self.on_change = on_change
+
+    def _load(self):
+        (loader, self._loader) = (self._loader, None)
+        text = loader()
+        self._chunks = [text] if text else []
+        self._length = len(text)
+        self._text = text
+
+    def _changed(self, kind, value=None):
+        self._text = None
+        if self.on_change: self.on_change(kind, value)
+
+    @property
+    def loaded(self):
+        return self._loader is None
+
+    @property
+    def text(self):
+        if self._loader is not None: self._load()
+        if self._text is None:
+            self._text = "".join(self._chunks)
+            self._chunks = [self._text] if self._text else []
+        return self._text
+
+    @text.setter
+    def text(self, text):
+        text = str(text)
+        self._loader = None
+        self._chunks = [text] if text else []
+        self._length = len(text)
+        self._changed("set", text)
+        self._text = text
+
+    def copy(self, on_change=None):
+        if self._loader is not None: return Doc(on_change=on_change, loader=self._loader)
+        doc = Doc(on_change=on_change)
+        doc._chunks = list(self._chunks)
+        doc._length = self._length
+        doc._text = self._text
+        return doc
+
+    def __len__(self):
+        if self._loader is not None: self._load()
+        return self._length
+
+    def tail(self, size):
+        # Returns the last `size` characters of the text, only looking at the last chunks
+        if self._loader is not None: self._load()
+        if size <= 0: return ""
+        if self._text is not None: return self._text[-size:]
+        parts = []
+        parts_size = 0
+        for chunk in reversed(self._chunks):
+            if parts_size >= size: break
+            parts.append(chunk)
+            parts_size += len(chunk)
+        return "".join(reversed(parts))[-size:]
 
     def append(self, text):
-        self.text += str(text)
+        text = str(text)
+        if not text: return self
+        if self._loader is not None: self._load()
+        self._chunks.append(text)
+        self._length += len(text)
+        self._changed("append", text)
         return self
 
+    def _rstrip(self):
+        # Strips trailing whitespace, dropping whitespace-only chunks at the tail
+        if self._loader is not None: self._load()
+        stripped = False
+        while self._chunks:
+            last_chunk = self._chunks[-1]
+            stripped_chunk = last_chunk.rstrip()
+            if stripped_chunk == last_chunk: break
+            self._length -= len(last_chunk) - len(stripped_chunk)
+            stripped = True
+            if stripped_chunk:
+                self._chunks[-1] = stripped_chunk
+                break
+            self._chunks.pop()
+        if stripped: self._changed("rstrip")
+
     def append_with_newline(self, text, num_newlines=1):
-        self.text = self.text.rstrip() + (os.linesep * num_newlines if self.text.strip() else "") + _dedent_and_trim(text)
-        return self
\ No newline at end of file
+        self._rstrip()
+        if self._chunks: self.append(os.linesep * num_newlines)
+        return self.append(_dedent_and_trim(text))
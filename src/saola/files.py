@@ -0,0 +1,159 @@
+import os
+import re
+import mmap
+import shutil
+import difflib
+import threading
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+# LINE INDEXES
+# ============
+# Files are shown by line ranges, read through a memory map, so that only the lines shown are read and
+# decoded. To find where a line starts, a file is scanned a block at a time, keeping the number of newlines
+# before each block, and only as far as the lines asked for. Line indexes are cached by path, and rebuilt
+# when the file changes (as told by its inode, modification time and size).
+
+BLOCK_SIZE = 1 << 16
+
+class LineIndex:
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size else b""
+        self.version = _version(stat)
+        self.size = stat.st_size
+        self._newlines = array("q", [0])  # Number of newlines before each block scanned so far
+        self._lock = threading.Lock()
+
+    def _scan(self, num_newlines):
+        # Scans blocks until num_newlines newlines are found, or the end of the file
+        newlines = self._newlines
+        while newlines[-1] < num_newlines and (len(newlines) - 1) * BLOCK_SIZE < self.size:
+            start = (len(newlines) - 1) * BLOCK_SIZE
+            newlines.append(newlines[-1] + self.data[start:start + BLOCK_SIZE].count(b"\n"))
+
+    @property
+    def num_lines(self):
+        # As with text.split("\n"), a file ending with a newline ends with an empty line
+        with self._lock:
+            self._scan(float("inf"))
+            return self._newlines[-1] + 1
+
+    def _line_start(self, line):
+        # Returns the offset where the line (starting from 0) starts, or None if the file has fewer lines
+        if line == 0: return 0
+        self._scan(line)
+        if self._newlines[-1] < line: return None
+        block = bisect_left(self._newlines, line) - 1
+        block_data = self.data[block * BLOCK_SIZE:(block + 1) * BLOCK_SIZE]
+        # The line starts after the remaining newlines of the block
+        rest = block_data.split(b"\n", line - self._newlines[block])[-1]
+        return (block + 1) * BLOCK_SIZE - len(rest) if len(block_data) == BLOCK_SIZE else self.size - len(rest)
+
+    def offsets(self, start, end=None):
+        # Returns the offsets where the lines from start to end (starting from 1, both included, or to the last
+        # line if end is None) start and end (before the newline), or (None, None) if the file has fewer lines
+        with self._lock:
+            start_offset = self._line_start(start - 1)
+            if start_offset is None: return (None, None)
+            end_offset = self._line_start(end) if end is not None else None
+            return (start_offset, self.size if end_offset is None else max(start_offset, end_offset - 1))
+
+    def lines(self, start, end=None):
+        (start_offset, end_offset) = self.offsets(start, end)
+        if start_offset is None: return []
+        return bytes(self.data[start_offset:end_offset]).decode("utf-8", errors="replace").split("\n")
+
+def _version(stat):
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+_line_indexes = OrderedDict()
+_line_indexes_lock = threading.Lock()
+MAX_LINE_INDEXES = 32
+
+def line_index(path):
+    # Returns the LineIndex of the file at path, reusing the cached one if the file didn't change
+    version = _version(os.stat(path))
+    with _line_indexes_lock:
+        index = _line_indexes.get(path)
+        if index is not None and index.version == version:
+            _line_indexes.move_to_end(path)
+            return index
+    index = LineIndex(path)
+    with _line_indexes_lock:
+        _line_indexes[path] = index
+        _line_indexes.move_to_end(path)
+        while len(_line_indexes) > MAX_LINE_INDEXES: _line_indexes.popitem(last=False)
+    return index
+
+def numbered_lines(lines, first_line_number=1, width=None):
+    # Returns the lines prefixed with their line numbers, right-aligned to the width of the largest one
+    width = width or len(str(first_line_number + len(lines) - 1))
+    return os.linesep.join(f"{str(i).rjust(width)}  {line}" for (i, line) in enumerate(lines, first_line_number))
+
+def parse_line_range(text):
+    # Parses a line range such as "10-20", or a single line such as "10", into a pair (start, end)
+    bounds = text.strip().split("-")
+    assert len(bounds) in (1, 2) and all(bound.strip().isdigit() for bound in bounds), f"Invalid line range: {text.strip()} (e.g. 10-20)."
+    (start, end) = (int(bounds[0]), int(bounds[-1]))
+    # A range ending right before it starts (e.g. 5-4) is empty, and lines may be inserted there
+    assert 1 <= start <= end + 1, f"Invalid line range: {text.strip()} (lines start from 1, and the range can't end before it starts)."
+    return (start, end)
+
+# WRITING FILES
+# =============
+# Files are written to a temporary file next to them, which then replaces them, so that they are never left
+# half written. When lines of a file are replaced, the rest of the file is copied as bytes from its memory
+# map, without decoding it or splitting it into lines.
+
+def write_atomically(path, parts):
+    # Writes the parts (bytes-like objects) to the file at path
+    temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temporary_path, "wb") as f:
+            for part in parts: f.write(part)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path): shutil.copymode(path, temporary_path)
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path): os.remove(temporary_path)
+        raise
+
+def replace_lines(path, start, end, text):
+    # Replaces the lines from start to end (starting from 1, both included) of the file at path with text,
+    # and returns the line where text starts along with the replaced lines. Lines past the end of the file
+    # are appended to it, so text then starts right after its last line.
+    index = line_index(path) if os.path.exists(path) else None
+    data = memoryview(index.data) if index is not None and index.size else b""
+    (start_offset, end_offset) = index.offsets(start, end) if data else (None, None)
+    if start_offset is None:
+        start = index.num_lines + 1 if data else 1
+        (prefix, replaced, suffix) = ([data, b"\n"] if data else [], [], [])
+    elif end < start:
+        # The lines are inserted before the line at start
+        (prefix, replaced, suffix) = ([data[:start_offset]], [], [b"\n", data[start_offset:]])
+    else:
+        prefix = [data[:start_offset]]
+        replaced = bytes(data[start_offset:end_offset]).decode("utf-8", errors="replace").split("\n")
+        # The suffix starts with the newline ending the replaced lines, if any line follows them
+        suffix = [data[end_offset:]] if end_offset < len(data) else []
+    write_atomically(path, prefix + [text.encode("utf-8")] + suffix)
+    return (start, replaced)
+
+def common_lines(old_lines, new_lines):
+    # Returns the number of lines at the start and at the end that are the same in both lists
+    size = min(len(old_lines), len(new_lines))
+    num_start = next((i for i in range(size) if old_lines[i] != new_lines[i]), size)
+    num_end = next((i for i in range(size - num_start) if old_lines[-1 - i] != new_lines[-1 - i]), size - num_start)
+    return (num_start, num_end)
+
+def unified_diff(path, old_lines, new_lines, first_line=1):
+    # Returns a unified diff of old_lines being replaced with new_lines at first_line (numbering the lines of the file)
+    def shift(match):
+        return f"@@ -{int(match[1]) + first_line - 1}{match[2] or ''} +{int(match[3]) + first_line - 1}{match[4] or ''} @@"
+    diff = difflib.unified_diff(old_lines, new_lines, path, path, lineterm="")
+    return os.linesep.join(re.sub(r"^@@ -(\d+)(,\d+)? \+(\d+)(,\d+)? @@", shift, line) for line in diff)
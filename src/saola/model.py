@@ -1,5 +1,10 @@
 import os
-from openai import OpenAI
+import time
+import random
+import asyncio
+import inspect
+import threading
+from queue import Queue, Empty
 from collections import namedtuple
 
 # STREAM HANDLERS
@@ -36,6 +41,23 @@ def _compose_stream_handlers(*handlers):
         return R(chunk=chunk, should_yield=should_yield, should_continue=should_continue)
     return handler
 
+# Async stream handlers may be either plain stream handlers or coroutine functions with the same signature
+def _compose_async_stream_handlers(*handlers):
+    async def handler(*, author, chunk, ending):
+        should_yield = True
+        should_continue = True
+        for h in handlers:
+            if not h: continue
+            if not should_yield: break
+            handler_result = h(author=author, chunk=chunk, ending=ending)
+            if inspect.isawaitable(handler_result): handler_result = await handler_result
+            handler_result = handler_result or R(chunk=True, should_yield=True, should_continue=True)
+            chunk = _convert_chunk(chunk, handler_result.chunk)
+            should_yield = should_yield and handler_result.should_yield
+            should_continue = should_continue and handler_result.should_continue
+        return R(chunk=chunk, should_yield=should_yield, should_continue=should_continue)
+    return handler
+
 class Model:
     def _stream_answer_nonstop(self, messages):
         raise NotImplementedError()
@@ -59,35 +81,314 @@ class Model:
     def get_answer(self, messages):
         return self._get_answer(messages)
 
-class OpenAIModel(Model):
-    def __init__(self, model_name, client=None, organization=None, api_key=None, base_url=None):
+class AsyncModel:
+    def _stream_answer_nonstop(self, messages):
+        # Must return an async iterator of (author, chunk) pairs
+        raise NotImplementedError()
+
+    async def _get_answer(self, messages):
+        raise NotImplementedError()
+
+    async def stream_answer(self, messages, *handlers):
+        handler = _compose_async_stream_handlers(*handlers)
+        broken = False
+        stream = self._stream_answer_nonstop(messages)
+        try:
+            async for (author, chunk) in stream:
+                handler_result = await handler(author=author, chunk=chunk, ending=False)
+                if handler_result.should_yield: yield (author, chunk, False)
+                if not handler_result.should_continue:
+                    broken = True
+                    break
+        finally:
+            if hasattr(stream, "aclose"): await stream.aclose()
+        if not broken:
+            handler_result = await handler(author=None, chunk=None, ending=True)
+            if handler_result.should_yield: yield (None, None, True)
+
+    async def get_answer(self, messages):
+        return await self._get_answer(messages)
+
+# RETRIES
+# =======
+# Requests to OpenAI models are retried when they fail with a transient error (rate limits, server errors,
+# dropped connections and timeouts), after a random delay of up to backoff * 2 ** attempt seconds (capped at
+# max_backoff seconds, or as told by a Retry-After header).
+#
+# A stream failing midway can't be requested again as it was, since another answer would be sampled, and
+# its start wouldn't match the part already yielded. Instead, the retried request ends with the partial answer
+# as an assistant message, so that the model continues it (see _continue_answer, also used by RoutedModel and
+# CachedModel). Endpoints that support prefilling the answer continue it exactly, while others may not pick
+# it up where it stopped (e.g. repeating its last words). With continue_streams=False, such a stream fails
+# instead.
+#
+# Streams may also be given deadlines: if no chunk arrives within first_token_timeout seconds, a duplicate
+# request is sent, and whichever of the two streams a chunk first is used (hedging), and if a stream then
+# stops sending chunks for chunk_timeout seconds, it is retried as above. With deadlines, the responses are
+# read in threads (or tasks, for AsyncOpenAIModel).
+#
+# Clients given to the models should be created with max_retries=0, as those the models create are, since
+# the retries of the client would add to those of the model, and their delays would defeat the deadlines.
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+_RETRYABLE_ERRORS = {"APIConnectionError", "APITimeoutError", "RateLimitError", "InternalServerError"}
+
+class StreamStalled(TimeoutError):
+    pass
+
+_DONE = object()
+
+def _is_retryable(error):
+    status_code = getattr(error, "status_code", None)
+    if status_code is not None: return status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, (ConnectionError, TimeoutError)) or any(cls.__name__ in _RETRYABLE_ERRORS for cls in type(error).__mro__)
+
+def _retry_after(error):
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+def _continue_answer(messages, answer):
+    # Returns the messages asking for the rest of answer, the part of the answer already streamed
+    return messages + [{"role": "assistant", "content": answer}] if answer else messages
+
+def _delta(chunk):
+    return (chunk.choices[0].delta.role or "assistant", chunk.choices[0].delta.content or None)
+
+class _Retrying:
+    # The retry options shared by OpenAIModel and AsyncOpenAIModel
+    def _init_retries(self, max_retries, backoff, max_backoff, first_token_timeout, chunk_timeout, continue_streams):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.first_token_timeout = first_token_timeout
+        self.chunk_timeout = chunk_timeout
+        self.continue_streams = continue_streams
+        self.retries = 0  # Requests retried so far
+        self.hedges = 0  # Duplicate requests sent so far, after first_token_timeout
+
+    def _should_retry(self, error, attempt, answer=None):
+        # answer is the part of the answer yielded before a stream failed
+        if answer and not self.continue_streams: return False
+        return attempt < self.max_retries and _is_retryable(error)
+
+    def _retry_delay(self, error, attempt):
+        self.retries += 1
+        retry_after = _retry_after(error)
+        if retry_after is not None: return min(retry_after, self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+class _StreamThread:
+    # Reads a stream in a thread, putting (self, item) in queue for every (author, chunk), then (self, _DONE),
+    # or (self, exception) if the stream fails
+    def __init__(self, stream, queue):
+        self.cancelled = False
+        threading.Thread(target=self._run, args=(stream, queue), daemon=True).start()
+
+    def _run(self, stream, queue):
+        try:
+            for item in stream:
+                if self.cancelled: break
+                queue.put((self, item))
+            else:
+                queue.put((self, _DONE))
+        except Exception as e:
+            queue.put((self, e))
+        finally:
+            stream.close()
+
+class OpenAIModel(_Retrying, Model):
+    def __init__(self, model_name, client=None, organization=None, api_key=None, base_url=None,
+                 max_retries=2, backoff=0.5, max_backoff=10.0, first_token_timeout=None, chunk_timeout=None, continue_streams=True):
         self.model_name = model_name
         organization = organization or os.getenv("OPENAI_ORGANIZATION")
         api_key = api_key or os.getenv("OPENAI_API_KEY")
         base_url = base_url or os.getenv("OPENAI_API_BASE")
-        self.client = client or OpenAI(organization=organization, api_key=api_key, base_url=base_url)
+        if client is None:
+            from openai import OpenAI
+            # Requests are retried by the model rather than the client
+            client = OpenAI(organization=organization, api_key=api_key, base_url=base_url, max_retries=0)
+        self.client = client
+        self._init_retries(max_retries, backoff, max_backoff, first_token_timeout, chunk_timeout, continue_streams)
 
-    def _stream_answer_nonstop(self, messages):
+    def _stream(self, messages):
         response = self.client.chat.completions.create(
             model=self.model_name,
             messages=messages,
             stream=True
         )
-        for chunk in response:
-            author = chunk.choices[0].delta.role or "assistant"
-            text_chunk = chunk.choices[0].delta.content or None
-            yield (author, text_chunk)
+        try:
+            for chunk in response: yield _delta(chunk)
+        finally:
+            if hasattr(response, "close"): response.close()
+
+    def _stream_with_deadlines(self, messages):
+        queue = Queue()
+        streams = [_StreamThread(self._stream(messages), queue)]
+        winner = None
+        failed = 0
+        try:
+            while True:
+                hedging = winner is None and len(streams) == 1 and self.first_token_timeout is not None
+                try:
+                    (stream, item) = queue.get(timeout=self.first_token_timeout if hedging else self.chunk_timeout)
+                except Empty:
+                    if not hedging: raise StreamStalled(f"No chunk was streamed for {self.chunk_timeout} seconds.")
+                    self.hedges += 1
+                    streams.append(_StreamThread(self._stream(messages), queue))
+                    continue
+                if winner is not None and stream is not winner: continue
+                if isinstance(item, Exception):
+                    failed += 1
+                    if winner is None and failed < len(streams): continue  # The other stream may still succeed
+                    raise item
+                if winner is None:
+                    winner = stream
+                    for other in streams: other.cancelled = other is not winner
+                if item is _DONE: return
+                yield item
+        finally:
+            for stream in streams: stream.cancelled = True
+
+    def _stream_answer_nonstop(self, messages):
+        answer = []  # The chunks yielded so far
+        attempt = 0
+        while True:
+            request = _continue_answer(messages, "".join(answer))
+            deadlines = self.first_token_timeout is not None or self.chunk_timeout is not None
+            try:
+                for (author, chunk) in (self._stream_with_deadlines(request) if deadlines else self._stream(request)):
+                    if chunk: answer.append(chunk)
+                    yield (author, chunk)
+                return
+            except Exception as e:
+                if not self._should_retry(e, attempt, answer): raise
+                time.sleep(self._retry_delay(e, attempt))
+                attempt += 1
 
     def _get_answer(self, messages):
-        response = self.client.chat.completions.create(
+        attempt = 0
+        while True:
+            try:
+                response = self.client.chat.completions.create(
+                    model=self.model_name,
+                    messages=messages,
+                    stream=False
+                )
+                break
+            except Exception as e:
+                if not self._should_retry(e, attempt): raise
+                time.sleep(self._retry_delay(e, attempt))
+                attempt += 1
+        author = response.choices[0].message.role or "assistant"
+        text = response.choices[0].message.content
+        return (author, text)
+        
+class AsyncOpenAIModel(_Retrying, AsyncModel):
+    def __init__(self, model_name, client=None, organization=None, api_key=None, base_url=None,
+                 max_retries=2, backoff=0.5, max_backoff=10.0, first_token_timeout=None, chunk_timeout=None, continue_streams=True):
+        self.model_name = model_name
+        organization = organization or os.getenv("OPENAI_ORGANIZATION")
+        api_key = api_key or os.getenv("OPENAI_API_KEY")
+        base_url = base_url or os.getenv("OPENAI_API_BASE")
+        if client is None:
+            from openai import AsyncOpenAI
+            client = AsyncOpenAI(organization=organization, api_key=api_key, base_url=base_url, max_retries=0)
+        self.client = client
+        self._init_retries(max_retries, backoff, max_backoff, first_token_timeout, chunk_timeout, continue_streams)
+
+    async def _stream(self, messages):
+        response = await self.client.chat.completions.create(
             model=self.model_name,
             messages=messages,
-            stream=False
+            stream=True
         )
+        try:
+            async for chunk in response: yield _delta(chunk)
+        finally:
+            if hasattr(response, "close"):
+                closed = response.close()
+                if inspect.isawaitable(closed): await closed
+
+    async def _stream_with_deadlines(self, messages):
+        queue = asyncio.Queue()
+        async def read(stream):
+            try:
+                async for item in stream: await queue.put((stream, item))
+                await queue.put((stream, _DONE))
+            except Exception as e:
+                await queue.put((stream, e))
+            finally:
+                await stream.aclose()
+        streams = [self._stream(messages)]
+        tasks = [asyncio.ensure_future(read(streams[0]))]
+        winner = None
+        failed = 0
+        try:
+            while True:
+                hedging = winner is None and len(streams) == 1 and self.first_token_timeout is not None
+                try:
+                    (stream, item) = await asyncio.wait_for(queue.get(), self.first_token_timeout if hedging else self.chunk_timeout)
+                except asyncio.TimeoutError:
+                    if not hedging: raise StreamStalled(f"No chunk was streamed for {self.chunk_timeout} seconds.")
+                    self.hedges += 1
+                    streams.append(self._stream(messages))
+                    tasks.append(asyncio.ensure_future(read(streams[-1])))
+                    continue
+                if winner is not None and stream is not winner: continue
+                if isinstance(item, Exception):
+                    failed += 1
+                    if winner is None and failed < len(streams): continue  # The other stream may still succeed
+                    raise item
+                if winner is None:
+                    winner = stream
+                    for (other, task) in zip(streams, tasks):
+                        if other is not winner: task.cancel()
+                if item is _DONE: return
+                yield item
+        finally:
+            for task in tasks: task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _stream_answer_nonstop(self, messages):
+        answer = []
+        attempt = 0
+        while True:
+            request = _continue_answer(messages, "".join(answer))
+            deadlines = self.first_token_timeout is not None or self.chunk_timeout is not None
+            stream = self._stream_with_deadlines(request) if deadlines else self._stream(request)
+            try:
+                async for (author, chunk) in stream:
+                    if chunk: answer.append(chunk)
+                    yield (author, chunk)
+                return
+            except Exception as e:
+                if not self._should_retry(e, attempt, answer): raise
+                await asyncio.sleep(self._retry_delay(e, attempt))
+                attempt += 1
+            finally:
+                await stream.aclose()
+
+    async def _get_answer(self, messages):
+        attempt = 0
+        while True:
+            try:
+                response = await self.client.chat.completions.create(
+                    model=self.model_name,
+                    messages=messages,
+                    stream=False
+                )
+                break
+            except Exception as e:
+                if not self._should_retry(e, attempt): raise
+                await asyncio.sleep(self._retry_delay(e, attempt))
+                attempt += 1
         author = response.choices[0].message.role or "assistant"
         text = response.choices[0].message.content
         return (author, text)
-        
+
 class OpenAIGPT35Turbo(OpenAIModel):
     def __init__(self, **kwargs):
         super().__init__("gpt-3.5-turbo", **kwargs)
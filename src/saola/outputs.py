@@ -0,0 +1,84 @@
+import copy
+import hashlib
+from saola.context import estimate_tokens
+
+class OutputIndex:
+    """
+    Hides the interface outputs of a convo that are repeated or superseded by later ones, so that they
+    aren't sent to the model again: an output is hidden when a later output has the same text (e.g. the
+    same traceback), or the same key (given by the interface, e.g. FILE_SHOW and FILE_WRITE outputs of the
+    same file supersede each other). A hidden output is replaced with a placeholder giving the index of the
+    bubble holding the later output.
+
+    Outputs are indexed by the hash of their text and by their key, so each new output only looks up the
+    latest one it repeats or supersedes, instead of scanning the convo. The texts of the hidden outputs are
+    kept in outputs (by hash) and brought back if the later output is rolled back, and tokens_saved counts
+    the tokens they no longer take (as counted by the context manager of the convo, if any).
+    """
+    placeholder = "[OUTPUT HIDDEN: superseded by the output in bubble {index}]"
+    repeated_placeholder = "[OUTPUT HIDDEN: repeated in the output in bubble {index}]"
+    min_size = 200  # Shorter outputs are not worth hiding when repeated
+
+    def __init__(self):
+        self.outputs = {}  # Texts of the hidden outputs, by hash
+        self.hidden = 0
+        self.tokens_saved = 0
+        self._latest = {}  # The (bubble index, hash) of the latest output, by ("hash", hash) or ("key", key)
+        self._changes = []  # (bubble index, latest key, previous latest, whether it was hidden) for every output, to undo them
+
+    def copy(self):
+        index = copy.copy(self)
+        index.outputs = dict(self.outputs)
+        index._latest = dict(self._latest)
+        index._changes = list(self._changes)
+        return index
+
+    @staticmethod
+    def hash(output):
+        return hashlib.sha256(output.encode("utf-8")).hexdigest()[:16]
+
+    def _count_tokens(self, convo, text):
+        return (convo.context_manager.count_tokens if convo.context_manager else estimate_tokens)(text)
+
+    def add(self, convo, bubble, output, key=None):
+        # Indexes the output just appended to bubble (whose meta has its output_hash), hiding the outputs it repeats or supersedes
+        digest = bubble.meta["output_hash"]
+        latest_keys = ([("hash", digest)] if len(output) >= self.min_size else []) + ([("key", key)] if key is not None else [])
+        for latest_key in latest_keys:
+            previous = self._latest.get(latest_key)
+            self._latest[latest_key] = (bubble.index, digest)
+            placeholder = self.repeated_placeholder if latest_key[0] == "hash" else self.placeholder
+            hidden = previous is not None and previous[0] != bubble.index and \
+                self._hide(convo, previous, placeholder.format(index=bubble.index))
+            self._changes.append((bubble.index, latest_key, previous, hidden))
+
+    def _hide(self, convo, previous, placeholder):
+        # Hides the output at previous (a bubble index and hash), unless it was rolled back or already hidden
+        (index, digest) = previous
+        if index >= len(convo.bubbles) or (convo.bubbles[index].meta or {}).get("output_hash") != digest: return False
+        if convo.bubbles[index].meta.get("cleaned_up"): return False
+        bubble = convo._writable_bubble(index)
+        text = bubble.text
+        self.outputs[digest] = text
+        bubble.doc.text = placeholder
+        bubble.meta = dict(bubble.meta, cleaned_up=True)
+        self.hidden += 1
+        self.tokens_saved += self._count_tokens(convo, text) - self._count_tokens(convo, placeholder)
+        return True
+
+    def truncate(self, convo, num_bubbles):
+        # Called when the convo is rolled back to num_bubbles bubbles, undoing the changes made by later outputs
+        while self._changes and self._changes[-1][0] >= num_bubbles:
+            (_, latest_key, previous, hidden) = self._changes.pop()
+            if previous is None:
+                del self._latest[latest_key]
+                continue
+            self._latest[latest_key] = previous
+            (index, digest) = previous
+            if not hidden or index >= num_bubbles: continue
+            bubble = convo._writable_bubble(index)
+            placeholder = bubble.text
+            bubble.doc.text = self.outputs[digest]
+            bubble.meta = {k: v for (k, v) in bubble.meta.items() if k != "cleaned_up"}
+            self.hidden -= 1
+            self.tokens_saved -= self._count_tokens(convo, bubble.text) - self._count_tokens(convo, placeholder)
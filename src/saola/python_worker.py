@@ -0,0 +1,414 @@
+import io
+import os
+import sys
+import json
+import time
+import types
+import pickle
+import codecs
+import signal
+import builtins
+import importlib
+import itertools
+import selectors
+import threading
+import subprocess
+
+# PYTHON WORKERS
+# ==============
+# A worker is a Python subprocess running this file, which executes code in its own namespace. Requests
+# and responses are JSON lines sent over two dedicated pipes, so that the code can freely use the
+# worker's stdin, stdout and stderr (which are streamed back as they are written):
+# - The worker sends {"ready": true} once it has started and preloaded its modules.
+# - {"code": <code>, "memory_limit": <bytes or null>} executes code.
+# - {"snapshot": <id>}, {"restore": <id>} and {"discard": <id>} manage snapshots of the namespace, which
+#   are kept in the worker.
+# The worker answers every request with {"done": true, "error": <text or null>}, after flushing its outputs.
+# This file only imports the standard library at the top, as workers run it without the saola package.
+
+DEFAULT_PRELOAD = ["json", "math", "re", "datetime", "collections", "itertools", "numpy", "pandas"]
+
+_BOOTSTRAP = "import sys, runpy; runpy.run_path(sys.argv.pop(1), run_name='__main__')"
+
+def _set_memory_limit(limit):
+    # Limits the address space of the worker to limit bytes, or lifts the limit when limit is None
+    import resource
+    (_, hard) = resource.getrlimit(resource.RLIMIT_AS)
+    if limit is not None and hard != resource.RLIM_INFINITY: limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (hard if limit is None else limit, hard))
+
+class _NamespacePickler(pickle.Pickler):
+    # Pickles references to the kept values of a namespace by their name
+    def __init__(self, file, kept):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.kept_names = {id(value): name for (name, value) in kept.items()}
+
+    def persistent_id(self, obj):
+        return self.kept_names.get(id(obj))
+
+class _NamespaceUnpickler(pickle.Unpickler):
+    def __init__(self, file, kept):
+        super().__init__(file)
+        self.kept = kept
+
+    def persistent_load(self, name):
+        return self.kept[name]
+
+def _pickle_values(values, kept):
+    f = io.BytesIO()
+    _NamespacePickler(f, kept).dump(values)
+    return f.getvalue()
+
+def _snapshot_namespace(namespace):
+    """
+    Returns a snapshot of the values of namespace, from which it can be restored with _restore_namespace.
+    Values are pickled, except the modules, functions and classes (which are not copied, and are restored
+    as they are along with the instances referencing them) and the values that cannot be pickled, which
+    are kept as they are.
+    """
+    values = {}
+    kept = {}
+    for (name, value) in namespace.items():
+        if name == "__builtins__": continue
+        if isinstance(value, (types.ModuleType, types.FunctionType, type)):
+            kept[name] = value
+        else:
+            values[name] = value
+    try:
+        return (_pickle_values(values, kept), kept)
+    except Exception:
+        pass
+    picklable = {}
+    for (name, value) in values.items():
+        try:
+            _pickle_values(value, kept)
+            picklable[name] = value
+        except Exception:
+            kept[name] = value
+    return (_pickle_values(picklable, kept), kept)
+
+def _restore_namespace(namespace, snapshot):
+    (pickled, kept) = snapshot
+    builtins_module = namespace.get("__builtins__")
+    namespace.clear()
+    if builtins_module is not None: namespace["__builtins__"] = builtins_module
+    namespace.update(kept)
+    namespace.update(_NamespaceUnpickler(io.BytesIO(pickled), kept).load())
+
+def _rebind(value, old_globals, new_globals, rebound):
+    # Returns a copy of the function or class value bound to new_globals if it was defined in old_globals
+    # (its methods, for a class), or value itself. rebound keeps the copies made so far, by id.
+    if id(value) in rebound: return rebound[id(value)]
+    if isinstance(value, types.FunctionType):
+        if value.__globals__ is not old_globals: return value
+        function = types.FunctionType(value.__code__, new_globals, value.__name__, value.__defaults__, value.__closure__)
+        (function.__kwdefaults__, function.__qualname__, function.__doc__) = (value.__kwdefaults__, value.__qualname__, value.__doc__)
+        function.__annotations__ = dict(value.__annotations__)
+        function.__dict__.update(value.__dict__)
+        rebound[id(value)] = function
+        return function
+    if isinstance(value, type) and value.__module__ == old_globals.get("__name__") and value.__name__ in old_globals:
+        attributes = {}
+        for (name, attribute) in vars(value).items():
+            if name in ("__dict__", "__weakref__"): continue
+            if isinstance(attribute, (staticmethod, classmethod)):
+                function = _rebind(attribute.__func__, old_globals, new_globals, rebound)
+                if function is not attribute.__func__: attribute = type(attribute)(function)
+            elif isinstance(attribute, property):
+                functions = (attribute.fget, attribute.fset, attribute.fdel)
+                rebound_functions = tuple(_rebind(f, old_globals, new_globals, rebound) if f else None for f in functions)
+                if rebound_functions != functions: attribute = property(*rebound_functions, attribute.__doc__)
+            else:
+                attribute = _rebind(attribute, old_globals, new_globals, rebound)
+            attributes[name] = attribute
+        bases = tuple(_rebind(base, old_globals, new_globals, rebound) for base in value.__bases__)
+        if bases == value.__bases__ and all(attributes[name] is attribute for (name, attribute) in vars(value).items() if name in attributes):
+            return value  # Its methods don't use the globals (e.g. it was imported)
+        try:
+            cls = type(value)(value.__name__, bases, attributes)
+        except Exception:
+            return value  # E.g. a metaclass that can't be called this way
+        cls.__qualname__ = value.__qualname__
+        rebound[id(value)] = cls
+        return cls
+    return value
+
+class PythonNamespace:
+    """
+    The namespace where the code of a convo is executed within this process, with the same snapshot
+    methods as PythonWorker.
+    """
+    def __init__(self):
+        self.globals = {"__name__": "__main__"}
+
+    def snapshot(self):
+        return _snapshot_namespace(self.globals)
+
+    def restore(self, snapshot):
+        _restore_namespace(self.globals, snapshot)
+
+    def discard(self, snapshot):
+        pass
+
+    def fork(self):
+        # Values that cannot be pickled (see _snapshot_namespace) are shared with the fork, while the functions
+        # and classes defined in this namespace are copied, so that their globals are those of the fork
+        namespace = PythonNamespace()
+        (pickled, kept) = self.snapshot()
+        rebound = {}
+        kept = {name: _rebind(value, self.globals, namespace.globals, rebound) for (name, value) in kept.items()}
+        namespace.restore((pickled, kept))
+        return namespace
+
+    def close(self):
+        self.globals.clear()
+
+def _worker_main(request_fd, response_fd, preload):
+    requests = os.fdopen(request_fd, "r", encoding="utf-8")
+    responses = os.fdopen(response_fd, "w", encoding="utf-8")
+    def respond(**response):
+        responses.write(json.dumps(response) + "\n")
+        responses.flush()
+    for name in preload:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            pass
+    sys.stdout.reconfigure(line_buffering=True)
+    sys.stderr.reconfigure(line_buffering=True)
+    # The code runs in a real __main__ module, so that the classes and functions it defines can be pickled
+    main = types.ModuleType("__main__")
+    main.__builtins__ = builtins
+    sys.modules["__main__"] = main
+    snapshots = {}
+    respond(ready=True)
+    for line in requests:
+        request = json.loads(line)
+        error = None
+        try:
+            if "snapshot" in request:
+                snapshots[request["snapshot"]] = _snapshot_namespace(main.__dict__)
+            elif "restore" in request:
+                _restore_namespace(main.__dict__, snapshots[request["restore"]])
+            elif "discard" in request:
+                snapshots.pop(request["discard"], None)
+            else:
+                if request.get("memory_limit") is not None: _set_memory_limit(request["memory_limit"])
+                exec(compile(request["code"], "<python>", "exec"), main.__dict__)
+        except BaseException as e:  # Including SystemExit, and the KeyboardInterrupt sent on timeouts
+            error = str(e) or type(e).__name__
+        finally:
+            if request.get("memory_limit") is not None: _set_memory_limit(None)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        respond(done=True, error=error)
+
+class ExecutionResult:
+    def __init__(self, stdout, stderr, error, timeout=None):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.error = error
+        self.timeout = timeout  # "wall-clock" if the execution was stopped
+
+    def format(self):
+        output = self.stdout.rstrip()
+        if self.stderr.strip(): output += ("\n" if output else "") + self.stderr.rstrip()
+        if self.timeout: output += ("\n" if output else "") + f"[The execution was stopped after reaching its {self.timeout} timeout]"
+        elif self.error: output += ("\n" if output else "") + f"ERROR: {self.error}"
+        return output
+
+class PythonWorker:
+    """
+    A Python subprocess where code is executed in a namespace that persists between executions. Code
+    that times out is interrupted (with a KeyboardInterrupt), and the worker is restarted if it does not
+    stop within interrupt_grace_period seconds, or if it dies; the next result then says so.
+    """
+    restart_notice = "[The Python worker was restarted, so the variables of previous executions were lost]"
+
+    def __init__(self, preload=DEFAULT_PRELOAD):
+        self.preload = list(preload)
+        self.process = None
+        self.restarted = False
+        self._lock = threading.Lock()
+        self._snapshot_ids = itertools.count()
+        self._start()
+
+    def _start(self):
+        (request_read, request_write) = os.pipe()
+        (response_read, response_write) = os.pipe()
+        self.process = subprocess.Popen(
+            [sys.executable, "-c", _BOOTSTRAP, os.path.abspath(__file__), str(request_read), str(response_write), json.dumps(self.preload)],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            pass_fds=(request_read, response_write),
+            start_new_session=True
+        )
+        os.close(request_read)
+        os.close(response_write)
+        self.requests = os.fdopen(request_write, "w", encoding="utf-8")
+        self.responses = os.fdopen(response_read, "rb", buffering=0)
+        self._pending_responses = b""
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def restart(self):
+        self.close()
+        self._start()
+        self.restarted = True
+
+    def close(self):
+        from saola.shell import _kill
+        if self.process is None: return
+        _kill(self.process)
+        for f in [self.requests, self.responses, self.process.stdout, self.process.stderr]:
+            try:
+                f.close()
+            except OSError:
+                pass
+        self.process.wait()
+        self.process = None
+
+    def run(self, code, *, timeout=None, memory_limit=None, max_output_size=None, on_output=None, read_size=65536, interrupt_grace_period=1):
+        """
+        Executes code in the worker, reading its stdout and stderr in chunks as they come. The code is
+        interrupted after timeout seconds, and may use at most memory_limit bytes of address space. Each
+        of stdout and stderr keeps at most max_output_size characters. on_output(stream_name, text) is
+        called with every chunk read.
+        """
+        with self._lock:
+            if not self.alive(): self.restart()
+            restarted = self.restarted
+            self.restarted = False
+            self._send({"code": code, "memory_limit": memory_limit})
+            result = self._wait_for_result(timeout, max_output_size, on_output, read_size, interrupt_grace_period)
+            if not self.alive(): self.restart()
+            if restarted: result.stderr = PythonWorker.restart_notice + ("\n" + result.stderr if result.stderr else "")
+            return result
+
+    # Snapshots are kept in the worker, and are lost if it is restarted
+    def snapshot(self):
+        snapshot_id = next(self._snapshot_ids)
+        self._call({"snapshot": snapshot_id})
+        return snapshot_id
+
+    def restore(self, snapshot_id):
+        return self._call({"restore": snapshot_id})
+
+    def discard(self, snapshot_id):
+        self._call({"discard": snapshot_id})
+
+    def _call(self, request):
+        # Sends a request other than an execution, returning its error (if any)
+        with self._lock:
+            if not self.alive(): return "The Python worker is not running"
+            self._send(request)
+            return self._wait_for_result(None, None, None, 65536, 1).error
+
+    def _send(self, request):
+        try:
+            self.requests.write(json.dumps(request) + "\n")
+            self.requests.flush()
+        except BrokenPipeError:
+            pass  # The worker died, which is noticed while waiting for its response
+
+    def _wait_for_result(self, timeout, max_output_size, on_output, read_size, interrupt_grace_period):
+        from saola.shell import OutputBuffer, _kill
+        buffers = {}
+        decoders = {}
+        selector = selectors.DefaultSelector()
+        for (name, pipe) in [("stdout", self.process.stdout), ("stderr", self.process.stderr)]:
+            buffers[name] = OutputBuffer(max_output_size)
+            decoders[name] = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            selector.register(pipe, selectors.EVENT_READ, name)
+        selector.register(self.responses, selectors.EVENT_READ, "responses")
+        deadline = None if timeout is None else time.monotonic() + timeout
+        response = None
+        stopped_by = None
+        try:
+            while response is None and selector.get_map():
+                now = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    if stopped_by is not None:
+                        _kill(self.process)  # The code ignored the interruption
+                        break
+                    stopped_by = "wall-clock"
+                    os.kill(self.process.pid, signal.SIGINT)
+                    deadline = now + interrupt_grace_period
+                for (key, _) in selector.select(None if deadline is None else deadline - now):
+                    data = os.read(key.fileobj.fileno(), read_size)
+                    if not data: selector.unregister(key.fileobj)
+                    if key.data == "responses":
+                        response = self._read_response(data) or response
+                        continue
+                    text = decoders[key.data].decode(data, final=not data)
+                    buffers[key.data].write(text)
+                    if on_output and text: on_output(key.data, text)
+            # The outputs of the code were flushed before its response, so they are already in the pipes
+            if self.responses in selector.get_map(): selector.unregister(self.responses)
+            while selector.get_map():
+                events = selector.select(0 if response is not None else interrupt_grace_period)
+                if not events: break
+                for (key, _) in events:
+                    data = os.read(key.fileobj.fileno(), read_size)
+                    if not data: selector.unregister(key.fileobj)
+                    text = decoders[key.data].decode(data, final=not data)
+                    buffers[key.data].write(text)
+                    if on_output and text: on_output(key.data, text)
+        finally:
+            selector.close()
+        if response is not None:
+            error = response["error"]
+        elif stopped_by is None:
+            # The worker closed its responses pipe, as it exited
+            try:
+                error = f"The Python worker exited with code {self.process.wait(timeout=interrupt_grace_period)}"
+            except subprocess.TimeoutExpired:
+                _kill(self.process)
+                error = "The Python worker stopped responding"
+        else:
+            error = None
+        return ExecutionResult(buffers["stdout"].getvalue(), buffers["stderr"].getvalue(), error, stopped_by)
+
+    def _read_response(self, data):
+        # Returns the done response among the complete lines received so far, if any
+        self._pending_responses += data
+        (*lines, self._pending_responses) = self._pending_responses.split(b"\n")
+        for line in lines:
+            response = json.loads(line)
+            if response.get("done"): return response
+        return None
+
+class PythonWorkerPool:
+    """
+    Keeps up to size fresh workers started in advance (with their modules preloaded), so that acquiring
+    a worker does not wait for Python to start. Workers are never shared, as each one keeps the
+    namespace of its user.
+    """
+    def __init__(self, size=1, preload=DEFAULT_PRELOAD):
+        self.size = size
+        self.preload = preload
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _fill(self):
+        with self._lock:
+            while len(self._idle) < self.size: self._idle.append(PythonWorker(self.preload))
+
+    def acquire(self):
+        worker = None
+        with self._lock:
+            while self._idle and worker is None:
+                worker = self._idle.pop(0)
+                if not worker.alive(): worker = None
+        self._fill()
+        return worker or PythonWorker(self.preload)
+
+    def close(self):
+        with self._lock:
+            for worker in self._idle: worker.close()
+            self._idle = []
+
+if __name__ == "__main__":
+    _worker_main(int(sys.argv[1]), int(sys.argv[2]), json.loads(sys.argv[3]))
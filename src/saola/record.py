@@ -0,0 +1,105 @@
+import gzip
+import json
+import time
+import hashlib
+import threading
+from collections import defaultdict, deque
+from saola.model import Model
+
+# RECORDINGS
+# ==========
+# A recording file has one JSON object per line, for each call to a model:
+# - {"key": <hash of the messages>, "chunks": [[delay, author, chunk], ...], "complete": <bool>} for streams,
+#   where delay is the number of seconds since the previous chunk (or since the call), and author is null
+#   when it is the same as in the previous chunk.
+# - {"key": <hash of the messages>, "delay": <seconds>, "answer": [author, text]} for get_answer calls.
+# Files whose name ends with .gz are compressed.
+
+def _open(path, mode):
+    return gzip.open(path, mode + "t", encoding="utf-8") if path.endswith(".gz") else open(path, mode, encoding="utf-8")
+
+def _messages_key(messages):
+    return hashlib.sha256(json.dumps(messages, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+class RecordingModel(Model):
+    """
+    Wraps any model and appends every answer it streams, with its timing, to the recording at path.
+    """
+    def __init__(self, model, path):
+        self.model = model() if isinstance(model, type) else model
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _write(self, record):
+        with self._lock, _open(self.path, "a") as f:
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def _stream_answer_nonstop(self, messages):
+        chunks = []
+        complete = False
+        last_author = None
+        last_time = time.perf_counter()
+        try:
+            for (author, chunk) in self.model._stream_answer_nonstop(messages):
+                now = time.perf_counter()
+                chunks.append([round(now - last_time, 6), author if author != last_author else None, chunk])
+                (last_author, last_time) = (author, now)
+                yield (author, chunk)
+                last_time = time.perf_counter()  # Time spent by the consumer is not part of the recording
+            complete = True
+        finally:
+            self._write({"key": _messages_key(messages), "chunks": chunks, "complete": complete})
+
+    def _get_answer(self, messages):
+        start = time.perf_counter()
+        answer = self.model._get_answer(messages)
+        self._write({"key": _messages_key(messages), "delay": round(time.perf_counter() - start, 6), "answer": list(answer)})
+        return answer
+
+class ReplayModel(Model):
+    """
+    Replays a recording made with a RecordingModel, without any network access.
+
+    Each call replays the next unused recording made for the same messages or, if there is none, the next
+    unused recording in the file. With speed=None there are no delays between chunks; otherwise the
+    recorded delays are divided by speed (speed=1.0 replays in real time).
+    """
+    def __init__(self, path, speed=None):
+        self.speed = speed
+        with _open(path, "r") as f: self.records = [json.loads(line) for line in f if line.strip()]
+        # Streams and answers are replayed from separate queues, so that a call of one kind never uses up
+        # the recordings of the other
+        self._unused = defaultdict(deque)
+        self._unused_by_key = defaultdict(deque)
+        for (i, record) in enumerate(self.records):
+            kind = "chunks" if "chunks" in record else "answer"
+            self._unused[kind].append(i)
+            self._unused_by_key[(kind, record["key"])].append(i)
+        self._used = set()
+        self._lock = threading.Lock()
+
+    def _next_record(self, messages, kind):
+        with self._lock:
+            for candidates in (self._unused_by_key[(kind, _messages_key(messages))], self._unused[kind]):
+                while candidates and candidates[0] in self._used: candidates.popleft()
+                if candidates: break
+            else:
+                raise LookupError("There are no recordings left to replay.")
+            i = candidates.popleft()
+            self._used.add(i)
+            return self.records[i]
+
+    def _sleep(self, delay):
+        if self.speed and delay > 0: time.sleep(delay / self.speed)
+
+    def _stream_answer_nonstop(self, messages):
+        author = None
+        for (delay, chunk_author, chunk) in self._next_record(messages, "chunks")["chunks"]:
+            self._sleep(delay)
+            author = chunk_author or author
+            yield (author, chunk)
+
+    def _get_answer(self, messages):
+        record = self._next_record(messages, "answer")
+        self._sleep(record["delay"])
+        return tuple(record["answer"])
@@ -0,0 +1,202 @@
+import time
+import random
+import threading
+from saola.model import Model, AsyncModel, _is_retryable, _continue_answer
+
+ENDPOINT_ERROR_STATUS_CODES = {401, 403, 404}  # Errors of the endpoint (e.g. a wrong key or URL) rather than of the request
+
+def _is_endpoint_error(error):
+    # Whether the error tells that the endpoint is unavailable, so that it counts as a failure of the endpoint
+    return _is_retryable(error) or getattr(error, "status_code", None) in ENDPOINT_ERROR_STATUS_CODES
+
+class Endpoint:
+    """
+    One of the models of a RoutedModel, with its load (outstanding requests), its latency (a moving
+    average of the seconds to the first chunk, or to the answer) and the state of its circuit breaker.
+    """
+    def __init__(self, model):
+        self.model = model() if isinstance(model, type) else model
+        self.outstanding = 0
+        self.latency = None
+        self.failures = 0  # Consecutive failures
+        self.opened_at = None  # When the circuit was opened (after too many failures), or None if it is closed
+        self.probing = False  # Whether a request is trying the endpoint while its circuit is open
+        self.requests = 0
+        self.errors = 0
+
+    @property
+    def healthy(self):
+        return self.opened_at is None
+
+class _Router:
+    # The routing shared by RoutedModel and AsyncRoutedModel
+    def _init_router(self, models, strategy, failure_threshold, reset_timeout, latency_decay, continue_streams):
+        assert strategy in ("least_outstanding", "ewma"), f"Unknown strategy: {strategy}"
+        assert models, "A routed model needs at least one model."
+        self.endpoints = [Endpoint(model) for model in models]
+        self.strategy = strategy
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.latency_decay = latency_decay
+        self.continue_streams = continue_streams
+        self.failovers = 0  # Requests sent to another endpoint after one failed
+        self._lock = threading.Lock()
+
+    @property
+    def model_name(self):
+        model = self.endpoints[0].model
+        return getattr(model, "model_name", type(model).__name__)
+
+    def _cost(self, endpoint):
+        latency = endpoint.latency or 0.0  # Endpoints without requests yet are tried first
+        if self.strategy == "ewma": return (latency * (endpoint.outstanding + 1), endpoint.outstanding)
+        return (endpoint.outstanding, latency)
+
+    def _choose(self, tried):
+        # Returns the endpoint to send a request to (among those not tried yet), counting it as outstanding
+        with self._lock:
+            now = time.monotonic()
+            untried = [e for e in self.endpoints if e not in tried]
+            # Endpoints whose circuit is open get a single request once reset_timeout has passed (half-open)
+            candidates = [e for e in untried if e.opened_at is None or (not e.probing and now - e.opened_at >= self.reset_timeout)]
+            if not candidates:
+                # All the circuits are open, so the endpoint that failed longest ago is tried anyway
+                candidates = sorted(untried, key=lambda e: e.opened_at)[:1]
+                if not candidates: return None
+            random.shuffle(candidates)  # Ties are broken randomly
+            endpoint = min(candidates, key=self._cost)
+            if endpoint.opened_at is not None: endpoint.probing = True
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            if tried: self.failovers += 1
+            return endpoint
+
+    def _fails_over(self, error, answer):
+        # Whether a request failing with error (after yielding answer, for streams) is sent to another endpoint
+        return _is_endpoint_error(error) and (not answer or self.continue_streams)
+
+    def _finished(self, endpoint, latency, failed):
+        # failed is None when the request failed because of itself (e.g. a bad request), which says nothing of the endpoint
+        with self._lock:
+            endpoint.outstanding -= 1
+            endpoint.probing = False
+            if failed is None: return
+            if failed:
+                endpoint.errors += 1
+                endpoint.failures += 1
+                if endpoint.failures >= self.failure_threshold or endpoint.opened_at is not None:
+                    endpoint.opened_at = time.monotonic()
+                return
+            endpoint.failures = 0
+            endpoint.opened_at = None
+            if latency is not None:
+                endpoint.latency = latency if endpoint.latency is None else \
+                    self.latency_decay * endpoint.latency + (1 - self.latency_decay) * latency
+
+class RoutedModel(_Router, Model):
+    """
+    Distributes the requests among several models of the same kind (e.g. OpenAIModels with clients for
+    different endpoints), sending each request to the one with the least outstanding requests, or with the
+    lowest latency (weighted by the outstanding requests) with strategy="ewma".
+
+    When a request fails with a transient error, or an error of the model's endpoint (a 401, 403 or 404, e.g.
+    because of a wrong key or URL), it is sent to another model; other errors come from the request itself,
+    so they are raised without counting against the model. A stream failing midway is
+    sent to another model along with its partial answer, which the model is asked to continue (see
+    saola.model), or fails with continue_streams=False. After failure_threshold consecutive failures, a
+    model is left out (its circuit is open) for reset_timeout seconds, after which a single request tries
+    it again.
+    """
+    def __init__(self, models, strategy="least_outstanding", failure_threshold=3, reset_timeout=30.0, latency_decay=0.8, continue_streams=True):
+        self._init_router(models, strategy, failure_threshold, reset_timeout, latency_decay, continue_streams)
+
+    def _stream_answer_nonstop(self, messages):
+        answer = []  # The chunks yielded so far
+        tried = []
+        error = None
+        while True:
+            endpoint = self._choose(tried)
+            if endpoint is None: raise error
+            tried.append(endpoint)
+            start = time.monotonic()
+            latency = None
+            failed = False
+            try:
+                for (author, chunk) in endpoint.model._stream_answer_nonstop(_continue_answer(messages, "".join(answer))):
+                    if latency is None: latency = time.monotonic() - start
+                    if chunk: answer.append(chunk)
+                    yield (author, chunk)
+            except Exception as e:
+                failed = True if _is_endpoint_error(e) else None
+                if not self._fails_over(e, answer): raise
+                error = e
+            finally:
+                self._finished(endpoint, latency, failed)
+            if not failed: return
+
+    def _get_answer(self, messages):
+        tried = []
+        error = None
+        while True:
+            endpoint = self._choose(tried)
+            if endpoint is None: raise error
+            tried.append(endpoint)
+            start = time.monotonic()
+            failed = False
+            try:
+                return endpoint.model._get_answer(messages)
+            except Exception as e:
+                failed = True if _is_endpoint_error(e) else None
+                if not failed: raise
+                error = e
+            finally:
+                self._finished(endpoint, time.monotonic() - start, failed)
+
+class AsyncRoutedModel(_Router, AsyncModel):
+    # Same as RoutedModel, for async models
+    def __init__(self, models, strategy="least_outstanding", failure_threshold=3, reset_timeout=30.0, latency_decay=0.8, continue_streams=True):
+        self._init_router(models, strategy, failure_threshold, reset_timeout, latency_decay, continue_streams)
+
+    async def _stream_answer_nonstop(self, messages):
+        answer = []
+        tried = []
+        error = None
+        while True:
+            endpoint = self._choose(tried)
+            if endpoint is None: raise error
+            tried.append(endpoint)
+            start = time.monotonic()
+            latency = None
+            failed = False
+            stream = endpoint.model._stream_answer_nonstop(_continue_answer(messages, "".join(answer)))
+            try:
+                async for (author, chunk) in stream:
+                    if latency is None: latency = time.monotonic() - start
+                    if chunk: answer.append(chunk)
+                    yield (author, chunk)
+            except Exception as e:
+                failed = True if _is_endpoint_error(e) else None
+                if not self._fails_over(e, answer): raise
+                error = e
+            finally:
+                self._finished(endpoint, latency, failed)
+                if hasattr(stream, "aclose"): await stream.aclose()
+            if not failed: return
+
+    async def _get_answer(self, messages):
+        tried = []
+        error = None
+        while True:
+            endpoint = self._choose(tried)
+            if endpoint is None: raise error
+            tried.append(endpoint)
+            start = time.monotonic()
+            failed = False
+            try:
+                return await endpoint.model._get_answer(messages)
+            except Exception as e:
+                failed = True if _is_endpoint_error(e) else None
+                if not failed: raise
+                error = e
+            finally:
+                self._finished(endpoint, time.monotonic() - start, failed)
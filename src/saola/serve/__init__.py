@@ -0,0 +1,115 @@
+from saola.convo import AsyncConvo, TitleInterface, ShellInterface, FileShowInterface, FileWriteInterface, SearchInterface, PythonInterface
+from saola.model import AsyncOpenAIModel
+from saola.ui import NetworkUI
+from uuid import uuid4
+import asyncio
+import json
+import os
+
+# A headless server hosting many concurrent conversations.
+#
+# Clients connect over TCP and speak line-delimited JSON. Each connection is one session:
+# - The server first sends {"type": "session", "session": <id>} followed by {"type": "ready"}.
+# - The client sends {"type": "user", "text": <message>} to ask something, or {"type": "approve"}
+#   to run the interface code waiting for a safety confirmation. Sending a new user message
+#   instead skips that code.
+# - The server streams the events of the NetworkUI, e.g. {"type": "chunk", "text": ..., "ending": ...},
+#   {"type": "interface_chunk", "stream": "stdout" or "stderr", "text": ...} as interface code prints,
+#   {"type": "interface_output", ...} or {"type": "confirmation", ...}, and {"type": "ready"} once the
+#   assistant is waiting for the user again.
+#
+# All sessions share one AsyncOpenAI client, and thus its pool of HTTP connections. Python code runs in a
+# worker subprocess per session (see saola.python_worker), as code run in the server process would print
+# to its stdout, mixed with that of the other sessions, rather than to the client.
+#
+# This file is likely to experience lots of breaking changes in the future.
+# Do not have your project depend on it.
+
+DEFAULT_INTERFACES = [TitleInterface, ShellInterface, FileShowInterface, FileWriteInterface, SearchInterface, PythonInterface]
+
+SESSION_INTERFACE_OPTIONS = {"PYTHON": {"use_worker": True}}
+
+def pooled_client(max_connections=100, api_key=None, base_url=None):
+    import httpx
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(
+        organization=os.getenv("OPENAI_ORGANIZATION"),
+        api_key=api_key or os.getenv("OPENAI_API_KEY"),
+        base_url=base_url or os.getenv("OPENAI_API_BASE"),
+        max_retries=0,  # Requests are retried by the model (see saola.model)
+        http_client=httpx.AsyncClient(limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections))
+    )
+
+class Server:
+    def __init__(self, model_name="gpt-4-1106-preview", *, client=None, model_factory=None, interfaces=None,
+                 safety_checks=True, max_connections=100, max_pending_chunks=256):
+        if model_factory is None:
+            client = client or pooled_client(max_connections)
+            model_factory = lambda: AsyncOpenAIModel(model_name, client=client)
+        self.model_factory = model_factory
+        self.interfaces = DEFAULT_INTERFACES if interfaces is None else interfaces
+        self.safety_checks = safety_checks
+        self.max_pending_chunks = max_pending_chunks
+        self.sessions = {}
+
+    async def _write_events(self, ui, writer):
+        try:
+            while True:
+                event = await ui.events.get()
+                if event is None: break
+                writer.write((json.dumps(event) + "\n").encode("utf-8"))
+                await writer.drain()
+                if event["type"] == "chunk": ui.chunk_sent()
+        finally:
+            ui.close()
+
+    async def _handle_request(self, convo, request):
+        if request.get("type") == "user" and isinstance(request.get("text"), str):
+            await convo.append_user_input(request["text"])
+        elif request.get("type") == "approve":
+            await convo.append_user_input(True)
+        else:
+            convo.ui.emit("error", error="Unknown request.")
+
+    async def handle_connection(self, reader, writer):
+        ui = NetworkUI(self.max_pending_chunks)
+        convo = AsyncConvo(self.model_factory(), ui=ui, interfaces=self.interfaces, safety_checks=self.safety_checks,
+                           interface_options=SESSION_INTERFACE_OPTIONS)
+        session_id = str(uuid4())
+        self.sessions[session_id] = convo
+        writer_task = asyncio.ensure_future(self._write_events(ui, writer))
+        ui.emit("session", session=session_id)
+        ui.display_user_header()
+        try:
+            while not ui.closed:
+                line = await reader.readline()
+                if not line: break
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    ui.emit("error", error="Requests must be JSON objects, one per line.")
+                    continue
+                await self._handle_request(convo, request if isinstance(request, dict) else {})
+        except ConnectionError:
+            pass
+        finally:
+            del self.sessions[session_id]
+            convo.close()  # Stops the shell sessions and Python worker of the session
+            ui.events.put_nowait(None)
+            try:
+                await writer_task
+            except ConnectionError:
+                pass
+            writer.close()
+
+    async def start(self, host="127.0.0.1", port=8765):
+        # Starts accepting connections, and returns the asyncio server (whose sockets tell the port picked with port=0)
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    async def serve_forever(self, host="127.0.0.1", port=8765):
+        server = await self.start(host, port)
+        async with server:
+            await server.serve_forever()
+
+def serve(host="127.0.0.1", port=8765, **kwargs):
+    asyncio.run(Server(**kwargs).serve_forever(host, port))
@@ -0,0 +1,20 @@
+from saola.serve import serve
+import argparse
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="python -m saola.serve", description="Hosts many Saola conversations behind a line-delimited JSON API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--model", default="gpt-4-1106-preview")
+    parser.add_argument("--no-safety-checks", action="store_true", help="Run interface code without asking the client (use at your own risk).")
+    parser.add_argument("--max-connections", type=int, default=100, help="Size of the pool of connections to the model API.")
+    parser.add_argument("--max-pending-chunks", type=int, default=256, help="Chunks buffered per session before waiting for its client.")
+    args = parser.parse_args()
+    serve(
+        args.host,
+        args.port,
+        model_name=args.model,
+        safety_checks=not args.no_safety_checks,
+        max_connections=args.max_connections,
+        max_pending_chunks=args.max_pending_chunks
+    )
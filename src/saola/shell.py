@@ -0,0 +1,307 @@
+import os
+import re
+import time
+import shlex
+import tempfile
+import threading
+import codecs
+import signal
+import selectors
+import subprocess
+from collections import deque
+from uuid import uuid4
+
+class OutputBuffer:
+    """
+    Keeps at most max_size characters of an output (all of it if max_size is None): its head and its tail,
+    with a marker in between telling how many characters were left out.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.head = []
+        self.head_size = 0
+        self.tail = deque()
+        self.tail_size = 0
+        self.truncated_size = 0
+
+    def write(self, text):
+        if self.max_size is None:
+            self.head.append(text)
+            return
+        if self.head_size < self.max_size // 2:
+            head_text = text[:self.max_size // 2 - self.head_size]
+            self.head.append(head_text)
+            self.head_size += len(head_text)
+            text = text[len(head_text):]
+        if not text: return
+        self.tail.append(text)
+        self.tail_size += len(text)
+        max_tail_size = self.max_size - self.max_size // 2
+        while self.tail_size > max_tail_size:
+            excess = self.tail_size - max_tail_size
+            if len(self.tail[0]) <= excess:
+                self.tail_size -= len(self.tail[0])
+                self.truncated_size += len(self.tail.popleft())
+            else:
+                self.tail[0] = self.tail[0][excess:]
+                self.tail_size -= excess
+                self.truncated_size += excess
+
+    def getvalue(self):
+        marker = f"\n[... {self.truncated_size} characters truncated ...]\n" if self.truncated_size else ""
+        return "".join(self.head) + marker + "".join(self.tail)
+
+class CommandResult:
+    def __init__(self, stdout, stderr, returncode, timeout=None):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = returncode
+        self.timeout = timeout  # "wall-clock" or "idle" if the command was stopped
+
+    def format(self):
+        output = self.stdout.rstrip()
+        if self.stderr.strip(): output += ("\n" if output else "") + "-- STDERR --\n" + self.stderr.rstrip()
+        if self.timeout: output += ("\n" if output else "") + f"[The command was stopped after reaching its {self.timeout} timeout]"
+        elif self.returncode: output += ("\n" if output else "") + f"[Exit code {self.returncode}]"
+        return output
+
+def _kill(process):
+    # Commands run in their own session, so their children are stopped too
+    for sig in [signal.SIGTERM, signal.SIGKILL]:
+        try:
+            os.killpg(process.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            return
+        try:
+            process.wait(timeout=1)
+            return
+        except subprocess.TimeoutExpired:
+            continue
+
+def run_command(command, *, timeout=None, idle_timeout=None, max_output_size=None, on_output=None, read_size=65536, background_grace_period=0.1):
+    """
+    Runs a shell command, reading its stdout and stderr in chunks as they come. The command is stopped
+    after timeout seconds, or after idle_timeout seconds without output. Each of stdout and stderr keeps
+    at most max_output_size characters. on_output(stream_name, text) is called with every chunk read.
+    """
+    process = subprocess.Popen(
+        ["/bin/bash", "-c", command],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        start_new_session=True
+    )
+    buffers = {}
+    decoders = {}
+    selector = selectors.DefaultSelector()
+    for (name, pipe) in [("stdout", process.stdout), ("stderr", process.stderr)]:
+        buffers[name] = OutputBuffer(max_output_size)
+        decoders[name] = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        selector.register(pipe, selectors.EVENT_READ, name)
+    start = last_output = time.monotonic()
+    exited_at = None
+    stopped_by = None
+    completed = False
+    try:
+        while selector.get_map():
+            now = time.monotonic()
+            if exited_at is None and process.poll() is not None: exited_at = now
+            # Background jobs of the command may keep its outputs open after it exits
+            if exited_at is not None and now - max(exited_at, last_output) >= background_grace_period: break
+            deadlines = []
+            if timeout is not None: deadlines.append((start + timeout, "wall-clock"))
+            if idle_timeout is not None: deadlines.append((last_output + idle_timeout, "idle"))
+            (deadline, reason) = min(deadlines) if deadlines else (float("inf"), None)
+            if now >= deadline:
+                stopped_by = reason
+                break
+            for (key, _) in selector.select(min(deadline - now, background_grace_period)):
+                data = os.read(key.fileobj.fileno(), read_size)
+                final = not data
+                text = decoders[key.data].decode(data, final=final)
+                if final: selector.unregister(key.fileobj)
+                if not text: continue
+                last_output = time.monotonic()
+                buffers[key.data].write(text)
+                if on_output: on_output(key.data, text)
+        completed = stopped_by is None
+    finally:
+        selector.close()
+        if not completed: _kill(process)
+        process.stdout.close()
+        process.stderr.close()
+    try:
+        returncode = process.wait(timeout=None if timeout is None else max(0, start + timeout - time.monotonic()))
+    except subprocess.TimeoutExpired:
+        # The command closed its outputs but kept running
+        _kill(process)
+        (returncode, stopped_by) = (process.wait(), "wall-clock")
+    return CommandResult(buffers["stdout"].getvalue(), buffers["stderr"].getvalue(), returncode, stopped_by)
+
+class ShellSession:
+    """
+    A long-lived bash process where commands are run one after the other, so that the working directory
+    and the environment persist between commands. The end of the output of each command is marked on
+    stdout (with the exit code) and stderr by a unique sentinel. If a command times out, or the shell dies
+    (e.g. because of an exit command), the shell is restarted for the next command.
+
+    Background jobs keep running between commands, and whatever they write after their command ended
+    shows up in the output of the next command.
+    """
+    restart_notice = "[The shell session was restarted, so its working directory and environment were reset]"
+
+    def __init__(self):
+        self.process = None
+        self.restarted = False
+        self._lock = threading.Lock()
+        self._start()
+
+    def _start(self):
+        self.process = subprocess.Popen(
+            ["/bin/bash", "--noprofile", "--norc"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True
+        )
+        self.last_used = time.monotonic()
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def restart(self):
+        self.close()
+        self._start()
+        self.restarted = True
+
+    def close(self):
+        if self.process is None: return
+        _kill(self.process)
+        for pipe in [self.process.stdin, self.process.stdout, self.process.stderr]: pipe.close()
+        self.process.wait()
+        self.process = None
+
+    def check(self, timeout=5):
+        # Restarts the shell if it is dead or does not answer within timeout seconds (the timeout itself
+        # restarts it), keeping the restart notice for the next command
+        if not self.alive():
+            self.restart()
+            return self
+        restarted = self.restarted
+        if self.run("true", timeout=timeout).returncode != 0 and not self.restarted: self.restart()
+        self.restarted = self.restarted or restarted
+        return self
+
+    def run(self, command, *, timeout=None, idle_timeout=None, max_output_size=None, on_output=None, read_size=65536):
+        # Same as run_command, but within this session
+        with self._lock:
+            if not self.alive(): self.restart()
+            restarted = self.restarted
+            self.restarted = False
+            sentinel = f"__SAOLA_END_{uuid4().hex}__"
+            (fd, script_path) = tempfile.mkstemp(prefix="saola_", suffix=".sh")
+            with os.fdopen(fd, "w") as f: f.write(command + "\n")
+            try:
+                result = self._run_script(script_path, sentinel, timeout, idle_timeout, max_output_size, on_output, read_size)
+            finally:
+                os.remove(script_path)
+            if result.timeout or not self.alive(): self.restart()
+            if restarted: result.stderr = ShellSession.restart_notice + ("\n" + result.stderr if result.stderr else "")
+            self.last_used = time.monotonic()
+            return result
+
+    def _run_script(self, script_path, sentinel, timeout, idle_timeout, max_output_size, on_output, read_size):
+        self.process.stdin.write((
+            f". {shlex.quote(script_path)} < /dev/null\n"
+            f"printf '\\n{sentinel} %d\\n' $?\n"
+            f"printf '\\n{sentinel}\\n' >&2\n"
+        ).encode("utf-8"))
+        self.process.stdin.flush()
+        ends = {"stdout": re.compile("\n" + sentinel + r" (\d+)\n"), "stderr": re.compile("\n" + sentinel + "\n")}
+        max_end_size = len(sentinel) + 16
+        buffers = {}
+        decoders = {}
+        pending = {}
+        selector = selectors.DefaultSelector()
+        for (name, pipe) in [("stdout", self.process.stdout), ("stderr", self.process.stderr)]:
+            buffers[name] = OutputBuffer(max_output_size)
+            decoders[name] = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            pending[name] = ""
+            selector.register(pipe, selectors.EVENT_READ, name)
+        def output(name, text):
+            if not text: return
+            buffers[name].write(text)
+            if on_output: on_output(name, text)
+        start = last_output = time.monotonic()
+        returncode = None
+        stopped_by = None
+        try:
+            while selector.get_map():
+                now = time.monotonic()
+                deadlines = []
+                if timeout is not None: deadlines.append((start + timeout, "wall-clock"))
+                if idle_timeout is not None: deadlines.append((last_output + idle_timeout, "idle"))
+                (deadline, reason) = min(deadlines) if deadlines else (None, None)
+                if deadline is not None and now >= deadline:
+                    stopped_by = reason
+                    break
+                for (key, _) in selector.select(None if deadline is None else deadline - now):
+                    name = key.data
+                    data = os.read(key.fileobj.fileno(), read_size)
+                    pending[name] += decoders[name].decode(data, final=not data)
+                    if not data:
+                        # The shell died
+                        selector.unregister(key.fileobj)
+                        output(name, pending[name])
+                        continue
+                    last_output = time.monotonic()
+                    end = ends[name].search(pending[name])
+                    if end:
+                        selector.unregister(key.fileobj)
+                        output(name, pending[name][:end.start()])
+                        if name == "stdout": returncode = int(end.group(1))
+                    else:
+                        output(name, pending[name][:-max_end_size])
+                        pending[name] = pending[name][-max_end_size:]
+        finally:
+            selector.close()
+        if returncode is None and stopped_by is None:
+            self.process.wait()
+            returncode = self.process.returncode
+        return CommandResult(buffers["stdout"].getvalue(), buffers["stderr"].getvalue(), returncode, stopped_by)
+
+class ShellSessionPool:
+    """
+    Keeps up to size fresh shell sessions started in advance, so that acquiring a session does not wait
+    for bash to start. Sessions are never shared, as each one keeps the state of its user. A session left
+    idle for check_after seconds or more is checked (see ShellSession.check) before it is handed out, and
+    restarted if it does not answer within check_timeout seconds.
+    """
+    def __init__(self, size=1, check_after=60, check_timeout=5):
+        self.size = size
+        self.check_after = check_after
+        self.check_timeout = check_timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _fill(self):
+        with self._lock:
+            while len(self._idle) < self.size: self._idle.append(ShellSession())
+
+    def acquire(self):
+        session = None
+        with self._lock:
+            while self._idle and session is None:
+                session = self._idle.pop(0)
+                if not session.alive(): session = None
+        self._fill()
+        if session is None: return ShellSession()
+        if time.monotonic() - session.last_used >= self.check_after:
+            session.check(self.check_timeout)
+            session.restarted = False  # It has no state to lose yet
+        return session
+
+    def close(self):
+        with self._lock:
+            for session in self._idle: session.close()
+            self._idle = []
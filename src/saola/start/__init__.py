@@ -1,10 +1,9 @@
 from saola.convo import Convo, TitleInterface, ShellInterface, FileShowInterface, FileWriteInterface, SearchInterface, PythonInterface
 from saola.model import OpenAIModel
 from saola.ui import DefaultUI
-from rich.panel import Panel
-from rich.prompt import Prompt
-from rich import print as rprint
-from openai import OpenAI
+import hashlib
+import json
+import time
 import os
 
 # [!] Use at your own risk.
@@ -26,21 +25,60 @@ import os
 # This file is likely to experience lots of breaking changes in the future.
 # Do not have your project depend on it.
 
-def start(safety_checks=True, show_warning=True, show_model_info=False):
-    ui = DefaultUI()
-    if show_warning: ui.show_warning()
-    open_ai_api_key = os.getenv("OPENAI_API_KEY") or input("OpenAI API Key: ")
-    open_ai_api_base = os.getenv("OPENAI_API_BASE")
-    client = OpenAI(api_key=open_ai_api_key, base_url=open_ai_api_base)
-    available_model_names = [model.id for model in client.models.list()]
-    preferred_model_names = ["gpt-4-1106-preview", "gpt-4", "gpt-3.5-turbo-1106"]
+MODEL_CACHE_PATH = os.path.join(os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "saola", "models.json")
+
+def _read_model_cache(key, ttl):
+    try:
+        with open(MODEL_CACHE_PATH, "r") as f: entry = json.load(f).get(key)
+    except (OSError, ValueError):
+        return None
+    if not entry or time.time() - entry.get("time", 0) > ttl: return None
+    return entry
+
+def _write_model_cache(key, entry):
+    # The entry keeps the time its model names were listed, so that they are listed again once it is older than the ttl
+    try:
+        with open(MODEL_CACHE_PATH, "r") as f: cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    cache[key] = entry
+    try:
+        os.makedirs(os.path.dirname(MODEL_CACHE_PATH), exist_ok=True)
+        with open(MODEL_CACHE_PATH + ".tmp", "w") as f: json.dump(cache, f)
+        os.replace(MODEL_CACHE_PATH + ".tmp", MODEL_CACHE_PATH)
+    except OSError:
+        pass  # The cache is only an optimization
+
+def _resolve_model_name(client, api_key, api_base, ttl):
+    # The available models of an account are listed over the network, so they are cached for ttl seconds
+    key = hashlib.sha256(f"{api_base}\n{api_key}".encode("utf-8")).hexdigest()
+    entry = (_read_model_cache(key, ttl) if ttl else None) or {}
+    available_model_names = entry.get("available_model_names")
+    listed = available_model_names is None
+    if listed:
+        available_model_names = [model.id for model in client.models.list()]
+    preferred_model_names = ["gpt-4-1106-preview", "gpt-4", "gpt-3.5-turbo-1106", entry.get("model_name")]
     model_name = None
     for name in preferred_model_names:
         if name not in available_model_names: continue
         model_name = name
         break
     if model_name is None:
+        from rich.prompt import Prompt
         model_name = Prompt.ask("Choose an OpenAI model", choices=available_model_names)
+    if ttl and (listed or model_name != entry.get("model_name")):
+        listed_at = time.time() if listed else entry["time"]
+        _write_model_cache(key, {"available_model_names": available_model_names, "model_name": model_name, "time": listed_at})
+    return model_name
+
+def start(safety_checks=True, show_warning=True, show_model_info=False, model_cache_ttl=24 * 60 * 60):
+    from openai import OpenAI
+    ui = DefaultUI()
+    if show_warning: ui.show_warning()
+    open_ai_api_key = os.getenv("OPENAI_API_KEY") or input("OpenAI API Key: ")
+    open_ai_api_base = os.getenv("OPENAI_API_BASE")
+    client = OpenAI(api_key=open_ai_api_key, base_url=open_ai_api_base, max_retries=0)  # Retried by the model
+    model_name = _resolve_model_name(client, open_ai_api_key, open_ai_api_base, model_cache_ttl)
     if show_model_info: ui.show_info("Using OpenAI model " + model_name)
     return Convo(
         OpenAIModel(model_name, client=client),
@@ -0,0 +1,205 @@
+import os
+import json
+import mmap
+import time
+import struct
+import threading
+
+# CONVO STORES
+# ============
+# A convo is stored as an append-only log of its changes, so that saving a new bubble or a streamed
+# chunk is a single small write. The file starts with MAGIC, followed by records made of a header
+# (kind, bubble index, payload size) and a payload:
+# - BUBBLE: a bubble is created at index, with the payload [author, meta] (JSON).
+# - APPEND: the payload (UTF-8) is appended to the text of the bubble at index.
+# - SET: the text of the bubble at index is replaced with the payload (UTF-8).
+# - RSTRIP: trailing whitespace is stripped from the text of the bubble at index.
+# - META: the meta of the bubble at index is replaced with the payload (JSON).
+# - TRUNCATE: the bubbles from index on are removed.
+# - CHECKPOINTS: the checkpoints of the convo are replaced with the payload (JSON).
+# - INTERFACE: the interface block being streamed or run changed, with the payload {"name": <name>,
+#   "code": <code, or null while the block is streamed>, "approved": <bool>}, or null when there is none
+#   (JSON). It is written before the text of the chunk where the block starts or ends.
+
+MAGIC = b"SAOLA-CONVO-1\n"
+
+(BUBBLE, APPEND, SET, RSTRIP, META, TRUNCATE, CHECKPOINTS, INTERFACE) = range(1, 9)
+
+_HEADER = struct.Struct("<BII")
+
+_TEXT_EDITS = {"append": APPEND, "set": SET, "rstrip": RSTRIP}
+
+def _dump_json(value):
+    return json.dumps(value, separators=(",", ":"), default=str).encode("utf-8")
+
+class _TextLoader:
+    # Rebuilds the text of a bubble from its text records, which are only read when the text is needed
+    def __init__(self, data, edits):
+        self.data = data
+        self.edits = edits  # Triplets (kind, payload offset, payload size)
+
+    def __call__(self):
+        parts = []
+        for (kind, offset, size) in self.edits:
+            if kind == RSTRIP:
+                parts = ["".join(parts).rstrip()]
+                continue
+            text = bytes(self.data[offset:offset + size]).decode("utf-8")
+            if kind == SET: parts = []
+            parts.append(text)
+        return "".join(parts)
+
+class ConvoStore:
+    """
+    Saves a convo to the file at path, and keeps appending its changes to the file.
+
+    save(convo) writes the whole convo, replacing the file, and load(convo) replaces the bubbles and
+    checkpoints of convo with those in the file. Loading only reads the records of the file, and
+    the texts of the bubbles are read (from a memory map) when they are first accessed. Either way,
+    the changes of the convo are then appended to the file; compact() rewrites it without the
+    history of the changes.
+
+    If the process dies, loading the file recovers the convo as it was, up to the last streamed chunk,
+    along with the interface block it was streaming or about to run (so that it can be run, or its
+    stream resumed, without requesting the answer again). Every record is written to the OS as it comes,
+    which survives the process. The durability option also syncs the file to disk: "batch" does so at
+    most every sync_interval seconds, at the end of every stream and before running interfaces, and
+    "sync" does so after every record.
+    """
+    def __init__(self, path, durability="flush", sync_interval=1.0):
+        assert durability in ("flush", "batch", "sync"), f"Unknown durability: {durability}"
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.durability = durability
+        self.sync_interval = sync_interval
+        self.convo = None
+        self._file = None
+        self._last_sync = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _write(self, kind, index, payload=b""):
+        with self._lock:
+            self._file.write(_HEADER.pack(kind, index, len(payload)) + payload)
+            self._file.flush()
+            if self.durability == "sync" or (self.durability == "batch" and time.monotonic() - self._last_sync >= self.sync_interval):
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self._file.fileno())
+        self._last_sync = time.monotonic()
+
+    def sync(self):
+        with self._lock:
+            if self._file is not None: self._sync()
+
+    def stream_handler(self, author, chunk, ending):
+        # Added to the stream handlers of the convo, after the chunks are appended to its bubbles
+        if ending and self.durability != "flush": self.sync()
+
+    def _write_bubble(self, bubble):
+        self._write(BUBBLE, bubble.index, _dump_json([bubble.author, bubble.meta]))
+        if bubble.text: self._write(SET, bubble.index, bubble.text.encode("utf-8"))
+
+    def _attach(self, convo):
+        if self.convo is not None and self.convo is not convo: self.convo.store = None
+        self.convo = convo
+        convo.store = self
+
+    def save(self, convo):
+        # The convo is written to a temporary file first, so that the previous file is kept if this fails
+        if os.path.dirname(self.path): os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temporary_path = f"{self.path}.{os.getpid()}.tmp"
+        self.close()
+        self._file = open(temporary_path, "wb")
+        self._file.write(MAGIC)
+        for bubble in convo.bubbles: self._write_bubble(bubble)
+        if convo.checkpoints: self.checkpoints_changed(convo)
+        if getattr(convo, "current_matching_interface", None): self.interface_changed(convo.current_matching_interface)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(temporary_path, self.path)
+        self._file = open(self.path, "ab")
+        self._attach(convo)
+        return convo
+
+    def compact(self):
+        return self.save(self.convo)
+
+    def load(self, convo):
+        from saola.base_convo import Bubble
+        from saola.doc import Doc
+        self.close()
+        with open(self.path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+        if data[:len(MAGIC)] != MAGIC: raise ValueError(f"{self.path} is not a saved convo.")
+        bubbles = []  # Pairs ([author, meta], text edits)
+        checkpoints = []
+        interface = None
+        position = len(MAGIC)
+        end = len(data)
+        while position + _HEADER.size <= end:
+            (kind, index, size) = _HEADER.unpack_from(data, position)
+            offset = position + _HEADER.size
+            if offset + size > end: break  # A record was only partly written
+            position = offset + size
+            if kind == BUBBLE:
+                del bubbles[index:]
+                bubbles.append((json.loads(data[offset:position]), []))
+            elif kind in (APPEND, RSTRIP):
+                bubbles[index][1].append((kind, offset, size))
+            elif kind == SET:
+                bubbles[index] = (bubbles[index][0], [(kind, offset, size)])
+            elif kind == META:
+                bubbles[index][0][1] = json.loads(data[offset:position])
+            elif kind == TRUNCATE:
+                del bubbles[index:]
+            elif kind == CHECKPOINTS:
+                checkpoints = json.loads(data[offset:position])
+            elif kind == INTERFACE:
+                interface = json.loads(data[offset:position])
+        convo.store = None
+        convo.bubbles = []
+        convo.checkpoints = checkpoints
+        convo._message_groups = []
+        convo._dirty_bubbles = set()
+        for ((author, meta), edits) in bubbles:
+            bubble = Bubble(author, convo, meta=meta)
+            if edits: bubble.doc = Doc(on_change=bubble._doc_changed, loader=_TextLoader(data, edits))
+        if interface is not None and hasattr(convo, "_restore_interface"): convo._restore_interface(interface)
+        # Records cut short by a crash are dropped before appending new ones
+        self._file = open(self.path, "r+b")
+        self._file.truncate(position)
+        self._file.seek(position)
+        self._attach(convo)
+        return convo
+
+    def close(self):
+        if self._file is not None: self._file.close()
+        self._file = None
+        if self.convo is not None: self.convo.store = None
+        self.convo = None
+
+    # Called by the convo and its bubbles
+    def bubble_created(self, bubble):
+        self._write_bubble(bubble)
+
+    def bubble_edited(self, bubble, kind, value):
+        self._write(_TEXT_EDITS[kind], bubble.index, value.encode("utf-8") if value else b"")
+
+    def meta_changed(self, bubble):
+        self._write(META, bubble.index, _dump_json(bubble.meta))
+
+    def bubbles_truncated(self, num_bubbles):
+        self._write(TRUNCATE, num_bubbles)
+
+    def bubbles_replaced(self, convo, start):
+        self.bubbles_truncated(start)
+        for bubble in convo.bubbles[start:]: self._write_bubble(bubble)
+
+    def checkpoints_changed(self, convo):
+        self._write(CHECKPOINTS, 0, _dump_json(convo.checkpoints))
+
+    def interface_changed(self, interface):
+        record = None if interface is None else {"name": interface.name, "code": interface.current_code, "approved": interface.approved}
+        self._write(INTERFACE, 0, _dump_json(record))
+        if self.durability == "batch": self.sync()
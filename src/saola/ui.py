@@ -1,13 +1,12 @@
 import abc
 import os
-from rich.panel import Panel
-from rich import print as rprint
-from rich.markup import escape
-from rich.prompt import Confirm
+import sys
 from uuid import uuid4
 from saola.utils import _is_notebook
 import saola
 import time
+import threading
+import asyncio
 
 
 # TODO: Make it so that stale conversation messages are clearly marked stale.
@@ -20,6 +19,10 @@ class UI(abc.ABC):
     def display_interface_output(self, interface, output):
         # Displays an interface's output to the user.
         pass
+    def append_to_interface_output(self, interface, stream_name, text):
+        # Appends text printed (to "stdout" or "stderr") by an interface while it runs.
+        sys.stdout.write(text)
+        sys.stdout.flush()
     def safety_confirmation(self, name, confirmation_title):
         # Asks the user a yes/no question and returns the answer.
         pass
@@ -54,6 +57,9 @@ class ShellUI(UI):
         # rprint(Panel("[bright_magenta]" + escape(output) + "[/bright_magenta]", border_style="bright_magenta"))
 
     def safety_confirmation(self, name, confirmation_title):
+        from rich.panel import Panel
+        from rich.prompt import Confirm
+        from rich import print as rprint
         print("")
         rprint(Panel("[red1] SAFETY CHECK [/red1]", border_style="red1"))
         return Confirm.ask(f"[red1] Execute {name} code? [/red1]")
@@ -63,6 +69,8 @@ class ShellUI(UI):
         return True 
 
     def display_user_header(self):
+        from rich.panel import Panel
+        from rich import print as rprint
         rprint(Panel("[bold green]USER (enter your question below)[/bold green]"))
 
     def supports_synchronous_user_input(self):
@@ -72,12 +80,16 @@ class ShellUI(UI):
         return input("")
 
     def display_assistant_header(self):
+        from rich.panel import Panel
+        from rich import print as rprint
         rprint(Panel("[bold blue]ASSISTANT[/bold blue]"))
 
     def append_to_assistant_output(self, author, chunk, ending):
         print(chunk or "", end="\n" if ending else "")
 
     def show_warning(self, text=None):
+        from rich.panel import Panel
+        from rich import print as rprint
         if text is None:
             rprint(Panel("[red1] [!] This assistant will be able to execute commands\n" +
                         "    on your shell when prompted. You will be asked to\n" +
@@ -88,6 +100,8 @@ class ShellUI(UI):
             rprint(Panel("[red1] " + text + "[/red1]", border_style="red1"))
         
     def show_info(self, text):
+        from rich.panel import Panel
+        from rich import print as rprint
         rprint(Panel(text))
 
 
@@ -690,5 +704,74 @@ class NotebookUI(UI):
         """))
 
 
+class NetworkUI(UI):
+    # Turns every UI call into a JSON-serializable event in the events queue, to be sent to a remote client.
+    # At most max_pending_chunks chunks of the assistant's output may be waiting to be sent, so that a slow
+    # client only slows down its own conversation. Must be created within the event loop of the convo.
+    def __init__(self, max_pending_chunks=256):
+        self.events = asyncio.Queue()
+        self.closed = False
+        self._max_pending_chunks = max_pending_chunks
+        self._pending_chunks = asyncio.Semaphore(max_pending_chunks)
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+
+    def emit(self, type, **kwargs):
+        # May be called from the event loop or from the threads where interfaces are executed
+        event = dict(type=type, **kwargs)
+        if threading.get_ident() == self._loop_thread:
+            self.events.put_nowait(event)
+        else:
+            self._loop.call_soon_threadsafe(self.events.put_nowait, event)
+
+    def chunk_sent(self):
+        self._pending_chunks.release()
+
+    def close(self):
+        # Unblocks the convo if it is waiting for the client, which makes it fail on its next chunk
+        self.closed = True
+        for _ in range(self._max_pending_chunks): self._pending_chunks.release()
+
+    def will_begin_interface_output(self, interface):
+        self.emit("interface_begin", interface=interface.name)
+
+    def display_interface_output(self, interface, output):
+        self.emit("interface_output", interface=interface.name, output=output)
+
+    def append_to_interface_output(self, interface, stream_name, text):
+        self.emit("interface_chunk", interface=interface.name, stream=stream_name, text=text)
+
+    def safety_confirmation(self, name, confirmation_title):
+        # Like the NotebookUI, the confirmation arrives later as a separate user input (see saola.serve)
+        self.emit("confirmation", interface=name, title=confirmation_title)
+        return None
+
+    def no_safety_confirmation(self):
+        return True
+
+    def display_user_header(self):
+        self.emit("ready")
+
+    def supports_synchronous_user_input(self):
+        return False
+
+    def get_user_input(self):
+        raise NotImplementedError("The Network UI does not support synchronous user input.")
+
+    def display_assistant_header(self):
+        self.emit("assistant")
+
+    async def append_to_assistant_output(self, author, chunk, ending):
+        await self._pending_chunks.acquire()
+        if self.closed: raise ConnectionResetError("The client of this conversation is gone.")
+        self.emit("chunk", text=chunk or "", ending=ending)
+
+    def show_warning(self, text=None):
+        self.emit("warning", text=text)
+
+    def show_info(self, text=None):
+        self.emit("info", text=text)
+
+
 DefaultUI = NotebookUI if _is_notebook() else ShellUI
     
\ No newline at end of file
@@ -1,3 +1,6 @@
+import os
+import getpass
+
 def _is_notebook() -> bool:
     try:
         shell = get_ipython().__class__.__name__  # type: ignore
@@ -8,4 +11,20 @@ def _is_notebook() -> bool:
         else:
             return False  # Other type (?)
     except NameError:
-        return False      # Probably standard Python interpreter
\ No newline at end of file
+        return False      # Probably standard Python interpreter
+
+def _get_username():
+    try:
+        return os.getlogin()
+    except OSError:
+        return getpass.getuser()  # No controlling terminal (e.g. services and containers)
+
+class _lazy_class_attribute:
+    # A class attribute computed by the decorated function on first access, instead of at import time
+    def __init__(self, function):
+        self.function = function
+        self.values = {}
+
+    def __get__(self, instance, owner):
+        if owner not in self.values: self.values[owner] = self.function(owner)
+        return self.values[owner]
@@ -0,0 +1,30 @@
+import pytest
+from saola.model import Model
+from saola.ui import UI
+
+class QuietUI(UI):
+    # Runs interface code without asking, and displays nothing
+    def no_safety_confirmation(self):
+        return True
+
+    def safety_confirmation(self, name, confirmation_title):
+        return True
+
+    def append_to_interface_output(self, interface, stream_name, text):
+        pass
+
+class ScriptedModel(Model):
+    # Streams the given answers in order, each one as a list of chunks (or a string, streamed as one chunk)
+    def __init__(self, *answers):
+        self.answers = list(answers)
+        self.requests = []
+
+    def _stream_answer_nonstop(self, messages):
+        self.requests.append(messages)
+        answer = self.answers.pop(0) if self.answers else "done"
+        for chunk in ([answer] if isinstance(answer, str) else answer):
+            yield ("assistant", chunk)
+
+@pytest.fixture
+def quiet_ui():
+    return QuietUI()
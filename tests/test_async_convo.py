@@ -0,0 +1,59 @@
+import asyncio
+import threading
+from saola.convo import AsyncConvo
+from saola.model import AsyncModel
+from test_matcher import EchoInterface
+from test_parallel import PendingUI
+
+class AsyncChunkedModel(AsyncModel):
+    # Streams the given answers in order, each one as a list of chunks
+    def __init__(self, *answers):
+        self.answers = list(answers)
+        self.requests = []
+
+    async def _stream_answer_nonstop(self, messages):
+        self.requests.append(messages)
+        for chunk in (self.answers.pop(0) if self.answers else ["done"]):
+            await asyncio.sleep(0)
+            yield ("assistant", chunk)
+
+class ThreadEchoInterface(EchoInterface):
+    def execute(self, code):
+        self.convo.threads.append(threading.current_thread())
+        return super().execute(code)
+
+ANSWER = ["Let me check.\n[__EC", "HO__]\nhi\n[/__", "ECHO__]\nignored"]
+
+def make_convo(model, ui):
+    convo = AsyncConvo(model, ui=ui, interfaces=[ThreadEchoInterface])
+    convo.executed = []
+    convo.threads = []
+    convo.user << "go"
+    return convo
+
+def test_stream_answer_runs_the_block_and_streams_the_answer_to_its_output(quiet_ui):
+    model = AsyncChunkedModel(ANSWER, ["All", " good."])
+    convo = make_convo(model, quiet_ui)
+    async def main():
+        return [(bubble.author, chunk) async for (bubble, chunk) in convo.stream_answer()]
+    streamed = asyncio.run(main())
+    # The stream stops at the end of the block, whose output is appended before the next answer
+    assert [b.author for b in convo.bubbles] == ["system", "user", "assistant", "assistant", "assistant"]
+    assert convo.bubbles[2].text == "Let me check.\n[__ECHO__]\nhi\n[/__ECHO__]"
+    assert convo.bubbles[3].text == "-- OUTPUT --\necho: hi\n-- END OUTPUT --"
+    assert convo.bubbles[4].text == "All good."
+    assert ("assistant", " good.") in streamed
+    assert convo.executed == ["\nhi\n"]
+    # The block ran in the default executor, off the thread of the event loop
+    assert convo.threads and convo.threads[0] is not threading.main_thread()
+    assert len(model.requests) == 2 and model.requests[1][-1]["content"].endswith(convo.bubbles[3].text)
+    assert convo.ready_for_user_input()
+
+def test_append_user_input_runs_a_block_once_it_is_confirmed():
+    model = AsyncChunkedModel(ANSWER, ["All good."])
+    convo = make_convo(model, PendingUI())
+    asyncio.run(convo.stream_answer_to_end())
+    assert convo.executed == [] and not convo.ready_for_user_input()
+    asyncio.run(convo.append_user_input(True))
+    assert convo.executed == ["\nhi\n"] and convo.bubbles[-1].text == "All good."
+    assert len(model.requests) == 2
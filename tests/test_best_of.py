@@ -0,0 +1,44 @@
+import asyncio
+from saola.convo import Convo, AsyncConvo
+from saola.model import AsyncModel
+from saola.best_of import BestOf
+from conftest import ScriptedModel
+from test_matcher import EchoInterface
+
+ANSWERS = ["Short.\n[__ECHO__]\nshort\n[/__ECHO__]\n", "A longer answer.\n[__ECHO__]\nlong\n[/__ECHO__]\n"]
+
+def scorer(fork):
+    return len(fork.bubbles[-1].text)
+
+def make_convo(convo_class, model, ui):
+    convo = convo_class(model, ui=ui, interfaces=[EchoInterface])
+    convo.executed = []  # Shared by the forks, which are shallow copies
+    convo.user << "hi"
+    return convo
+
+def test_only_the_blocks_of_the_winner_run_once_adopted(quiet_ui):
+    convo = make_convo(Convo, ScriptedModel(*ANSWERS, "After the output."), quiet_ui)
+    best_of = BestOf(convo, 2, scorer)
+    streamed = list(best_of.stream())
+    assert convo.executed == ["\nlong\n"]
+    assert [b.text for b in convo.bubbles[-3:]] == [
+        "A longer answer.\n[__ECHO__]\nlong\n[/__ECHO__]",
+        "-- OUTPUT --\necho: long\n-- END OUTPUT --",
+        "After the output."
+    ]
+    assert (best_of.winner, convo.bubbles[-1], "After the output.") in streamed
+    assert all(fork.executed is convo.executed and fork.current_matching_interface is not None for fork in best_of.forks)
+
+class AsyncScriptedModel(AsyncModel):
+    def __init__(self, *answers):
+        self.answers = list(answers)
+
+    async def _stream_answer_nonstop(self, messages):
+        yield ("assistant", self.answers.pop(0) if self.answers else "done")
+
+def test_async_forks_leave_the_blocks_to_the_adopting_convo(quiet_ui):
+    convo = make_convo(AsyncConvo, AsyncScriptedModel(*ANSWERS, "After the output."), quiet_ui)
+    best_of = BestOf(convo, 2, scorer)
+    asyncio.run(best_of.astream_to_end())
+    assert convo.executed == ["\nlong\n"]
+    assert convo.bubbles[-1].text == "After the output."
@@ -0,0 +1,43 @@
+from saola.cache import ResponseCache, CachedModel
+from conftest import ScriptedModel
+
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+def test_replay_of_a_stopped_stream_continues_the_replayed_answer():
+    model = ScriptedModel(["Hello ", "wor", "ld"], ["ld!"])
+    cached = CachedModel(model)
+    stream = cached._stream_answer_nonstop(MESSAGES)
+    assert [next(stream), next(stream)] == [("assistant", "Hello "), ("assistant", "wor")]
+    stream.close()
+    chunks = [chunk for (_, chunk) in cached._stream_answer_nonstop(MESSAGES)]
+    assert chunks == ["Hello ", "wor", "ld!"]
+    assert model.requests[1] == MESSAGES + [{"role": "assistant", "content": "Hello wor"}]
+    assert [chunk for (_, chunk) in cached._stream_answer_nonstop(MESSAGES)] == chunks
+    assert len(model.requests) == 2
+
+def disk_keys(cache):
+    return [key for (key,) in cache._db.execute("SELECT key FROM entries ORDER BY accessed")]
+
+def test_least_recently_used_values_are_evicted_from_disk(tmp_path):
+    cache = ResponseCache(path=tmp_path / "cache.sqlite", max_disk_bytes=30)
+    for key in "abc":
+        cache.put(key, "x" * 8)  # 10 bytes once serialized
+    cache.get("a")  # A memory hit, refreshing the access time of "a" on disk
+    cache.put("d", "x" * 8)
+    assert disk_keys(cache) == ["c", "a", "d"]
+    assert cache._disk_size == 30
+    cache.put("c", "x" * 18)
+    assert disk_keys(cache) == ["d", "c"]
+    cache.close()
+    reopened = ResponseCache(path=tmp_path / "cache.sqlite", max_disk_bytes=30)
+    assert (reopened._disk_size, reopened.get("c")) == (30, "x" * 18)
+
+def test_memory_hits_are_written_to_disk_in_batches(tmp_path):
+    cache = ResponseCache(path=tmp_path / "cache.sqlite")
+    cache.touch_batch = 2
+    for key in "abc":
+        cache.put(key, key)
+    cache.get("a")
+    assert disk_keys(cache) == ["a", "b", "c"]
+    cache.get("b")
+    assert disk_keys(cache) == ["c", "a", "b"]
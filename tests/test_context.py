@@ -0,0 +1,73 @@
+import random
+from saola.base_convo import BaseConvo
+from saola.context import ContextManager, _merge_into_messages
+
+def rebuilt_messages(context_manager, convo):
+    # The messages fit from scratch, counting and replacing the texts of all the bubbles
+    tokens = [context_manager.count_tokens(b.text) + context_manager.message_overhead for b in convo.bubbles]
+    total = sum(tokens)
+    texts = [b.text for b in convo.bubbles]
+    pinned = context_manager.pinned(convo)
+    for policy in context_manager.policies:
+        if total <= context_manager.max_tokens: break
+        total = policy(convo, texts, tokens, pinned, total)
+    return _merge_into_messages([(b.author, t) for (b, t) in zip(convo.bubbles, texts) if t is not None])
+
+def test_under_budget_messages_are_kept():
+    convo = BaseConvo(context_manager=ContextManager(max_tokens=1000))
+    convo.system << "system"
+    convo.user << "hello"
+    messages = convo.messages
+    assert messages == [{'role': 'system', 'content': 'system'}, {'role': 'user', 'content': 'hello'}]
+    assert convo._token_tally.total == sum(convo._token_tally.counts) == 2 * (2 + 4)
+
+def test_total_follows_edits_rollbacks_and_forks():
+    context_manager = ContextManager(max_tokens=10 ** 6)
+    convo = BaseConvo(context_manager=context_manager)
+    convo.user << "one two three"
+    convo.checkpoint()
+    bubble = convo.assistant << "four"
+    convo.messages
+    bubble.doc.append(" five six seven")
+    convo.messages
+    assert convo._token_tally.total == sum(context_manager.bubble_tokens(b) for b in convo.bubbles)
+    fork = convo.fork()
+    fork.assistant << "a much longer answer in the fork"
+    fork.messages
+    convo.rollback()
+    convo.messages
+    assert convo._token_tally.counts == [context_manager.bubble_tokens(convo.bubbles[0])]
+    convo.adopt(fork)
+    convo.messages
+    assert convo._token_tally.total == sum(context_manager.bubble_tokens(b) for b in convo.bubbles)
+
+def test_over_budget_messages_match_a_full_rebuild():
+    rng = random.Random(0)
+    for _ in range(50):
+        context_manager = ContextManager(max_tokens=rng.randint(20, 300), keep_recent_turns=rng.randint(1, 3))
+        convo = BaseConvo(context_manager=context_manager)
+        convo.system << "system prompt"
+        for _ in range(40):
+            op = rng.random()
+            if op < 0.3: convo.user << "user " * rng.randint(1, 20)
+            elif op < 0.55: convo.assistant << "answer " * rng.randint(1, 20)
+            elif op < 0.8: convo.bubble_maker("assistant", meta={"interface": "SHELL"}) << "output " * rng.randint(1, 60)
+            elif op < 0.9: convo.checkpoint()
+            elif convo.checkpoints: convo.rollback()
+            assert convo.messages == rebuilt_messages(context_manager, convo)
+
+def test_outputs_of_a_single_long_turn_are_hidden():
+    context_manager = ContextManager(max_tokens=200)
+    convo = BaseConvo(context_manager=context_manager)
+    convo.system << "system prompt"
+    convo.user << "Find the bug."
+    for i in range(10):
+        convo.assistant << f"Running command {i}."
+        convo.bubble_maker("assistant", meta={"interface": "SHELL"}) << f"output {i} " * 50
+    messages = convo.messages
+    assert sum(context_manager.count_tokens(m["content"]) + context_manager.message_overhead for m in messages) <= 200
+    # The user message and the latest output are kept, while the earlier outputs of the turn make room
+    assert [m["content"] for m in messages[:2]] == ["system prompt", "Find the bug."]
+    assert messages[-1]["content"].endswith(convo.bubbles[-1].text)
+    assert not any(f"output {i}" in m["content"] for m in messages for i in range(9))
+    assert messages == rebuilt_messages(context_manager, convo)
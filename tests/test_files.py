@@ -0,0 +1,67 @@
+import os
+from saola.convo import Convo, FileWriteInterface
+from saola.files import replace_lines
+from conftest import ScriptedModel
+
+def write_lines(path, num_lines):
+    path.write_text(os.linesep.join(f"line {i}" for i in range(1, num_lines + 1)))
+
+def file_write(path, line_range, contents, ui, **options):
+    convo = Convo(ScriptedModel(), ui=ui, interface_options={"FILE_WRITE": options})
+    return FileWriteInterface(convo).execute(f"{path}\n{line_range}\n{contents}")
+
+def test_replace_lines_returns_where_the_text_starts(tmp_path):
+    path = tmp_path / "file.txt"
+    write_lines(path, 5)
+    assert replace_lines(str(path), 2, 3, "two\nthree") == (2, ["line 2", "line 3"])
+    assert replace_lines(str(path), 9, 10, "six") == (6, [])
+    assert path.read_text().split("\n")[4:] == ["line 5", "six"]
+    assert replace_lines(str(tmp_path / "new.txt"), 3, 3, "one") == (1, [])
+
+def test_window_shows_the_diff_and_the_lines_around_it(tmp_path, quiet_ui):
+    path = tmp_path / "file.txt"
+    write_lines(path, 100)
+    output = file_write(path, "50-51", "fifty\nfifty-one\nextra", quiet_ui, max_lines=10, context_lines=2)
+    assert output == os.linesep.join([
+        f"File written to {path} with the changes below:",
+        f"--- {path}",
+        f"+++ {path}",
+        "@@ -50,2 +50,3 @@",
+        "-line 50",
+        "-line 51",
+        "+fifty",
+        "+fifty-one",
+        "+extra",
+        "Lines 48-54 of 101 of the file (shown below with line numbers):",
+        "48  line 48",
+        "49  line 49",
+        "50  fifty",
+        "51  fifty-one",
+        "52  extra",
+        "53  line 52",
+        "54  line 53",
+    ])
+
+def test_window_of_lines_written_past_the_end_of_the_file(tmp_path, quiet_ui):
+    path = tmp_path / "file.txt"
+    write_lines(path, 20)
+    output = file_write(path, "500-500", "new 1\nnew 2", quiet_ui, max_lines=10, context_lines=2)
+    assert output == os.linesep.join([
+        f"File written to {path} with the changes below:",
+        f"--- {path}",
+        f"+++ {path}",
+        "@@ -20,0 +21,2 @@",
+        "+new 1",
+        "+new 2",
+        "Lines 19-22 of 22 of the file (shown below with line numbers):",
+        "19  line 19",
+        "20  line 20",
+        "21  new 1",
+        "22  new 2",
+    ])
+
+def test_short_files_are_shown_whole(tmp_path, quiet_ui):
+    path = tmp_path / "file.txt"
+    write_lines(path, 3)
+    output = file_write(path, "9-9", "four", quiet_ui)
+    assert output == f"File written to {path} (shown below with line numbers):" + os.linesep + "1  line 1\n2  line 2\n3  line 3\n4  four"
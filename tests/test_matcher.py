@@ -0,0 +1,77 @@
+import random
+import pytest
+from saola.convo import Convo, Interface, TitleInterface
+from conftest import ScriptedModel
+
+class EchoInterface(Interface):
+    name = "ECHO"
+    explanation = ""
+
+    def execute(self, code):
+        self.convo.executed.append(code)
+        return f"echo: {code.strip()}"
+
+def answer(chunks, ui, interfaces=(TitleInterface, EchoInterface)):
+    convo = Convo(ScriptedModel(chunks, "done"), ui=ui, interfaces=list(interfaces))
+    convo.executed = []
+    convo.user << "hi"
+    convo.stream_answer_to_end()
+    return convo
+
+def split(text, sizes):
+    chunks = []
+    while text:
+        size = next(sizes)
+        chunks.append(text[:size])
+        text = text[size:]
+    return chunks
+
+ANSWER = "Let me check.\n[__ECHO__]\nsome code\n[/__ECHO__]\nThis is never streamed."
+
+def test_block_in_one_chunk(quiet_ui):
+    convo = answer([ANSWER], quiet_ui)
+    assert convo.executed == ["\nsome code\n"]
+    assert convo.bubbles[-3].text == "Let me check.\n[__ECHO__]\nsome code\n[/__ECHO__]"
+    assert convo.bubbles[-2].text == "-- OUTPUT --\necho: some code\n-- END OUTPUT --"
+    assert convo.bubbles[-1].text == "done"
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 7, 11])
+def test_block_split_across_chunks(quiet_ui, size):
+    chunks = [ANSWER[i:i + size] for i in range(0, len(ANSWER), size)]
+    convo = answer(chunks, quiet_ui)
+    assert convo.executed == ["\nsome code\n"]
+    assert convo.bubbles[-3].text == "Let me check.\n[__ECHO__]\nsome code\n[/__ECHO__]"
+
+def test_random_chunkings_match_the_same_blocks(quiet_ui):
+    text = "[__TITLE__] Echo [/__TITLE__]\n[__ECHO__]\na[__ECHO__]b\n[/__ECHO__]\nafter"
+    expected = answer([text], quiet_ui)
+    rng = random.Random(0)
+    for _ in range(200):
+        convo = answer(split(text, iter(lambda: rng.randint(1, 6), None)), quiet_ui)
+        assert convo.executed == expected.executed == ["\na[__ECHO__]b\n"]
+        assert [b.text for b in convo.bubbles] == [b.text for b in expected.bubbles]
+
+def test_start_pattern_must_begin_a_line(quiet_ui):
+    convo = answer(["Not a block: [__ECHO__]\nx\n[/__ECHO__]\n"], quiet_ui)
+    assert convo.executed == []
+    assert len(convo.bubbles) == 3
+
+def test_start_pattern_after_newline_in_previous_chunk(quiet_ui):
+    convo = answer(["text\n", "[__EC", "HO__]x[/__ECHO", "__]\n"], quiet_ui)
+    assert convo.executed == ["x"]
+
+def test_block_cut_short_at_end_of_stream_does_not_run(quiet_ui):
+    convo = answer(["[__ECHO__]\nunfinished"], quiet_ui)
+    assert convo.executed == []
+    assert convo.current_matching_interface is None
+    assert convo.bubbles[-1].text == "[__ECHO__]\nunfinished"
+
+def test_end_pattern_needs_a_line_break(quiet_ui):
+    # The end pattern includes the line break, which may arrive as the end of the stream
+    convo = answer(["[__ECHO__]\nx\n[/__ECHO__]"], quiet_ui)
+    assert convo.executed == ["\nx\n"]
+
+def test_title_runs_without_interrupting_the_stream(quiet_ui):
+    convo = answer(["[__TITLE__] Do It [/__TITLE__]\nand more text"], quiet_ui)
+    assert convo.bubbles[-1].text == "[__TITLE__] Do It [/__TITLE__]\nand more text"
+    assert convo.next_interface_title == "Do It"
@@ -0,0 +1,56 @@
+from types import SimpleNamespace
+import pytest
+from saola.model import OpenAIModel
+
+class Dropped(ConnectionError):
+    pass
+
+def chunk(text):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(role=None, content=text))])
+
+class FakeClient:
+    # Streams the given responses in order, each a list of texts, where a Dropped instance fails the stream
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+        self.chat = self.completions = self
+
+    def create(self, model, messages, stream):
+        self.requests.append(messages)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception): raise response
+        def stream():
+            for text in response:
+                if isinstance(text, Exception): raise text
+                yield chunk(text)
+        return stream()
+
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+def test_failed_request_is_retried_as_it_was():
+    client = FakeClient(Dropped(), ["Hello"])
+    model = OpenAIModel("model", client=client, backoff=0)
+    assert list(model._stream_answer_nonstop(MESSAGES)) == [("assistant", "Hello")]
+    assert client.requests == [MESSAGES, MESSAGES]
+    assert model.retries == 1
+
+@pytest.mark.parametrize("deadlines", [{}, {"first_token_timeout": 5, "chunk_timeout": 5}])
+def test_stream_failing_midway_continues_the_partial_answer(deadlines):
+    client = FakeClient(["Hello ", "wor", Dropped()], ["ld!"])
+    model = OpenAIModel("model", client=client, backoff=0, **deadlines)
+    chunks = [chunk for (_, chunk) in model._stream_answer_nonstop(MESSAGES)]
+    assert chunks == ["Hello ", "wor", "ld!"]
+    assert client.requests[1] == MESSAGES + [{"role": "assistant", "content": "Hello wor"}]
+
+def test_stream_failing_midway_fails_without_continue_streams():
+    client = FakeClient(["Hello ", Dropped()], ["ignored"])
+    model = OpenAIModel("model", client=client, backoff=0, continue_streams=False)
+    with pytest.raises(Dropped):
+        list(model._stream_answer_nonstop(MESSAGES))
+    assert len(client.requests) == 1
+
+def test_errors_that_are_not_transient_are_raised():
+    client = FakeClient(ValueError("bad request"))
+    model = OpenAIModel("model", client=client, backoff=0)
+    with pytest.raises(ValueError):
+        list(model._stream_answer_nonstop(MESSAGES))
@@ -0,0 +1,60 @@
+from saola.convo import Convo, FileShowInterface, FileWriteInterface
+from conftest import ScriptedModel
+from test_matcher import EchoInterface
+
+LONG_OUTPUT = "Traceback (most recent call last):\n" + "  some frame\n" * 20
+
+def make_convo(ui):
+    return Convo(ScriptedModel(), ui=ui, interfaces=[EchoInterface, FileShowInterface, FileWriteInterface])
+
+def append_output(convo, interface_class, output, file_path=None):
+    convo.assistant << "Running it."
+    convo.current_streaming_bubble = convo.bubbles[-1]
+    interface = interface_class(convo)
+    if file_path: interface.meta['file_path'] = file_path
+    convo._append_interface_output(interface, output)
+    return convo.bubbles[-1]
+
+def test_repeated_and_superseded_outputs_point_to_the_later_one(quiet_ui):
+    convo = make_convo(quiet_ui)
+    first = append_output(convo, EchoInterface, LONG_OUTPUT)
+    shown = append_output(convo, FileShowInterface, "File a.txt:\n1  a", file_path="/a.txt")
+    written = append_output(convo, FileWriteInterface, "File written to a.txt:\n1  b", file_path="/a.txt")
+    repeated = append_output(convo, EchoInterface, LONG_OUTPUT)
+    assert convo.bubbles[first.index].text == f"[OUTPUT HIDDEN: repeated in the output in bubble {repeated.index}]"
+    assert convo.bubbles[shown.index].text == f"[OUTPUT HIDDEN: superseded by the output in bubble {written.index}]"
+    assert convo.outputs.hidden == 2 and convo.outputs.tokens_saved > 0
+    assert convo.bubbles[repeated.index].text == "-- OUTPUT --\n" + LONG_OUTPUT + "\n-- END OUTPUT --"
+
+def test_rollback_brings_back_the_hidden_outputs(quiet_ui):
+    convo = make_convo(quiet_ui)
+    first = append_output(convo, EchoInterface, LONG_OUTPUT)
+    shown = append_output(convo, FileShowInterface, "File a.txt:\n1  a", file_path="/a.txt")
+    (first_text, shown_text) = (first.text, shown.text)
+    convo.checkpoint()
+    append_output(convo, FileWriteInterface, "File written to a.txt:\n1  b", file_path="/a.txt")
+    append_output(convo, EchoInterface, LONG_OUTPUT)
+    assert convo.outputs.hidden == 2
+    convo.rollback()
+    assert [convo.bubbles[first.index].text, convo.bubbles[shown.index].text] == [first_text, shown_text]
+    assert (convo.outputs.hidden, convo.outputs.tokens_saved) == (0, 0)
+    assert "cleaned_up" not in convo.bubbles[first.index].meta
+    # The index is back as it was, so new outputs hide the ones before the checkpoint again
+    repeated = append_output(convo, EchoInterface, LONG_OUTPUT)
+    assert convo.bubbles[first.index].text == f"[OUTPUT HIDDEN: repeated in the output in bubble {repeated.index}]"
+
+def test_rollback_forgets_the_outputs_after_the_checkpoint(quiet_ui):
+    convo = make_convo(quiet_ui)
+    convo.user << "hi"
+    convo.checkpoint()
+    append_output(convo, EchoInterface, LONG_OUTPUT)
+    convo.rollback()
+    assert convo.outputs._latest == {} and convo.outputs._changes == []
+    append_output(convo, EchoInterface, LONG_OUTPUT)
+    assert convo.outputs.hidden == 0
+
+def test_short_outputs_are_not_hidden_when_repeated(quiet_ui):
+    convo = make_convo(quiet_ui)
+    first = append_output(convo, EchoInterface, "ok")
+    append_output(convo, EchoInterface, "ok")
+    assert convo.bubbles[first.index].text == "-- OUTPUT --\nok\n-- END OUTPUT --"
@@ -0,0 +1,80 @@
+import time
+import threading
+from saola.convo import Convo, Interface
+from conftest import QuietUI, ScriptedModel
+
+class WaitInterface(Interface):
+    # A pure block "<seconds>" waiting that long (or at the barrier of the convo, if any) before answering
+    name = "WAIT"
+    explanation = ""
+    pure = True
+    safety_checks = False
+
+    def execute(self, code):
+        if getattr(self.convo, "barrier", None): self.convo.barrier.wait()
+        time.sleep(float(code))
+        self.convo.ran.append(("WAIT", code.strip()))
+        return f"waited {code.strip()}"
+
+class WriteInterface(Interface):
+    # A block with side effects, which needs a confirmation
+    name = "WRITE"
+    explanation = ""
+
+    def execute(self, code):
+        self.convo.ran.append(("WRITE", code.strip()))
+        return f"wrote {code.strip()}"
+
+class PendingUI(QuietUI):
+    # Leaves confirmations pending, as the NotebookUI and NetworkUI do
+    def safety_confirmation(self, name, confirmation_title):
+        self.asked = getattr(self, "asked", []) + [name]
+        return None
+
+def block(name, code):
+    return f"[__{name}__]\n{code}\n[/__{name}__]\n"
+
+def make_convo(answer, ui):
+    model = ScriptedModel(answer, "Thanks.")
+    convo = Convo(model, ui=ui, interfaces=[WaitInterface, WriteInterface], parallel_interfaces=True)
+    convo.ran = []
+    convo.user << "go"
+    return (convo, model)
+
+def output_texts(convo):
+    return [b.text for b in convo.bubbles if b.text.startswith("-- OUTPUT --")]
+
+def test_consecutive_pure_blocks_run_at_once(quiet_ui):
+    (convo, _) = make_convo("Checking.\n" + block("WAIT", "0") + block("WAIT", "0") + block("WAIT", "0"), quiet_ui)
+    # Each block waits for the two others, which fails (after the timeout) unless they run at once
+    convo.barrier = threading.Barrier(3, timeout=5)
+    convo.stream_answer_to_end()
+    assert convo.ran == [("WAIT", "0")] * 3
+
+def test_outputs_are_appended_in_block_order_with_one_follow_up_request(quiet_ui):
+    answer = "Checking.\n" + block("WAIT", "0.3") + block("WAIT", "0.1") + block("WAIT", "0.2") + "Done checking."
+    (convo, model) = make_convo(answer, quiet_ui)
+    start = time.monotonic()
+    convo.stream_answer_to_end()
+    assert time.monotonic() - start < 0.55
+    assert [code for (_, code) in convo.ran] == ["0.1", "0.2", "0.3"]  # The order they finished in
+    assert output_texts(convo) == [f"-- OUTPUT --\nwaited {code}\n-- END OUTPUT --" for code in ["0.3", "0.1", "0.2"]]
+    assert len(model.requests) == 2
+    assert convo.bubbles[-1].text == "Thanks."
+
+def test_queued_blocks_run_once_a_pending_confirmation_arrives():
+    ui = PendingUI()
+    (convo, model) = make_convo(block("WAIT", "0") + block("WRITE", "a") + block("WAIT", "0.01") + block("WRITE", "b"), ui)
+    convo.stream_answer_to_end()
+    # The blocks before the pending one ran, and those after it wait with it
+    assert convo.ran == [("WAIT", "0")]
+    assert convo.current_matching_interface.current_code.strip() == "a"
+    assert [i.current_code.strip() for i in convo.queued_interfaces] == ["0.01", "b"]
+    assert len(model.requests) == 1
+    convo.append_user_input(True)
+    assert convo.ran == [("WAIT", "0"), ("WRITE", "a"), ("WAIT", "0.01")]
+    assert convo.current_matching_interface.current_code.strip() == "b"
+    convo.append_user_input(True)
+    assert convo.ran[-1] == ("WRITE", "b") and set(ui.asked) == {"WRITE"}
+    assert output_texts(convo) == ["-- OUTPUT --\n" + text + "\n-- END OUTPUT --" for text in ["waited 0", "wrote a", "waited 0.01", "wrote b"]]
+    assert len(model.requests) == 2 and convo.bubbles[-1].text == "Thanks."
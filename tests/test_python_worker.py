@@ -0,0 +1,67 @@
+import time
+from saola.python_worker import PythonWorker, PythonNamespace
+
+def test_namespace_persists_between_executions():
+    worker = PythonWorker(preload=[])
+    try:
+        worker.run("x = 41")
+        result = worker.run("print(x + 1)")
+        assert (result.stdout, result.error) == ("42\n", None)
+    finally:
+        worker.close()
+
+def test_execution_is_interrupted_at_its_timeout_and_keeps_the_namespace():
+    worker = PythonWorker(preload=[])
+    try:
+        worker.run("x = 1")
+        start = time.monotonic()
+        result = worker.run("import time\nprint('started')\ntime.sleep(10)", timeout=0.5)
+        assert time.monotonic() - start < 5
+        assert (result.stdout, result.timeout) == ("started\n", "wall-clock")
+        assert result.format().endswith("[The execution was stopped after reaching its wall-clock timeout]")
+        assert worker.run("print(x)").stdout == "1\n"
+    finally:
+        worker.close()
+
+def test_worker_ignoring_the_interruption_is_restarted():
+    worker = PythonWorker(preload=[])
+    try:
+        worker.run("x = 1")
+        code = "import signal, time\nsignal.signal(signal.SIGINT, signal.SIG_IGN)\ntime.sleep(10)"
+        result = worker.run(code, timeout=0.3, interrupt_grace_period=0.3)
+        assert result.timeout == "wall-clock"
+        result = worker.run("print(globals().get('x'))")
+        assert (result.stdout, result.stderr) == ("None\n", PythonWorker.restart_notice)
+    finally:
+        worker.close()
+
+def test_worker_exiting_is_restarted():
+    worker = PythonWorker(preload=[])
+    try:
+        assert worker.run("import os\nos._exit(3)").error == "The Python worker exited with code 3"
+        assert worker.run("print('back')").stderr == PythonWorker.restart_notice
+    finally:
+        worker.close()
+
+def test_forked_namespace_is_isolated_from_its_parent():
+    parent = PythonNamespace()
+    exec(
+        "x = 1\n"
+        "def f(): return x\n"
+        "def bump():\n"
+        "    global x\n"
+        "    x += 100\n"
+        "class Counter:\n"
+        "    def get(self): return x\n"
+        "    @property\n"
+        "    def double(self): return 2 * x\n"
+        "counter = Counter()\n"
+        "handlers = [f]\n",
+        parent.globals
+    )
+    fork = parent.fork()
+    exec("x = 2\nbump()", fork.globals)
+    assert fork.globals["x"] == 102 and parent.globals["x"] == 1
+    assert [fork.globals["f"](), fork.globals["handlers"][0](), fork.globals["counter"].get(), fork.globals["counter"].double] == [102, 102, 102, 204]
+    assert [parent.globals["f"](), parent.globals["counter"].get()] == [1, 1]
+    assert isinstance(fork.globals["counter"], fork.globals["Counter"])
@@ -0,0 +1,30 @@
+import pytest
+from saola.record import RecordingModel, ReplayModel
+from conftest import ScriptedModel
+
+class AnsweringModel(ScriptedModel):
+    def _get_answer(self, messages):
+        self.requests.append(messages)
+        return ("assistant", self.answers.pop(0))
+
+def messages(text):
+    return [{"role": "user", "content": text}]
+
+def test_streams_and_answers_are_replayed_in_order(tmp_path):
+    path = str(tmp_path / "recording.jsonl.gz")
+    recording = RecordingModel(AnsweringModel(["Hel", "lo"], "Answer", ["Second"], "Other answer"), path)
+    assert list(recording._stream_answer_nonstop(messages("a"))) == [("assistant", "Hel"), ("assistant", "lo")]
+    assert recording._get_answer(messages("b")) == ("assistant", "Answer")
+    assert list(recording._stream_answer_nonstop(messages("c"))) == [("assistant", "Second")]
+    assert recording._get_answer(messages("d")) == ("assistant", "Other answer")
+    replay = ReplayModel(path)
+    # Calls of either kind, with unknown messages, do not use up the recordings of the other kind
+    assert replay._get_answer(messages("unknown")) == ("assistant", "Answer")
+    assert list(replay._stream_answer_nonstop(messages("unknown"))) == [("assistant", "Hel"), ("assistant", "lo")]
+    # Recordings made for the same messages come first
+    assert replay._get_answer(messages("d")) == ("assistant", "Other answer")
+    assert list(replay._stream_answer_nonstop(messages("c"))) == [("assistant", "Second")]
+    with pytest.raises(LookupError):
+        replay._get_answer(messages("b"))
+    with pytest.raises(LookupError):
+        list(replay._stream_answer_nonstop(messages("a")))
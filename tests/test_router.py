@@ -0,0 +1,70 @@
+import pytest
+from saola.router import RoutedModel
+from conftest import ScriptedModel
+
+class Dropped(ConnectionError):
+    pass
+
+class DroppingModel(ScriptedModel):
+    # Streams the given chunks, then fails
+    def _stream_answer_nonstop(self, messages):
+        yield from super()._stream_answer_nonstop(messages)
+        raise Dropped()
+
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+def test_stream_failing_midway_is_continued_by_another_model():
+    (failing, other) = (DroppingModel(["Hello ", "wor"]), ScriptedModel(["ld!"]))
+    router = RoutedModel([failing, other])
+    router.endpoints[1].outstanding = 1  # The failing model is tried first
+    chunks = [chunk for (_, chunk) in router._stream_answer_nonstop(MESSAGES)]
+    assert chunks == ["Hello ", "wor", "ld!"]
+    assert other.requests == [MESSAGES + [{"role": "assistant", "content": "Hello wor"}]]
+    assert router.failovers == 1
+
+def test_stream_failing_midway_fails_without_continue_streams():
+    (failing, other) = (DroppingModel(["Hello "]), ScriptedModel(["ignored"]))
+    router = RoutedModel([failing, other], continue_streams=False)
+    router.endpoints[1].outstanding = 1
+    with pytest.raises(Dropped):
+        list(router._stream_answer_nonstop(MESSAGES))
+    assert other.requests == []
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"Error {status_code}")
+        self.status_code = status_code
+
+class FailingModel(ScriptedModel):
+    def __init__(self, error):
+        super().__init__()
+        self.error = error
+
+    def _stream_answer_nonstop(self, messages):
+        self.requests.append(messages)
+        raise self.error
+        yield
+
+def probed_router(error):
+    # A router whose first endpoint has an open circuit, due for a probe, that fails with error
+    (failing, other) = (FailingModel(error), ScriptedModel("Hello"))
+    router = RoutedModel([failing, other], failure_threshold=1, reset_timeout=0)
+    router.endpoints[0].opened_at = 0.0
+    router.endpoints[1].outstanding = 1  # The failing model is tried first
+    return (router, failing, other)
+
+def test_endpoint_errors_open_the_circuit_and_fail_over():
+    (router, failing, other) = probed_router(StatusError(401))
+    assert [chunk for (_, chunk) in router._stream_answer_nonstop(MESSAGES)] == ["Hello"]
+    endpoint = router.endpoints[0]
+    assert (endpoint.healthy, endpoint.failures, endpoint.errors) == (False, 1, 1)
+    assert len(other.requests) == 1
+
+def test_errors_of_the_request_do_not_change_the_health_of_the_endpoint():
+    (router, failing, other) = probed_router(StatusError(400))
+    with pytest.raises(StatusError):
+        list(router._stream_answer_nonstop(MESSAGES))
+    endpoint = router.endpoints[0]
+    assert (endpoint.healthy, endpoint.failures, endpoint.errors, endpoint.latency) == (False, 0, 0, None)
+    assert (endpoint.outstanding, endpoint.probing) == (0, False)
+    assert other.requests == []
@@ -0,0 +1,121 @@
+import json
+import asyncio
+from saola.convo import Interface
+from saola.model import AsyncModel
+from saola.serve import Server
+
+class EchoInterface(Interface):
+    name = "ECHO"
+    explanation = ""
+
+    def execute(self, code):
+        self._print_output("stdout", "echoing\n")
+        return f"echo: {code.strip()}"
+
+class StubModel(AsyncModel):
+    # Answers with the given chunks, then with "done" once an interface output follows
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.yielded = 0
+
+    async def _stream_answer_nonstop(self, messages):
+        if "-- END OUTPUT --" in messages[-1]["content"]:
+            yield ("assistant", "done")
+            return
+        for chunk in self.chunks:
+            self.yielded += 1
+            yield ("assistant", chunk)
+
+class Client:
+    def __init__(self, reader, writer):
+        (self.reader, self.writer) = (reader, writer)
+
+    async def send(self, **request):
+        self.writer.write((json.dumps(request) + "\n").encode("utf-8"))
+        await self.writer.drain()
+
+    async def receive(self):
+        return json.loads(await asyncio.wait_for(self.reader.readline(), 5))
+
+    async def receive_until(self, type):
+        events = []
+        while not events or events[-1]["type"] != type: events.append(await self.receive())
+        return events
+
+def run(server, client_main):
+    # Runs client_main(server, client) against the server, listening on a free port
+    async def main():
+        listener = await server.start("127.0.0.1", 0)
+        async with listener:
+            port = listener.sockets[0].getsockname()[1]
+            client = Client(*await asyncio.open_connection("127.0.0.1", port, limit=2 ** 21))
+            try:
+                await client_main(server, client)
+            finally:
+                client.writer.close()
+    asyncio.run(main())
+
+def test_session_streams_the_answer_and_the_interface_output():
+    models = []
+    def model_factory():
+        models.append(StubModel(["Let me check.\n[__ECHO__]\nhi\n", "[/__ECHO__]\n"]))
+        return models[-1]
+    async def client_main(server, client):
+        session = await client.receive()
+        assert session["type"] == "session" and list(server.sessions) == [session["session"]]
+        assert await client.receive() == {"type": "ready"}
+        await client.send(type="user", text="Echo hi")
+        events = await client.receive_until("ready")
+        types = [event["type"] for event in events]
+        assert types[0] == "assistant"
+        assert [e["type"] for e in events if e["type"].startswith("interface")] == ["interface_begin", "interface_chunk", "interface_output"]
+        assert next(e for e in events if e["type"] == "interface_chunk") == {"type": "interface_chunk", "interface": "ECHO", "stream": "stdout", "text": "echoing\n"}
+        assert next(e for e in events if e["type"] == "interface_output")["output"] == "echo: hi"
+        texts = "".join(e["text"] for e in events if e["type"] == "chunk")
+        assert texts.startswith("Let me check.\n[__ECHO__]\nhi\n") and texts.endswith("done")
+    run(Server(model_factory=model_factory, interfaces=[EchoInterface], safety_checks=False), client_main)
+    assert len(models) == 1
+
+BIG_CHUNKS = ["x" * (1 << 20)] * 64  # Large enough to fill the socket buffers
+
+def test_slow_client_holds_back_the_stream_and_disconnecting_ends_the_session():
+    model = StubModel(BIG_CHUNKS)
+    server = Server(model_factory=lambda: model, interfaces=[], max_pending_chunks=2)
+    closed = []
+    async def client_main(server, client):
+        await client.receive_until("ready")
+        convo = next(iter(server.sessions.values()))
+        convo.interface_state["TEST"] = type("State", (), {"close": lambda self: closed.append(True)})()
+        await client.send(type="user", text="Write a lot")
+        await asyncio.sleep(0.5)  # The client doesn't read meanwhile
+        assert 0 < model.yielded < len(BIG_CHUNKS)
+        yielded = model.yielded
+        await asyncio.sleep(0.2)
+        assert model.yielded == yielded
+        client.writer.close()
+        for _ in range(100):
+            if not server.sessions: break
+            await asyncio.sleep(0.05)
+        assert server.sessions == {} and closed == [True]
+        assert model.yielded < len(BIG_CHUNKS)
+    run(server, client_main)
+
+def test_slow_client_gets_the_whole_answer_once_it_reads():
+    model = StubModel(BIG_CHUNKS)
+    async def client_main(server, client):
+        await client.receive_until("ready")
+        await client.send(type="user", text="Write a lot")
+        await asyncio.sleep(0.3)
+        assert model.yielded < len(BIG_CHUNKS)
+        events = await client.receive_until("ready")
+        assert sum(len(e["text"]) for e in events if e["type"] == "chunk") == len(BIG_CHUNKS) << 20
+    run(Server(model_factory=lambda: model, interfaces=[], max_pending_chunks=2), client_main)
+
+def test_invalid_requests_get_an_error():
+    async def client_main(server, client):
+        await client.receive_until("ready")
+        client.writer.write(b"not json\n")
+        assert (await client.receive())["type"] == "error"
+        await client.send(type="unknown")
+        assert (await client.receive()) == {"type": "error", "error": "Unknown request."}
+    run(Server(model_factory=lambda: StubModel([]), interfaces=[]), client_main)
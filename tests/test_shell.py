@@ -0,0 +1,75 @@
+import time
+from saola.shell import run_command, ShellSession, ShellSessionPool
+
+def test_session_keeps_its_state_between_commands():
+    session = ShellSession()
+    try:
+        session.run("cd /tmp && export GREETING=hi")
+        assert session.run("pwd; echo $GREETING").stdout == "/tmp\nhi\n"
+    finally:
+        session.close()
+
+def test_background_output_shows_up_in_the_next_command():
+    session = ShellSession()
+    try:
+        session.run("(sleep 0.2; echo late) &")
+        time.sleep(0.5)
+        assert session.run("echo now").stdout == "late\nnow\n"
+    finally:
+        session.close()
+
+def test_check_restarts_a_hung_shell_and_keeps_the_restart_notice():
+    session = ShellSession()
+    try:
+        session.run("cd /tmp")
+        session.process.stdin.write(b"sleep 10\n")  # Keeps the shell busy, as a stuck command would
+        session.process.stdin.flush()
+        session.check(timeout=0.5)
+        assert session.alive() and session.restarted
+        result = session.run("pwd")
+        assert result.stderr == ShellSession.restart_notice
+        assert result.stdout != "/tmp\n"
+    finally:
+        session.close()
+
+def test_pool_checks_sessions_left_idle():
+    pool = ShellSessionPool(size=1, check_after=0, check_timeout=0.5)
+    try:
+        pool.acquire().close()
+        session = pool._idle[0]
+        session.process.stdin.write(b"sleep 10\n")
+        session.process.stdin.flush()
+        acquired = pool.acquire()
+        assert acquired is session and acquired.alive() and not acquired.restarted
+        assert acquired.run("echo ok").stdout == "ok\n"
+        acquired.close()
+    finally:
+        pool.close()
+
+def test_command_is_stopped_at_its_wall_clock_timeout():
+    start = time.monotonic()
+    result = run_command("echo started; sleep 10", timeout=0.5)
+    assert time.monotonic() - start < 5
+    assert (result.stdout, result.timeout) == ("started\n", "wall-clock")
+    assert result.format().endswith("[The command was stopped after reaching its wall-clock timeout]")
+
+def test_command_is_stopped_after_idle_timeout_without_output():
+    result = run_command("for i in 1 2 3; do echo $i; sleep 0.1; done; sleep 10", timeout=20, idle_timeout=0.5)
+    assert (result.stdout, result.timeout) == ("1\n2\n3\n", "idle")
+
+def test_background_jobs_do_not_keep_a_command_running():
+    # The background job keeps stdout open after the command exits, without printing anything
+    start = time.monotonic()
+    result = run_command("sleep 10 &", timeout=1)
+    assert time.monotonic() - start < 5
+    assert result.timeout is None and result.returncode == 0
+
+def test_session_is_restarted_after_a_timeout():
+    session = ShellSession()
+    try:
+        session.run("export GREETING=hi")
+        assert session.run("sleep 10", timeout=0.5).timeout == "wall-clock"
+        result = session.run("echo ${GREETING:-reset}")
+        assert (result.stdout, result.stderr) == ("reset\n", ShellSession.restart_notice)
+    finally:
+        session.close()
@@ -0,0 +1,90 @@
+import threading
+from saola.convo import Convo, Interface
+from saola.model import Model
+from conftest import QuietUI
+
+class PeekInterface(Interface):
+    name = "PEEK"
+    explanation = ""
+    pure = True
+
+    def execute(self, code):
+        self.convo.runs.append(threading.current_thread() is not threading.main_thread())
+        self._print_output("stdout", "peeked\n")
+        self.convo.printed.set()
+        return f"peek: {code.strip()}"
+
+class RecordingUI(QuietUI):
+    # Like the UIs of the package, returns True from no_safety_confirmation, and answers confirmations with confirm
+    def __init__(self, confirm=True):
+        self.confirm = confirm
+        self.events = []
+
+    def safety_confirmation(self, name, confirmation_title):
+        self.events.append(("confirmation", name))
+        return self.confirm
+
+    def will_begin_interface_output(self, interface):
+        self.events.append(("begin", interface.name))
+
+    def append_to_interface_output(self, interface, stream_name, text):
+        self.events.append((stream_name, text))
+
+class WaitingModel(Model):
+    # Streams a PEEK block, then waits for it to print something (if it runs speculatively) before going on
+    def __init__(self, convo_printed):
+        self.convo_printed = convo_printed
+
+    def _stream_answer_nonstop(self, messages):
+        if messages[-1]["role"] != "user":
+            yield ("assistant", "done")
+            return
+        yield ("assistant", "[__PEEK__]\nx\n[/__PEEK__]\n")
+        self.convo_printed.wait(1)
+        yield ("assistant", "More text.")
+
+def answer(ui, **kwargs):
+    printed = threading.Event()
+    convo = Convo(WaitingModel(printed), ui=ui, interfaces=[PeekInterface], parallel_interfaces=True, **kwargs)
+    (convo.runs, convo.printed) = ([], printed)
+    convo.user << "hi"
+    convo.stream_answer_to_end()
+    convo.close()
+    return convo
+
+def test_blocks_do_not_run_speculatively_by_default():
+    convo = answer(RecordingUI())
+    assert convo.runs == [False]
+
+def test_output_printed_speculatively_is_shown_when_the_block_runs():
+    ui = RecordingUI()
+    convo = answer(ui, speculative_interfaces=True, safety_checks=False)
+    assert convo.runs == [True]
+    assert ui.events == [("begin", "PEEK"), ("stdout", "peeked\n")]
+    assert convo.bubbles[-2].text == "-- OUTPUT --\npeek: x\n-- END OUTPUT --"
+
+def test_blocks_needing_a_confirmation_do_not_run_speculatively():
+    ui = RecordingUI(confirm=False)
+    convo = answer(ui, speculative_interfaces=True)
+    assert convo.runs == []
+    assert ui.events == [("confirmation", "PEEK")]
+    convo = answer(RecordingUI(), speculative_interfaces=True)
+    assert convo.runs == [False]
+
+def test_dropped_speculations_are_cancelled_and_the_pool_closed_with_the_convo(quiet_ui):
+    convo = Convo(WaitingModel(threading.Event()), ui=quiet_ui, interfaces=[PeekInterface], speculative_interfaces=True)
+    convo.max_speculative_interfaces = 1
+    (convo.runs, convo.printed) = ([], threading.Event())
+    busy = threading.Event()
+    pool = convo._speculation_executor()
+    pool.submit(busy.wait, 5)
+    interface = PeekInterface(convo)
+    interface.current_code = "x"
+    interface._speculate()
+    speculation = interface._speculation
+    interface._drop_speculation()
+    assert speculation.cancelled() and interface._speculation is None
+    assert convo.fork()._speculation_pool is None
+    busy.set()
+    convo.close()
+    assert convo._speculation_pool is None and convo.runs == []
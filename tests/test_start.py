@@ -0,0 +1,34 @@
+import importlib
+from types import SimpleNamespace
+
+start = importlib.import_module("saola.start")  # The module, rather than the start function exported by saola
+
+class FakeModels:
+    def __init__(self, *names):
+        self.names = list(names)
+        self.listed = 0
+
+    def list(self):
+        self.listed += 1
+        return [SimpleNamespace(id=name) for name in self.names]
+
+def test_model_names_are_listed_again_once_the_cache_expires(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(start, "MODEL_CACHE_PATH", str(tmp_path / "models.json"))
+    monkeypatch.setattr(start.time, "time", lambda: now[0])
+    models = FakeModels("gpt-4")
+    client = SimpleNamespace(models=models)
+    ttl = 100
+    assert start._resolve_model_name(client, "key", None, ttl) == "gpt-4"
+    # Starting again within the ttl uses the cache, without making it last longer
+    for _ in range(3):
+        now[0] += 30
+        assert start._resolve_model_name(client, "key", None, ttl) == "gpt-4"
+    assert models.listed == 1
+    now[0] += 30  # 120 seconds after the names were listed
+    assert start._resolve_model_name(client, "key", None, ttl) == "gpt-4"
+    assert models.listed == 2
+    models.names = ["gpt-3.5-turbo-1106"]
+    now[0] += 101
+    assert start._resolve_model_name(client, "key", None, ttl) == "gpt-3.5-turbo-1106"
+    assert models.listed == 3
@@ -0,0 +1,105 @@
+import os
+import pytest
+from saola.base_convo import BaseConvo
+from saola.convo import Convo, Interface
+from saola.store import ConvoStore, MAGIC
+from conftest import QuietUI, ScriptedModel
+
+def texts(convo):
+    return [(b.author, b.text) for b in convo.bubbles]
+
+def saved_convo(path):
+    convo = BaseConvo()
+    convo.system << "system"
+    convo.user << "hi"
+    ConvoStore(path).save(convo)
+    return convo
+
+def test_changes_are_appended_and_loaded(tmp_path):
+    path = tmp_path / "convo.bin"
+    convo = saved_convo(path)
+    convo.checkpoint()
+    bubble = convo.assistant << "Hello"
+    bubble.doc.append(" world")
+    convo.store.close()
+    loaded = ConvoStore(path).load(BaseConvo())
+    assert texts(loaded) == texts(convo) and loaded.checkpoints == convo.checkpoints
+
+def test_load_after_a_torn_write_drops_the_partial_record(tmp_path):
+    path = tmp_path / "convo.bin"
+    convo = saved_convo(path)
+    complete_size = os.path.getsize(path)
+    convo.assistant << "Hello"
+    convo.store.close()
+    data = path.read_bytes()
+    for size in range(complete_size, len(data)):
+        # The file ends anywhere within the records of the last bubble, as after a crash
+        path.write_bytes(data[:size])
+        store = ConvoStore(path)
+        loaded = store.load(BaseConvo())
+        assert texts(loaded)[:2] == [("system", "system"), ("user", "hi")]
+        assert texts(loaded)[2:] in ([], [("assistant", "")])
+        # New records are appended after the last complete one
+        loaded.assistant << "Recovered"
+        store.close()
+        assert texts(ConvoStore(path).load(BaseConvo()))[-1] == ("assistant", "Recovered")
+
+def test_load_rejects_files_that_are_not_convos(tmp_path):
+    path = tmp_path / "convo.bin"
+    path.write_bytes(MAGIC[:-2])
+    with pytest.raises(ValueError):
+        ConvoStore(path).load(BaseConvo())
+
+class PendingUI(QuietUI):
+    # Leaves confirmations pending, as the NotebookUI and NetworkUI do
+    def safety_confirmation(self, name, confirmation_title):
+        return None
+
+class RunsInterface(Interface):
+    name = "RUN"
+    explanation = ""
+
+    def execute(self, code):
+        self.convo.ran.append(code.strip())
+        return f"ran {code.strip()}"
+
+def interface_convo(model, ui):
+    convo = Convo(model, ui=ui, interfaces=[RunsInterface])
+    convo.ran = []
+    return convo
+
+def test_block_cut_short_resumes_from_where_the_stream_stopped(tmp_path, quiet_ui):
+    path = tmp_path / "convo.bin"
+    convo = interface_convo(ScriptedModel(["Running.\n[__RUN__]\n", "print(1)", "\n[/__RUN__]\n"]), quiet_ui)
+    convo.user << "go"
+    ConvoStore(path).save(convo)
+    stream = convo.stream_answer()
+    for _ in range(2): next(stream)
+    # The process dies in the middle of the block, so a copy of the file is all that is left of it
+    crashed_path = tmp_path / "crashed.bin"
+    crashed_path.write_bytes(path.read_bytes())
+    model = ScriptedModel(["\n[/__RUN__]\n"], "Thanks.")
+    loaded = ConvoStore(crashed_path).load(interface_convo(model, quiet_ui))
+    assert loaded.current_matching_interface is not None and loaded.current_matching_interface.current_code is None
+    loaded.stream_answer_to_end()
+    # The model is asked to go on with the partial answer, not to answer again
+    assert model.requests[0][-1]["role"] == "assistant" and model.requests[0][-1]["content"].endswith("print(1)")
+    assert loaded.ran == ["print(1)"]
+    assert [b.text for b in loaded.bubbles[2:]] == ["Running.\n[__RUN__]\nprint(1)\n[/__RUN__]", "-- OUTPUT --\nran print(1)\n-- END OUTPUT --", "Thanks."]
+
+def test_block_awaiting_a_confirmation_runs_after_loading(tmp_path, quiet_ui):
+    path = tmp_path / "convo.bin"
+    convo = interface_convo(ScriptedModel("Running.\n[__RUN__]\nprint(1)\n[/__RUN__]\n"), PendingUI())
+    convo.user << "go"
+    ConvoStore(path).save(convo)
+    convo.stream_answer_to_end()
+    assert convo.ran == [] and convo.current_matching_interface is not None
+    convo.store.close()
+    model = ScriptedModel("Thanks.")
+    loaded = ConvoStore(path).load(interface_convo(model, quiet_ui))
+    assert loaded.current_matching_interface.current_code.strip() == "print(1)"
+    loaded.stream_answer_to_end()
+    # The block runs, and the only request is the one following its output
+    assert loaded.ran == ["print(1)"]
+    assert len(model.requests) == 1 and "ran print(1)" in model.requests[0][-1]["content"]
+    assert loaded.bubbles[-1].text == "Thanks."